@@ -0,0 +1,90 @@
+import json
+import typer
+
+
+app = typer.Typer(help="Compare two benchmark result files and report throughput, memory and accuracy regressions.")
+
+
+def load_results(file_path):
+    with open(file_path) as f:
+        results = json.load(f)
+
+    return results, {case["case"]: case for case in results["cases"]}
+
+
+
+def relative_change(before, after):
+    if before is None or after is None or before == 0:
+        return None
+    return (after - before) / before
+
+
+
+def compare_case(before, after, time_tolerance, memory_tolerance, error_tolerance, min_stage_s):
+    # (name, before, after, change, regression) rows of one benchmark case
+    rows = []
+
+    def add(name, old, new, tolerance, absolute=False, minimum=0):
+        change = (new - old) if absolute else relative_change(old, new)
+        significant = old is not None and new is not None and max(old, new) >= minimum
+        regression = change is not None and significant and change > tolerance
+        rows.append((name, old, new, change, regression, absolute))
+
+    add("wall_s", before["wall_s"], after["wall_s"], time_tolerance)
+    add("peak_rss_mb", before["peak_rss_mb"], after["peak_rss_mb"], memory_tolerance)
+    add("mean_error_px", before["accuracy"]["mean_px"], after["accuracy"]["mean_px"], error_tolerance, absolute=True)
+    add("max_error_px", before["accuracy"]["max_px"], after["accuracy"]["max_px"], error_tolerance, absolute=True)
+
+    # stages that only exist in one of the runs (e.g. a new option) are listed without a change
+    for stage in list(before["stages"]) + [s for s in after["stages"] if s not in before["stages"]]:
+        old = before["stages"].get(stage, {}).get("wall_s")
+        new = after["stages"].get(stage, {}).get("wall_s")
+        add(f"stage {stage} wall_s", old, new, time_tolerance, minimum=min_stage_s)
+
+    return rows
+
+
+
+def format_value(value):
+    return "-" if value is None else f"{value:.3f}"
+
+
+
+@app.command()
+def compare(
+    baseline_path: str = typer.Argument(..., help="Benchmark results of the reference version"),
+    candidate_path: str = typer.Argument(..., help="Benchmark results of the version to check"),
+    time_tolerance: float = typer.Option(0.1, help="Allowed relative increase of wall time", show_default=True),
+    memory_tolerance: float = typer.Option(0.1, help="Allowed relative increase of peak memory", show_default=True),
+    error_tolerance: float = typer.Option(0.5, help="Allowed increase of the registration error in px", show_default=True),
+    min_stage_s: float = typer.Option(0.1, help="Ignore stages faster than this in both runs, their timings are dominated by noise", show_default=True),
+):
+    baseline, baseline_cases = load_results(baseline_path)
+    candidate, candidate_cases = load_results(candidate_path)
+    print(f"Baseline:  {baseline['environment'].get('commit')} ({baseline_path})")
+    print(f"Candidate: {candidate['environment'].get('commit')} ({candidate_path})")
+
+    regressions = []
+    for name, before in baseline_cases.items():
+        if name not in candidate_cases:
+            print(f"\n{name}: missing from the candidate results")
+            continue
+
+        print(f"\n{name}")
+        for metric, old, new, change, regression, absolute in compare_case(before, candidate_cases[name], time_tolerance,
+                                                                           memory_tolerance, error_tolerance, min_stage_s):
+            change_text = "-" if change is None else (f"{change:+.3f}" if absolute else f"{change:+.1%}")
+            print(f"  {metric:<40} {format_value(old):>10} {format_value(new):>10} {change_text:>9}{'  REGRESSION' if regression else ''}")
+            if regression:
+                regressions.append(f"{name} {metric}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): " + ", ".join(regressions))
+        raise typer.Exit(code=1)
+
+    print("\nNo regressions.")
+
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+import typer
+from stainwarpy.regPipeline import registration_pipeline
+from stainwarpy.profiling import StageProfiler
+from .synthetic import load_pair
+
+
+app = typer.Typer(help="Benchmark the registration pipeline on synthetic DAPI / H&E pairs with a known ground truth.")
+
+RESULTS_FORMAT_VERSION = 1
+
+
+def transform_error(tform, truth_matrix, size, pixel_size, n_points=20):
+    # distance between the estimated and the ground truth mapping on a grid over the moving image
+    grid = np.linspace(0.05 * size, 0.95 * size, n_points)
+    xx, yy = np.meshgrid(grid, grid)
+    points = np.column_stack([xx.ravel(), yy.ravel(), np.ones(xx.size)])
+
+    estimated = points @ np.asarray(tform.params).T
+    truth = points @ np.asarray(truth_matrix).T
+    estimated = estimated[:, :2] / estimated[:, 2:]
+    truth = truth[:, :2] / truth[:, 2:]
+    error = np.linalg.norm(estimated - truth, axis=1)
+
+    return {
+        "mean_px": float(error.mean()),
+        "median_px": float(np.median(error)),
+        "max_px": float(error.max()),
+        "mean_um": float(error.mean() * pixel_size),
+    }
+
+
+
+def environment_info():
+    import scipy
+    import skimage
+    import tifffile
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "scikit-image": skimage.__version__,
+        "tifffile": tifffile.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+
+def run_case(fixed_path, moving_path, truth, pipeline_options):
+
+    size, kind, seed = truth["size"], truth["kind"], truth["seed"]
+    profiler = StageProfiler()
+    start = time.perf_counter()
+    tform, moved_img, tre, mi = registration_pipeline(fixed_path, moving_path, None, None, "multiplexed",
+                                                      feature_tform=kind, profiler=profiler, **pipeline_options)
+    wall = time.perf_counter() - start
+    summary = profiler.summary()
+
+    return {
+        "case": f"{kind}_{size}",
+        "size": size,
+        "kind": kind,
+        "seed": seed,
+        "megapixels": size * size / 1e6,
+        "wall_s": wall,
+        "megapixels_per_s": size * size / 1e6 / wall,
+        "peak_rss_mb": summary["peak_rss_mb"],
+        "stages": {record["stage"]: {key: value for key, value in record.items() if key != "stage"} for record in summary["stages"]},
+        "accuracy": transform_error(tform, truth["transformation_map"], size, truth["pixel_size"]),
+        "TRE": tre,
+        "Mutual Information": mi,
+    }
+
+
+
+def run_isolated(fixed_path, moving_path, truth, pipeline_options):
+    # a fresh process per case so peak memory is not carried over from earlier cases or the slide generation
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_case, fixed_path, moving_path, truth, pipeline_options).result()
+
+
+
+@app.command()
+def run(
+    output_path: str = typer.Argument(..., help="Path of the JSON file the results are written to"),
+    sizes: List[int] = typer.Option([1024, 4096], "--size", help="Slide sizes in px (repeatable), e.g. 1024 up to 40000"),
+    kinds: List[str] = typer.Option(["similarity", "affine"], "--kind", help="Ground truth transformations ['similarity', 'affine'] (repeatable)"),
+    seed: int = typer.Option(0, help="Seed of the synthetic slides", show_default=True),
+    repeat: int = typer.Option(1, help="Run every case this many times and keep the fastest", show_default=True),
+    data_dir: str = typer.Option(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"), help="Folder of the generated synthetic slides, reused between runs"),
+    tile_size: int = typer.Option(None, help="Passed to the pipeline as for 'stainwarpy register'"),
+    use_pyramid: bool = typer.Option(False, "--use-pyramid", help="Passed to the pipeline as for 'stainwarpy register'"),
+    fast_deconv: bool = typer.Option(False, "--fast-deconv", help="Passed to the pipeline as for 'stainwarpy register'"),
+    refine: bool = typer.Option(False, "--refine", help="Passed to the pipeline as for 'stainwarpy register'"),
+    matcher: str = typer.Option('brute', help="Passed to the pipeline as for 'stainwarpy register'", show_default=True),
+    fast_load: bool = typer.Option(False, "--fast-load", help="Passed to the pipeline as for 'stainwarpy register'"),
+    sift_workers: int = typer.Option(None, help="Passed to the pipeline as for 'stainwarpy register'"),
+    sift_tile_size: int = typer.Option(None, help="Passed to the pipeline as for 'stainwarpy register'"),
+    ransac: str = typer.Option('skimage', help="Passed to the pipeline as for 'stainwarpy register'", show_default=True),
+    tissue_mask: bool = typer.Option(False, "--tissue-mask", help="Passed to the pipeline as for 'stainwarpy register'"),
+    prealign: str = typer.Option('off', help="Passed to the pipeline as for 'stainwarpy register'", show_default=True),
+):
+    pipeline_options = dict(tile_size=tile_size, use_pyramid=use_pyramid, fast_deconvolution=fast_deconv, refine=refine, matcher=matcher,
+                            fast_load=fast_load, sift_workers=sift_workers, sift_tile_size=sift_tile_size, ransac_method=ransac, tissue_mask=tissue_mask, prealign=prealign)
+
+    results = []
+    for size in sizes:
+        for kind in kinds:
+            fixed_path, moving_path, truth = load_pair(os.path.join(data_dir, f"{kind}_{size}_seed{seed}"), size, kind, seed)
+            runs = [run_isolated(fixed_path, moving_path, truth, pipeline_options) for _ in range(repeat)]
+            result = min(runs, key=lambda r: r["wall_s"])
+            results.append(result)
+            print(f"{result['case']}: {result['wall_s']:.2f} s, {result['megapixels_per_s']:.2f} MP/s, "
+                  f"peak {result['peak_rss_mb']:.0f} MB, mean error {result['accuracy']['mean_px']:.2f} px")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump({"format_version": RESULTS_FORMAT_VERSION, "environment": environment_info(),
+                   "pipeline_options": pipeline_options, "cases": results}, f, indent=2)
+    print(f"Benchmark results saved to {output_path}")
+
+
+
+if __name__ == "__main__":
+    app()
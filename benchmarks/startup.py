@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+from typing import List
+import typer
+
+
+app = typer.Typer(help="Benchmark the start up time of the package and its command line interface.")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    "import stainwarpy": [sys.executable, "-c", "import stainwarpy"],
+    "stainwarpy --help": [sys.executable, "-m", "stainwarpy.reg_cli", "--help"],
+    "stainwarpy extract-channel --help": [sys.executable, "-m", "stainwarpy.reg_cli", "extract-channel", "--help"],
+    "stainwarpy transform-points --help": [sys.executable, "-m", "stainwarpy.reg_cli", "transform-points", "--help"],
+    "import stainwarpy.regPipeline": [sys.executable, "-c", "import stainwarpy.regPipeline"],
+}
+
+
+def package_env(repo_root):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = repo_root + os.pathsep + env.get("PYTHONPATH", "")
+
+    return env
+
+
+
+def time_command(command, env, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+
+    return {"median_s": statistics.median(times), "min_s": min(times), "max_s": max(times)}
+
+
+
+def slowest_imports(module, env, top):
+    # (cumulative us, module) of the slowest imports from python -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].strip()))
+
+    return sorted(rows, reverse=True)[:top]
+
+
+
+@app.command()
+def startup(
+    repeat: int = typer.Option(10, help="Run every command this many times", show_default=True),
+    commands: List[str] = typer.Option(list(COMMANDS), "--command", help=f"Commands to time (repeatable) {list(COMMANDS)}"),
+    repo_root: str = typer.Option(REPO_ROOT, help="Checkout of stainwarpy to benchmark, e.g. a worktree of an older commit"),
+    top: int = typer.Option(10, help="Also list this many slowest imports of the CLI module", show_default=True),
+    output_path: str = typer.Option(None, help="Save the results to this JSON file"),
+):
+    env = package_env(repo_root)
+    results = {}
+    for name in commands:
+        if name not in COMMANDS:
+            raise ValueError(f"Unknown command '{name}'. Use one of {list(COMMANDS)}.")
+        results[name] = time_command(COMMANDS[name], env, repeat)
+        print(f"{name:<40} median {results[name]['median_s'] * 1000:8.1f} ms   min {results[name]['min_s'] * 1000:8.1f} ms")
+
+    if top > 0:
+        print("\nSlowest imports of stainwarpy.reg_cli (cumulative):")
+        for us, module in slowest_imports("stainwarpy.reg_cli", env, top):
+            print(f"  {us / 1000:8.1f} ms  {module}")
+
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            json.dump({"python": sys.version.split()[0], "repo_root": repo_root, "repeat": repeat, "commands": results}, f, indent=2)
+        print(f"Startup results saved to {output_path}")
+
+
+
+if __name__ == "__main__":
+    app()
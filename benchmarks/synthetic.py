@@ -0,0 +1,230 @@
+import os
+import json
+import numpy as np
+from scipy import ndimage
+from skimage.transform import SimilarityTransform, AffineTransform
+from stainwarpy.writer import write_pyramidal_ome_tiff
+from stainwarpy.tiling import cast_to_dtype
+
+"""
+Synthetic DAPI / H&E slide pairs of any size with a known ground truth transformation.
+
+Both images are rendered tile by tile from the same tissue model (a smooth random tissue
+field and a set of nuclei), the H&E image in a frame related to the DAPI frame by the ground
+truth transformation, so slides far larger than memory can be generated.
+"""
+
+FIELD_SIZE = 256
+NUCLEUS_SPACING = 14
+NUCLEUS_SIGMA = 2.5
+PIXEL_SIZE = 0.5
+
+HEMATOXYLIN = np.array([0.65, 0.70, 0.29])
+EOSIN = np.array([0.07, 0.99, 0.11])
+
+
+def ground_truth_transform(size, kind="similarity", seed=0):
+    # moving -> fixed transformation: rotation about the slide centre plus a small shift (and shear for affine)
+    rng = np.random.default_rng(seed)
+    centre = np.array([size / 2, size / 2])
+    rotation = np.deg2rad(rng.uniform(4, 10))
+    shift = rng.uniform(-0.03, 0.03, 2) * size
+
+    if kind == "similarity":
+        linear = SimilarityTransform(rotation=rotation, scale=rng.uniform(0.97, 1.03)).params
+    elif kind == "affine":
+        linear = AffineTransform(rotation=rotation, scale=rng.uniform(0.96, 1.04, 2), shear=rng.uniform(0.02, 0.05)).params
+    else:
+        raise ValueError("Invalid ground truth transformation. Use 'similarity' or 'affine'.")
+
+    to_origin = np.eye(3)
+    to_origin[:2, 2] = -centre
+    back = np.eye(3)
+    back[:2, 2] = centre + shift
+
+    return AffineTransform(matrix=back @ linear @ to_origin)
+
+
+
+def tissue_field(seed=0):
+    # scale free tissue density on a FIELD_SIZE grid covering the slide: coarse tissue islands with finer texture
+    rng = np.random.default_rng(seed)
+    coarse = ndimage.gaussian_filter(rng.standard_normal((FIELD_SIZE, FIELD_SIZE)), 10, mode="wrap")
+    fine = ndimage.gaussian_filter(rng.standard_normal((FIELD_SIZE, FIELD_SIZE)), 2.5, mode="wrap")
+    field = coarse / coarse.std() + 0.35 * fine / fine.std() + 0.4
+
+    # fade out towards the slide border so no tissue is cut by the moving image canvas
+    yy, xx = np.mgrid[0:FIELD_SIZE, 0:FIELD_SIZE] / (FIELD_SIZE - 1) - 0.5
+    field -= 4 * np.maximum(np.hypot(yy, xx) - 0.3, 0) / 0.2
+
+    return field
+
+
+
+def tissue_density(field, size, x, y):
+    # tissue density (0 outside tissue) at fixed frame coordinates
+    scale = (FIELD_SIZE - 1) / (size - 1)
+    values = ndimage.map_coordinates(field, [np.asarray(y) * scale, np.asarray(x) * scale], order=1, mode="nearest")
+
+    return np.clip(values, 0, 1.5) / 1.5
+
+
+
+def sample_nuclei(field, size, seed=0):
+    # nuclei (x, y, amplitude) in the fixed frame, denser where the tissue is dense
+    rng = np.random.default_rng(seed + 1)
+    n_candidates = int((size / NUCLEUS_SPACING) ** 2)
+
+    nuclei = []
+    for start in range(0, n_candidates, 1 << 22):
+        n = min(1 << 22, n_candidates - start)
+        xy = rng.uniform(0, size, (n, 2))
+        keep = rng.uniform(0, 1, n) < tissue_density(field, size, xy[:, 0], xy[:, 1])
+        nuclei.append(np.column_stack([xy[keep], rng.uniform(0.6, 1.0, keep.sum())]))
+
+    return np.concatenate(nuclei)
+
+
+
+class NucleusIndex:
+    # nuclei of one frame bucketed into a grid so a tile only touches the nuclei around it
+
+    def __init__(self, xy, amplitude, cell_size):
+        self.cell_size = cell_size
+        # nuclei left of / above the slide share the -1 cell
+        cells = np.maximum(np.floor(xy / cell_size).astype(np.int64), -1)
+        self.n_cols = int(cells[:, 0].max()) + 2 if len(cells) else 1
+        keys = (cells[:, 1] + 1) * self.n_cols + cells[:, 0] + 1
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.xy = xy[order]
+        self.amplitude = amplitude[order]
+
+    def query(self, y0, y1, x0, x1):
+        cy0, cy1 = max(int(np.floor(y0 / self.cell_size)), -1), int(np.floor(y1 / self.cell_size))
+        cx0, cx1 = max(int(np.floor(x0 / self.cell_size)), -1), min(int(np.floor(x1 / self.cell_size)), self.n_cols - 2)
+
+        parts = [np.zeros(0, dtype=np.int64)]
+        for cy in range(cy0, cy1 + 1):
+            lo, hi = np.searchsorted(self.keys, [(cy + 1) * self.n_cols + cx0 + 1, (cy + 1) * self.n_cols + cx1 + 2])
+            parts.append(np.arange(lo, hi))
+        idx = np.concatenate(parts)
+
+        return self.xy[idx], self.amplitude[idx]
+
+
+
+def render_nuclei(index, y0, y1, x0, x1, sigma):
+    # gaussian nuclei splatted with bilinear weights into the tile plus a margin
+    margin = int(np.ceil(4 * sigma)) + 1
+    xy, amplitude = index.query(y0 - margin, y1 + margin, x0 - margin, x1 + margin)
+    canvas = np.zeros((y1 - y0 + 2 * margin, x1 - x0 + 2 * margin))
+
+    px = xy[:, 0] - x0 + margin
+    py = xy[:, 1] - y0 + margin
+    ix, iy = np.floor(px).astype(int), np.floor(py).astype(int)
+    fx, fy = px - ix, py - iy
+    inside = (ix >= 0) & (iy >= 0) & (ix < canvas.shape[1] - 1) & (iy < canvas.shape[0] - 1)
+    ix, iy, fx, fy, amplitude = ix[inside], iy[inside], fx[inside], fy[inside], amplitude[inside]
+
+    for dy, dx, weight in ((0, 0, (1 - fy) * (1 - fx)), (0, 1, (1 - fy) * fx), (1, 0, fy * (1 - fx)), (1, 1, fy * fx)):
+        np.add.at(canvas, (iy + dy, ix + dx), amplitude * weight)
+
+    canvas = ndimage.gaussian_filter(canvas, sigma, mode="constant") * 2 * np.pi * sigma ** 2
+
+    return np.clip(canvas[margin:-margin, margin:-margin], 0, 1)
+
+
+
+class SyntheticSlide:
+    # tissue model shared by the fixed (DAPI) and moving (H&E) renderings
+
+    def __init__(self, size, kind="similarity", seed=0, tile_size=512):
+        self.size = size
+        self.tile_size = tile_size
+        self.seed = seed
+        self.tform = ground_truth_transform(size, kind, seed)
+        self.field = tissue_field(seed)
+
+        nuclei = sample_nuclei(self.field, size, seed)
+        # nuclei of the moving frame are the fixed nuclei mapped through the inverse ground truth
+        moving_xy = self.tform.inverse(nuclei[:, :2])
+        self.scale = np.sqrt(abs(np.linalg.det(self.tform.params[:2, :2])))
+        self.fixed_nuclei = NucleusIndex(nuclei[:, :2], nuclei[:, 2], tile_size)
+        self.moving_nuclei = NucleusIndex(moving_xy, nuclei[:, 2], tile_size)
+        self.n_nuclei = len(nuclei)
+
+    def noise(self, frame, channel, y0, x0, shape, scale):
+        rng = np.random.default_rng([self.seed, frame, channel, y0, x0])
+        return rng.normal(0, scale, shape)
+
+    def fixed_tile(self, channel, y0, y1, x0, x1):
+        xs, ys = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+        nuclei = render_nuclei(self.fixed_nuclei, y0, y1, x0, x1, NUCLEUS_SIGMA)
+
+        if channel == 0:
+            # DAPI
+            values = 0.03 + 0.9 * nuclei
+        else:
+            # tissue autofluorescence and marker-like channels
+            tissue = tissue_density(self.field, self.size, xs.ravel(), ys.ravel()).reshape(xs.shape)
+            values = 0.05 + (0.5 / channel) * tissue + (0.2 / channel) * nuclei
+
+        values = values + self.noise(0, channel, y0, x0, values.shape, 0.01)
+        return cast_to_dtype(np.clip(values, 0, 1) * 65535, np.uint16)
+
+    def moving_tile(self, channel, y0, y1, x0, x1):
+        xs, ys = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+        fixed_xy = self.tform(np.column_stack([xs.ravel(), ys.ravel()]))
+        tissue = tissue_density(self.field, self.size, fixed_xy[:, 0], fixed_xy[:, 1]).reshape(xs.shape)
+        nuclei = render_nuclei(self.moving_nuclei, y0, y1, x0, x1, NUCLEUS_SIGMA / self.scale)
+
+        # Beer-Lambert mixing of hematoxylin (nuclei) and eosin (tissue) optical densities
+        density = 1.1 * nuclei * HEMATOXYLIN[channel] + 0.45 * tissue * EOSIN[channel]
+        values = 255 * 10 ** -(density + self.noise(1, channel, y0, x0, density.shape, 0.015))
+
+        return cast_to_dtype(values, np.uint8)
+
+
+
+def generate_pair(output_folder, size, kind="similarity", seed=0, tile_size=512, n_fixed_channels=4):
+
+    os.makedirs(output_folder, exist_ok=True)
+    fixed_path = os.path.join(output_folder, "fixed.ome.tif")
+    moving_path = os.path.join(output_folder, "moving.ome.tif")
+    truth_path = os.path.join(output_folder, "ground_truth.json")
+
+    slide = SyntheticSlide(size, kind, seed, tile_size)
+
+    write_pyramidal_ome_tiff(fixed_path, slide.fixed_tile, (size, size, n_fixed_channels), np.uint16,
+                             channel_names=["DAPI"] + [f"marker_{c}" for c in range(1, n_fixed_channels)],
+                             pixel_size=PIXEL_SIZE, tile_size=tile_size)
+    write_pyramidal_ome_tiff(moving_path, slide.moving_tile, (size, size, 3), np.uint8,
+                             channel_names=["R", "G", "B"], pixel_size=PIXEL_SIZE, tile_size=tile_size)
+
+    truth = {
+        "size": size,
+        "kind": kind,
+        "seed": seed,
+        "pixel_size": PIXEL_SIZE,
+        "n_nuclei": slide.n_nuclei,
+        "transformation_map": slide.tform.params.tolist(),
+    }
+    with open(truth_path, "w") as f:
+        json.dump(truth, f, indent=2)
+
+    return fixed_path, moving_path, truth
+
+
+
+def load_pair(output_folder, size, kind="similarity", seed=0, tile_size=512):
+    # reuse a previously generated pair with the same parameters
+    truth_path = os.path.join(output_folder, "ground_truth.json")
+    if os.path.exists(truth_path):
+        with open(truth_path) as f:
+            truth = json.load(f)
+        if (truth["size"], truth["kind"], truth["seed"]) == (size, kind, seed):
+            return os.path.join(output_folder, "fixed.ome.tif"), os.path.join(output_folder, "moving.ome.tif"), truth
+
+    print(f"Generating synthetic {kind} pair of {size} x {size} px in {output_folder}.")
+    return generate_pair(output_folder, size, kind, seed, tile_size)
@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name="stainwarpy",
     version="0.1.6",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     install_requires=[
         "numpy==2.2.6",
         "tifffile==2025.5.10",
@@ -16,7 +16,13 @@ setup(
     extras_require={
         "plots": [
             "matplotlib",
-        ]
+        ],
+        "lazy": [
+            "zarr",
+        ],
+        "parquet": [
+            "pyarrow",
+        ],
     },
     entry_points={
         "console_scripts": [
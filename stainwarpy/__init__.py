@@ -1,11 +1,35 @@
-from .preprocess import colour_deconvolusion_preprocessing_HnE, load_and_scale_images, extract_channel
-from .reg import register_DAPI_HnE, register_feature_based, features_with_SIFT, transform_seg_mask
-from .metrics import compute_TRE, compute_mutual_information
-from. regPipeline import registration_pipeline
+import importlib
 
 __author__ = "Thusheera Kumarasekara"
 
 __version__ = "0.1.6"
 
+# public names and their modules, imported on first access so `import stainwarpy` (and the CLI) does not load skimage and scipy
+_LAZY_ATTRIBUTES = {
+    "colour_deconvolusion_preprocessing_HnE": "preprocess",
+    "load_and_scale_images": "preprocess",
+    "extract_channel": "preprocess",
+    "register_DAPI_HnE": "reg",
+    "register_feature_based": "reg",
+    "features_with_SIFT": "reg",
+    "transform_seg_mask": "reg",
+    "compute_TRE": "metrics",
+    "compute_mutual_information": "metrics",
+    "registration_pipeline": "regPipeline",
+}
+
 __all__ = ["colour_deconvolusion_preprocessing_HnE", "load_and_scale_images", "extract_channel", "register_DAPI_HnE", "register_feature_based", "features_with_SIFT", "transform_seg_mask", "compute_TRE", "compute_mutual_information",
-           "registration_pipeline"]
\ No newline at end of file
+           "registration_pipeline"]
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(f".{_LAZY_ATTRIBUTES[name]}", __name__), name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,166 @@
+import os
+import json
+import functools
+import numpy as np
+from skimage.transform import AffineTransform, ProjectiveTransform
+from .preprocess import scaled_shape
+
+
+TRANSFORM_FORMAT_VERSION = 1
+
+# feature transformations from the least to the most general, a composition is of the more general kind
+TRANSFORM_KINDS = ("euclidean", "similarity", "affine", "projective")
+
+
+def rescale_matrix(factor):
+    # px of a frame -> px of the same frame with factor times larger pixels, pixel centres aligned as in the resampling of the images
+    offset = 0.5 / factor - 0.5
+    return np.array([[1 / factor, 0, offset], [0, 1 / factor, offset], [0, 0, 1]])
+
+
+
+def level_shape(shape, level, downsample=2):
+    # (h, w) of a pyramid level, rounded up at every level as in write_pyramidal_ome_tiff
+    h, w = shape
+    for _ in range(level):
+        h, w = -(-h // downsample), -(-w // downsample)
+
+    return (h, w)
+
+
+
+class TransformArtifact:
+    # moving -> fixed transformation with the frames (shape, pixel size) it maps between, applied without reading either image
+
+    def __init__(self, matrix, kind, source_shape, target_shape, source_pixel_size=None, target_pixel_size=None, seed=None, metadata=None):
+        if kind not in TRANSFORM_KINDS:
+            raise ValueError(f"Invalid transformation type. Use one of {list(TRANSFORM_KINDS)}.")
+        matrix = np.asarray(matrix, dtype=float)
+        if matrix.shape != (3, 3):
+            raise ValueError("The transformation matrix must be 3x3.")
+
+        self.matrix = matrix
+        self.kind = kind
+        self.source_shape = tuple(int(n) for n in source_shape[:2])
+        self.target_shape = tuple(int(n) for n in target_shape[:2])
+        self.source_pixel_size = source_pixel_size
+        self.target_pixel_size = target_pixel_size
+        self.seed = seed
+        self.metadata = dict(metadata or {})
+
+    @property
+    def params(self):
+        # same attribute as the scikit-image transformations, e.g. for warp_tiled
+        return self.matrix
+
+    @functools.cached_property
+    def tform(self):
+        # AffineTransform also holds mirrored similarity transformations (e.g. after a pre-alignment)
+        if self.kind == "projective":
+            return ProjectiveTransform(matrix=self.matrix)
+        return AffineTransform(matrix=self.matrix)
+
+    def __call__(self, xy):
+        # (N, 2) xy points of the source frame -> target frame
+        return self.tform(np.asarray(xy, dtype=float))
+
+    @functools.cached_property
+    def inverse(self):
+        # fixed -> moving
+        return TransformArtifact(np.linalg.inv(self.matrix), self.kind, self.target_shape, self.source_shape, self.target_pixel_size, self.source_pixel_size,
+                                 seed=self.seed, metadata=dict(self.metadata, inverted=not self.metadata.get("inverted", False)))
+
+    def then(self, other):
+        # this transformation followed by other, collapsed into one matrix; the target frame of this one must be the source frame of other
+        if self.target_shape != other.source_shape or not same_pixel_size(self.target_pixel_size, other.source_pixel_size):
+            raise ValueError(f"Cannot compose transformations: target frame {self.target_shape} at {self.target_pixel_size} does not match "
+                             f"source frame {other.source_shape} at {other.source_pixel_size}.")
+
+        kind = TRANSFORM_KINDS[max(TRANSFORM_KINDS.index(self.kind), TRANSFORM_KINDS.index(other.kind))]
+        return TransformArtifact(other.matrix @ self.matrix, kind, self.source_shape, other.target_shape, self.source_pixel_size, other.target_pixel_size,
+                                 metadata={"composed_of": [self.to_dict(), other.to_dict()]})
+
+    def at_pixel_size(self, source_pixel_size=None, target_pixel_size=None):
+        # the same transformation between the frames resampled to other pixel sizes, e.g. a mask of the moving image at another resolution
+        matrix, source_shape, target_shape = self.matrix, self.source_shape, self.target_shape
+
+        if source_pixel_size is not None and not same_pixel_size(source_pixel_size, self.source_pixel_size):
+            factor = pixel_size_factor(source_pixel_size, self.source_pixel_size)
+            matrix = matrix @ np.linalg.inv(rescale_matrix(factor))
+            source_shape = scaled_shape(source_shape, factor)
+        else:
+            source_pixel_size = self.source_pixel_size
+
+        if target_pixel_size is not None and not same_pixel_size(target_pixel_size, self.target_pixel_size):
+            factor = pixel_size_factor(target_pixel_size, self.target_pixel_size)
+            matrix = rescale_matrix(factor) @ matrix
+            target_shape = scaled_shape(target_shape, factor)
+        else:
+            target_pixel_size = self.target_pixel_size
+
+        return TransformArtifact(matrix, self.kind, source_shape, target_shape, source_pixel_size, target_pixel_size, seed=self.seed, metadata=self.metadata)
+
+    def at_level(self, level, downsample=2):
+        # the same transformation between pyramid levels of both images
+        factor = downsample ** level
+        matrix = rescale_matrix(factor) @ self.matrix @ np.linalg.inv(rescale_matrix(factor))
+        scaled = lambda pixel_size: pixel_size * factor if pixel_size is not None else None
+
+        return TransformArtifact(matrix, self.kind, level_shape(self.source_shape, level, downsample), level_shape(self.target_shape, level, downsample),
+                                 scaled(self.source_pixel_size), scaled(self.target_pixel_size), seed=self.seed, metadata=dict(self.metadata, level=level))
+
+    def to_dict(self):
+        return {
+            "format_version": TRANSFORM_FORMAT_VERSION,
+            "type": self.kind,
+            "matrix": self.matrix.tolist(),
+            "source": {"shape": list(self.source_shape), "pixel_size": self.source_pixel_size},
+            "target": {"shape": list(self.target_shape), "pixel_size": self.target_pixel_size},
+            "seed": self.seed,
+            "metadata": self.metadata,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("format_version") != TRANSFORM_FORMAT_VERSION:
+            raise ValueError(f"Unsupported transform format version {data.get('format_version')}.")
+
+        return cls(data["matrix"], data["type"], data["source"]["shape"], data["target"]["shape"], data["source"]["pixel_size"], data["target"]["pixel_size"],
+                   seed=data.get("seed"), metadata=data.get("metadata"))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+
+def same_pixel_size(a, b):
+    # unknown pixel sizes match anything
+    return a is None or b is None or bool(np.isclose(a, b, rtol=1e-6))
+
+
+
+def pixel_size_factor(new, old):
+    if old is None:
+        raise ValueError("The pixel size of the transformation frame is unknown, it cannot be resampled.")
+    return new / old
+
+
+
+def load_transform(path):
+    # artifacts do not change once written, so repeated loads (e.g. for every derived product of a slide) are served from memory
+    stat = os.stat(path)
+    return cached_transform(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+
+@functools.lru_cache(maxsize=256)
+def cached_transform(path, mtime_ns, size):
+    with open(path) as f:
+        return TransformArtifact.from_dict(json.load(f))
+
+
+
+def compose_transforms(transforms):
+    # the first transformation is applied first
+    return functools.reduce(lambda a, b: a.then(b), transforms)
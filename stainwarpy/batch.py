@@ -0,0 +1,226 @@
+import os
+import csv
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from .regPipeline import registration_pipeline, save_registration_outputs, registered_image_path, PROFILE_NAME
+from .profiling import StageProfiler
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+LEDGER_NAME = "completed_pairs.jsonl"
+METRICS_TABLE_NAME = "batch_metrics.csv"
+METRICS_TABLE_FIELDS = ["pair_id", "fixed_path", "moving_path", "status",
+                        "rTRE before registration", "rTRE after feature based",
+                        "MI before registration", "MI after feature based",
+                        "seconds", "error"]
+
+
+def _optional_float(value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+
+def read_manifest(manifest_path):
+
+    # one entry per pair: fixed_path, moving_path and optionally pair_id, fixed_px_sz, moving_px_sz, fixed_img
+    if manifest_path.endswith(".json"):
+        with open(manifest_path) as f:
+            entries = json.load(f)
+    elif manifest_path.endswith(".csv"):
+        with open(manifest_path, newline="") as f:
+            entries = list(csv.DictReader(f))
+    else:
+        raise ValueError("Unsupported manifest format. Please provide a .csv or .json file.")
+
+    pairs = []
+    for i, entry in enumerate(entries):
+        if not entry.get("fixed_path") or not entry.get("moving_path"):
+            raise ValueError(f"Manifest entry {i} must provide fixed_path and moving_path.")
+
+        pairs.append({
+            "pair_id": str(entry.get("pair_id") or f"pair_{i:04d}"),
+            "fixed_path": entry["fixed_path"],
+            "moving_path": entry["moving_path"],
+            "fixed_px_sz": _optional_float(entry.get("fixed_px_sz")),
+            "moving_px_sz": _optional_float(entry.get("moving_px_sz")),
+            "fixed_img": entry.get("fixed_img") or None,
+        })
+
+    pair_ids = [pair["pair_id"] for pair in pairs]
+    if len(set(pair_ids)) != len(pair_ids):
+        raise ValueError("pair_id values in the manifest must be unique.")
+
+    return pairs
+
+
+
+def read_ledger(ledger_path):
+    completed = {}
+    if not os.path.exists(ledger_path):
+        return completed
+
+    with open(ledger_path) as f:
+        for line in f:
+            line = line.strip()
+            # a crash can leave a partially written last line behind
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            completed[record["pair_id"]] = record
+
+    return completed
+
+
+
+def append_ledger(ledger_path, record):
+    with open(ledger_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+
+def limit_worker_memory(max_memory_mb):
+    # cap the address space of each worker so a single large pair fails with MemoryError instead of taking the node down
+    if max_memory_mb is not None:
+        if resource is None:
+            raise ValueError("Per-worker memory limits are not supported on this platform.")
+        limit = int(max_memory_mb * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+
+def register_pair(pair, output_folder, fixed_img, pipeline_options, profile=False):
+
+    pair_folder = os.path.join(output_folder, pair["pair_id"])
+    record = {"pair_id": pair["pair_id"], "fixed_path": pair["fixed_path"], "moving_path": pair["moving_path"]}
+    start = time.perf_counter()
+
+    # tiled and OME-TIFF outputs are streamed to disk by the pipeline
+    final_img_path = registered_image_path(pair_folder, pipeline_options.get("ome_tiff", False))
+    streamed = pipeline_options.get("tile_size") is not None or pipeline_options.get("ome_tiff", False)
+    profiler = StageProfiler() if profile else None
+
+    try:
+        os.makedirs(pair_folder, exist_ok=True)
+        transformation_map, final_img, tre, mi = registration_pipeline(
+            pair["fixed_path"],
+            pair["moving_path"],
+            pair["fixed_px_sz"],
+            pair["moving_px_sz"],
+            pair["fixed_img"] or fixed_img,
+            output_path=final_img_path if streamed else None,
+            profiler=profiler,
+            **pipeline_options
+        )
+        save_registration_outputs(pair_folder, transformation_map, final_img, tre, mi, final_img_path)
+        if profiler is not None:
+            profiler.save(os.path.join(pair_folder, PROFILE_NAME))
+        record.update(status="completed", TRE=tre, MI=mi)
+    except Exception as e:
+        record.update(status="failed", error=f"{type(e).__name__}: {e}")
+
+    record["seconds"] = time.perf_counter() - start
+
+    return record
+
+
+
+def failed_record(pair, error):
+    return {"pair_id": pair["pair_id"], "fixed_path": pair["fixed_path"], "moving_path": pair["moving_path"], "status": "failed", "error": error, "seconds": None}
+
+
+
+def run_pairs(pairs, output_folder, fixed_img, pipeline_options, profile, workers, max_memory_mb, on_record):
+
+    # registers the pairs in a fresh pool of worker processes, returns the pairs lost with the pool if a worker died
+    broken = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_worker_memory, initargs=(max_memory_mb,)) as pool:
+        futures = {pool.submit(register_pair, pair, output_folder, fixed_img, pipeline_options, profile): pair for pair in pairs}
+
+        for future in as_completed(futures):
+            pair = futures[future]
+            try:
+                record = future.result()
+            except BrokenProcessPool:
+                broken.append(pair)
+                continue
+            except Exception as e:
+                record = failed_record(pair, f"{type(e).__name__}: {e}")
+            on_record(record)
+
+    return broken
+
+
+
+def metrics_row(record):
+    tre = record.get("TRE") or {}
+    mi = record.get("MI") or {}
+
+    return {
+        "pair_id": record["pair_id"],
+        "fixed_path": record["fixed_path"],
+        "moving_path": record["moving_path"],
+        "status": record["status"],
+        "rTRE before registration": tre.get("before registration"),
+        "rTRE after feature based": tre.get("after feature based"),
+        "MI before registration": mi.get("before registration"),
+        "MI after feature based": mi.get("after feature based"),
+        "seconds": record.get("seconds"),
+        "error": record.get("error"),
+    }
+
+
+
+def register_batch(manifest_path, output_folder, fixed_img, workers=1, max_memory_mb=None, profile=False, **pipeline_options):
+
+    pairs = read_manifest(manifest_path)
+    os.makedirs(output_folder, exist_ok=True)
+
+    # pairs recorded in the ledger by an earlier (possibly crashed) run are not registered again
+    ledger_path = os.path.join(output_folder, LEDGER_NAME)
+    records = read_ledger(ledger_path)
+    pending = [pair for pair in pairs if pair["pair_id"] not in records]
+    print(f"{len(pairs) - len(pending)} of {len(pairs)} pairs already completed, registering {len(pending)}.")
+
+    def on_record(record):
+        records[record["pair_id"]] = record
+
+        if record["status"] == "completed":
+            append_ledger(ledger_path, record)
+            print(f"Pair {record['pair_id']} registered in {record['seconds']:.1f} s.")
+        else:
+            print(f"Pair {record['pair_id']} failed: {record['error']}")
+
+    try:
+        broken = run_pairs(pending, output_folder, fixed_img, pipeline_options, profile, workers, max_memory_mb, on_record)
+
+        # a worker that crashes or is killed (e.g. beyond --max-memory-mb) takes the pool and every pair still in it down:
+        # those pairs run again in a fresh pool, then one at a time, so only a pair that crashes on its own is recorded as failed
+        if broken:
+            print(f"A worker process died, retrying {len(broken)} pairs.")
+            broken = run_pairs(broken, output_folder, fixed_img, pipeline_options, profile, workers, max_memory_mb, on_record)
+        for pair in broken:
+            if run_pairs([pair], output_folder, fixed_img, pipeline_options, profile, 1, max_memory_mb, on_record):
+                on_record(failed_record(pair, "BrokenProcessPool: the worker process terminated abruptly, e.g. killed for exceeding the memory limit"))
+    finally:
+        # aggregated metrics table in manifest order, also written when the batch is interrupted
+        rows = [metrics_row(records[pair["pair_id"]]) for pair in pairs if pair["pair_id"] in records]
+        table_path = os.path.join(output_folder, METRICS_TABLE_NAME)
+
+        with open(table_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=METRICS_TABLE_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Batch metrics saved to {table_path}")
+
+    return rows
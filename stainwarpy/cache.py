@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from .reg import SIFTFeatures
+
+
+CACHE_FORMAT_VERSION = 1
+
+
+def file_digest(file_path, chunk_size=1 << 24):
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+
+class FeatureCache:
+    # on-disk SIFT keypoint/descriptor cache with size based LRU eviction
+
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self._digests = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def digest(self, file_path):
+        # hash the file content once per (path, size, mtime) in this process
+        stat = os.stat(file_path)
+        file_id = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        if file_id not in self._digests:
+            self._digests[file_id] = file_digest(file_path)
+
+        return self._digests[file_id]
+
+    def key(self, file_path, **params):
+        params = dict(params, content=self.digest(file_path), version=CACHE_FORMAT_VERSION)
+
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                features = SIFTFeatures(data["keypoints"], data["descriptors"], int(data["scale_factor"]))
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+
+        # mark as recently used
+        os.utime(path)
+
+        return features
+
+    def put(self, key, features):
+        # write to a temporary file first so concurrent workers never read partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, keypoints=features.keypoints, descriptors=features.descriptors, scale_factor=features.scale_factor)
+        os.replace(tmp_path, self.path(key))
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        # drop least recently used entries until the cache fits
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
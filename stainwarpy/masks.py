@@ -0,0 +1,198 @@
+import json
+import numpy as np
+from scipy import ndimage
+from skimage import measure
+from .tiling import transform_matrix, tile_grid, inverse_coords, source_window, warp_tile
+
+MASK_MODES = ("dense", "tiled", "objects")
+
+
+def nearest_index(coords):
+    # same rounding as map_coordinates with order=0
+    return np.floor(coords + 0.5).astype(np.int64)
+
+
+
+def occupancy_grid(mask, block_size=64, chunk_rows=1024):
+    # coarse map of the blocks of the mask that contain any object
+    h, w = mask.shape
+    grid = np.zeros(((h + block_size - 1) // block_size, (w + block_size - 1) // block_size), dtype=bool)
+    chunk_rows = max(chunk_rows // block_size, 1) * block_size
+
+    for r0 in range(0, h, chunk_rows):
+        chunk = np.asarray(mask[r0:r0 + chunk_rows]) != 0
+        rows = np.flatnonzero(chunk.any(axis=1))
+        cols = np.flatnonzero(chunk.any(axis=0))
+        if len(rows) == 0:
+            continue
+        ys, xs = np.nonzero(chunk[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1])
+        grid[(ys + rows[0] + r0) // block_size, (xs + cols[0]) // block_size] = True
+
+    return grid
+
+
+
+def warp_labels_tiled(mask, tform, output_shape, tile_size=1024, block_size=64):
+
+    inv_matrix = np.linalg.inv(transform_matrix(tform))
+    occupied = occupancy_grid(mask, block_size)
+    out = np.zeros(output_shape[:2], dtype=mask.dtype)
+
+    for y0, y1, x0, x1 in tile_grid(output_shape, tile_size):
+        src_y, src_x = inverse_coords(inv_matrix, y0, y1, x0, x1)
+        window = source_window(src_y, src_x, mask.shape, margin=1)
+
+        # tiles that map onto background only are left empty without touching the mask
+        if window is None:
+            continue
+        wy0, wy1, wx0, wx1 = window
+        if not occupied[wy0 // block_size:(wy1 - 1) // block_size + 1, wx0 // block_size:(wx1 - 1) // block_size + 1].any():
+            continue
+
+        out[y0:y1, x0:x1] = warp_tile(mask, inv_matrix, y0, y1, x0, x1, order=0)
+
+    return out
+
+
+
+def output_boxes(slices, matrix, output_shape):
+    # bounding boxes of the objects in the output, from the transformed corners of their source boxes
+    y0 = np.array([s[0].start for s in slices], dtype=float)
+    y1 = np.array([s[0].stop for s in slices], dtype=float)
+    x0 = np.array([s[1].start for s in slices], dtype=float)
+    x1 = np.array([s[1].stop for s in slices], dtype=float)
+
+    corners = np.stack([np.stack([x, y, np.ones_like(x)], axis=1)
+                        for x, y in ((x0 - 0.5, y0 - 0.5), (x1 - 0.5, y0 - 0.5), (x0 - 0.5, y1 - 0.5), (x1 - 0.5, y1 - 0.5))])
+    mapped = corners @ matrix.T
+    mapped = mapped[..., :2] / mapped[..., 2:]
+
+    h, w = output_shape[:2]
+    oy0 = np.clip(np.floor(mapped[..., 1].min(axis=0)), 0, h).astype(np.int64)
+    oy1 = np.clip(np.ceil(mapped[..., 1].max(axis=0)) + 1, 0, h).astype(np.int64)
+    ox0 = np.clip(np.floor(mapped[..., 0].min(axis=0)), 0, w).astype(np.int64)
+    ox1 = np.clip(np.ceil(mapped[..., 0].max(axis=0)) + 1, 0, w).astype(np.int64)
+
+    return oy0, oy1, ox0, ox1
+
+
+
+def warp_labels_objects(mask, tform, output_shape, batch_pixels=1 << 22):
+
+    matrix = transform_matrix(tform)
+    inv_matrix = np.linalg.inv(matrix)
+    out = np.zeros(output_shape[:2], dtype=mask.dtype)
+
+    # only the bounding box of every object is mapped, so the work scales with the object area
+    slices = ndimage.find_objects(np.asarray(mask))
+    labels = np.array([i + 1 for i, s in enumerate(slices) if s is not None], dtype=np.int64)
+    slices = [s for s in slices if s is not None]
+    if len(slices) == 0:
+        return out
+
+    oy0, oy1, ox0, ox1 = output_boxes(slices, matrix, output_shape)
+    heights, widths = oy1 - oy0, ox1 - ox0
+    areas = heights * widths
+
+    # objects are processed in batches of about batch_pixels output pixels
+    batch_ids = (np.cumsum(areas) - areas) // batch_pixels
+    splits = np.concatenate([[0], np.flatnonzero(np.diff(batch_ids)) + 1, [len(areas)]])
+
+    for start, stop in zip(splits[:-1], splits[1:]):
+        batch = slice(start, stop)
+        counts = areas[batch]
+        if counts.sum() == 0:
+            continue
+        obj = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        y = oy0[batch][obj] + local // widths[batch][obj]
+        x = ox0[batch][obj] + local % widths[batch][obj]
+
+        src_x = inv_matrix[0, 0] * x + inv_matrix[0, 1] * y + inv_matrix[0, 2]
+        src_y = inv_matrix[1, 0] * x + inv_matrix[1, 1] * y + inv_matrix[1, 2]
+        if not np.allclose(inv_matrix[2], [0, 0, 1]):
+            src_w = inv_matrix[2, 0] * x + inv_matrix[2, 1] * y + inv_matrix[2, 2]
+            src_x, src_y = src_x / src_w, src_y / src_w
+        sy, sx = nearest_index(src_y), nearest_index(src_x)
+
+        inside = (sy >= 0) & (sy < mask.shape[0]) & (sx >= 0) & (sx < mask.shape[1])
+        y, x, sy, sx, obj = y[inside], x[inside], sy[inside], sx[inside], obj[inside]
+        label = labels[batch][obj]
+
+        # an output pixel belongs to the object whose label its nearest source pixel carries
+        keep = mask[sy, sx] == label
+        out[y[keep], x[keep]] = label[keep]
+
+    return out
+
+
+
+def label_centroids(mask, chunk_rows=1024):
+    # (labels, centroids as (x, y)) of all objects, accumulated with bincount over row chunks
+    h, w = mask.shape
+    n = int(np.max(mask)) + 1 if mask.size else 1
+    count = np.zeros(n)
+    sum_x = np.zeros(n)
+    sum_y = np.zeros(n)
+    xs = np.arange(w, dtype=float)
+
+    for r0 in range(0, h, chunk_rows):
+        chunk = np.asarray(mask[r0:r0 + chunk_rows]).astype(np.int64)
+        rows = np.arange(r0, r0 + chunk.shape[0], dtype=float)
+        count += np.bincount(chunk.ravel(), minlength=n)
+        sum_x += np.bincount(chunk.ravel(), weights=np.broadcast_to(xs, chunk.shape).ravel(), minlength=n)
+        sum_y += np.bincount(chunk.ravel(), weights=np.broadcast_to(rows[:, None], chunk.shape).ravel(), minlength=n)
+
+    labels = np.flatnonzero(count)
+    labels = labels[labels != 0]
+
+    return labels, np.column_stack([sum_x[labels] / count[labels], sum_y[labels] / count[labels]])
+
+
+
+def label_contours(mask):
+    # outer contour of every object as (x, y) points
+    contours = {}
+    for i, s in enumerate(ndimage.find_objects(np.asarray(mask))):
+        if s is None:
+            continue
+        label = i + 1
+        obj = np.pad(np.asarray(mask[s]) == label, 1)
+        found = measure.find_contours(obj.astype(np.uint8), 0.5)
+        if not found:
+            continue
+        contour = max(found, key=len)
+        contours[label] = contour[:, ::-1] + [s[1].start - 1, s[0].start - 1]
+
+    return contours
+
+
+
+def transform_centroids(mask, tform):
+    labels, centroids = label_centroids(mask)
+    return labels, tform(centroids)
+
+
+
+def transform_contours(mask, tform):
+    return {label: tform(contour) for label, contour in label_contours(mask).items()}
+
+
+
+def save_centroids_csv(file_path, labels, centroids):
+    np.savetxt(file_path, np.column_stack([labels, centroids]), delimiter=",", header="label,x,y", comments="", fmt=["%d", "%.3f", "%.3f"])
+
+
+
+def save_contours_geojson(file_path, contours):
+    features = []
+    for label, contour in contours.items():
+        ring = np.round(contour, 3).tolist()
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [ring + ring[:1]]},
+            "properties": {"label": int(label)},
+        })
+
+    with open(file_path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
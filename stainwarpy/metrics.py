@@ -5,7 +5,8 @@ def compute_TRE(tform, tre_points, fixed):
 
     src_points, dst_points = tre_points
     tre = {}
-    h, w = fixed.shape   
+    # the fixed image, or only its (h, w)
+    h, w = fixed.shape[:2] if hasattr(fixed, "shape") else fixed[:2]
     diagonal = np.sqrt(h**2 + w**2)
 
     if len(src_points) != len(dst_points):
@@ -29,20 +30,72 @@ def compute_TRE(tform, tre_points, fixed):
 
 
 
-def mutual_information_metric(fixed, moving, bins):
-    fy, fx = fixed.shape
-    my, mx = moving.shape
+def overlap(fixed, moving):
+    # compare the overlapping region only
+    min_y = min(fixed.shape[0], moving.shape[0])
+    min_x = min(fixed.shape[1], moving.shape[1])
 
-    if fy != my or fx != mx:
-        min_y = min(fy, my)
-        min_x = min(fx, mx)
+    return fixed[:min_y, :min_x], moving[:min_y, :min_x]
 
-        fixed = fixed[:min_y, :min_x]
-        moving = moving[:min_y, :min_x]
 
-    # Compute joint histogram
-    hist_2d, _, _ = np.histogram2d(fixed.ravel(), moving.ravel(), bins=bins)
-    
+
+def bin_image(img, bins, value_range=None, chunk_rows=1024):
+
+    # integer bin index of every pixel, with the bin edges of np.histogram2d over the image range
+    lo, hi = value_range if value_range is not None else (float(img.min()), float(img.max()))
+    if hi <= lo:
+        lo, hi = lo - 0.5, hi + 0.5
+    edges = np.linspace(lo, hi, bins + 1)
+
+    idx = np.empty(img.shape, dtype=np.uint8 if bins <= 256 else np.uint16)
+
+    norm = bins / (edges[-1] - edges[0])
+
+    for r0 in range(0, img.shape[0], chunk_rows):
+        chunk = img[r0:r0 + chunk_rows]
+        # equal width bins, then the rounding corrected against the edges as np.searchsorted would place them;
+        # values on the last edge fall into the last bin
+        bin_idx = np.clip(((chunk - edges[0]) * norm).astype(np.intp), 0, bins - 1)
+        bin_idx -= chunk < edges[bin_idx]
+        bin_idx += (chunk >= edges[bin_idx + 1]) & (bin_idx < bins - 1)
+        idx[r0:r0 + chunk_rows] = np.clip(bin_idx, 0, bins - 1)
+
+    return idx
+
+
+
+def joint_histogram(fixed_idx, moving_idx, bins, mask=None, sample_size=None, rng=None, chunk_rows=1024):
+
+    fixed_idx, moving_idx = overlap(fixed_idx, moving_idx)
+    min_y, min_x = fixed_idx.shape
+    if mask is not None:
+        mask = mask[:min_y, :min_x]
+
+    if sample_size is not None:
+        # random pixel subsample instead of every pixel
+        rng = np.random.default_rng(rng)
+        flat = rng.integers(0, min_y * min_x, size=sample_size)
+        rows, cols = np.unravel_index(flat, (min_y, min_x))
+        if mask is not None:
+            keep = mask[rows, cols]
+            rows, cols = rows[keep], cols[keep]
+        pairs = fixed_idx[rows, cols].astype(np.intp) * bins + moving_idx[rows, cols]
+        return np.bincount(pairs, minlength=bins * bins).reshape(bins, bins)
+
+    # accumulate the joint histogram over chunks of rows
+    hist = np.zeros(bins * bins, dtype=np.int64)
+    for r0 in range(0, min_y, chunk_rows):
+        pairs = fixed_idx[r0:r0 + chunk_rows].astype(np.intp) * bins + moving_idx[r0:r0 + chunk_rows]
+        if mask is not None:
+            pairs = pairs[mask[r0:r0 + chunk_rows]]
+        hist += np.bincount(pairs.ravel(), minlength=bins * bins)
+
+    return hist.reshape(bins, bins)
+
+
+
+def normalized_mutual_information(hist_2d):
+
     # Normalize to get joint probabilities
     pxy = hist_2d / np.sum(hist_2d)
     
@@ -63,15 +116,52 @@ def mutual_information_metric(fixed, moving, bins):
 
 
 
-def compute_mutual_information(fixed, moving, tform_img, bins = 50):
+def bootstrap_mutual_information(hist_2d, n_bootstrap=200, confidence=0.95, rng=None):
+
+    # resample the sampled pixel counts, which only touches the bins x bins histogram
+    rng = np.random.default_rng(rng)
+    counts = hist_2d.ravel()
+    resampled = rng.multinomial(counts.sum(), counts / counts.sum(), size=n_bootstrap)
+    scores = [normalized_mutual_information(r.reshape(hist_2d.shape)) for r in resampled]
+
+    # the plug-in estimate of a pixel sample is biased upwards: the bootstrap bias corrected estimate is reported
+    # with the basic bootstrap interval, which is corrected the same way, so the estimate lies within its interval
+    plug_in = normalized_mutual_information(hist_2d)
+    alpha = (1 - confidence) / 2
+    estimate = float(2 * plug_in - np.mean(scores))
+    return estimate, [float(2 * plug_in - np.quantile(scores, 1 - alpha)), float(2 * plug_in - np.quantile(scores, alpha))]
+
+
+
+def mutual_information_metric(fixed, moving, bins, mask=None, sample_size=None, rng=None):
+
+    # the bin ranges are taken from the overlap, as in np.histogram2d of the cropped images
+    fixed, moving = overlap(fixed, moving)
+    hist_2d = joint_histogram(bin_image(fixed, bins), bin_image(moving, bins), bins, mask=mask, sample_size=sample_size, rng=rng)
+
+    return normalized_mutual_information(hist_2d)
+
+
+
+def compute_mutual_information(fixed, moving, tform_img, bins = 50, mask=None, sample_size=None, seed=None):
     mi_scores = {}
-    
-    mi_before = mutual_information_metric(fixed, moving, bins)
-    mi_scores['before registration'] = mi_before
-    print("normalized MI before registration: ", mi_before)
+    rng = np.random.default_rng(seed)
+
+    # the fixed image is binned once per overlap shape (the registered image has the fixed shape, the moving image may not)
+    fixed_bins = {}
 
-    mi_after_init = mutual_information_metric(fixed, tform_img, bins)
-    mi_scores['after feature based'] = mi_after_init
-    print("normalized MI after feature based registration: ", mi_after_init)
+    for name, img, label in [('before registration', moving, "before registration"),
+                             ('after feature based', tform_img, "after feature based registration")]:
+        fixed_crop, img = overlap(fixed, img)
+        if fixed_crop.shape not in fixed_bins:
+            fixed_bins[fixed_crop.shape] = bin_image(fixed_crop, bins)
+        hist_2d = joint_histogram(fixed_bins[fixed_crop.shape], bin_image(img, bins), bins, mask=mask, sample_size=sample_size, rng=rng)
+        if sample_size is None:
+            mi_scores[name] = normalized_mutual_information(hist_2d)
+            print(f"normalized MI {label}: ", mi_scores[name])
+        else:
+            mi_scores[name], mi_scores[f'{name} 95% CI'] = bootstrap_mutual_information(hist_2d, rng=rng)
+            print(f"normalized MI {label}: ", mi_scores[name])
+            print(f"95% confidence interval of normalized MI {label}: ", mi_scores[f'{name} 95% CI'])
 
-    return mi_scores
\ No newline at end of file
+    return mi_scores
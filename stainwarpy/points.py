@@ -0,0 +1,371 @@
+import csv
+import json
+import numpy as np
+from skimage.transform import ProjectiveTransform
+from .preprocess import get_pixel_size_ome_tiff
+from .artifact import load_transform
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+POINT_UNITS = ("px", "um")
+
+
+def load_transformation_map(tform_map_path):
+    # feature_based_transformation_map.npy holds the 3x3 moving -> fixed matrix of any of the feature transformations
+    return ProjectiveTransform(matrix=np.load(tform_map_path))
+
+
+
+def point_mapper(tform, moving_px_sz=None, fixed_px_sz=None, units="px", frame_px_sz=None):
+
+    if units not in POINT_UNITS:
+        raise ValueError(f"Invalid units. Use one of {list(POINT_UNITS)}.")
+    if units == "um" and (moving_px_sz is None or fixed_px_sz is None):
+        raise ValueError("moving_px_sz and fixed_px_sz must be provided for points in um.")
+
+    # the transformation maps into the fixed image resampled to the moving pixel size (unless frame_px_sz says otherwise),
+    # so without both pixel sizes the points stay in that (registration) frame
+    frame_px_sz = moving_px_sz if frame_px_sz is None else frame_px_sz
+    scale = frame_px_sz / fixed_px_sz if frame_px_sz is not None and fixed_px_sz is not None else 1.0
+
+    def map_points(xy):
+        xy = np.asarray(xy, dtype=float)
+        if units == "um":
+            xy = xy / moving_px_sz
+
+        mapped = tform(xy)
+        # pixel centres, as in the resampling of the fixed image
+        mapped = (mapped + 0.5) * scale - 0.5
+
+        return mapped * fixed_px_sz if units == "um" else mapped
+
+    return map_points
+
+
+
+def transform_points_csv(input_path, output_path, map_points, x_col="x", y_col="y", batch_size=100000):
+
+    with open(input_path, newline="") as f_in, open(output_path, "w", newline="") as f_out:
+        dialect = csv.excel_tab if input_path.endswith(".tsv") else csv.excel
+        reader = csv.reader(f_in, dialect)
+        writer = csv.writer(f_out, dialect)
+
+        header = next(reader)
+        if x_col not in header or y_col not in header:
+            raise ValueError(f"Columns '{x_col}' and '{y_col}' not found in {input_path}.")
+        x_idx, y_idx = header.index(x_col), header.index(y_col)
+        writer.writerow(header)
+
+        # rows are streamed in batches so memory does not grow with the table
+        n_points = 0
+        batch = []
+        for row in reader:
+            batch.append(row)
+            if len(batch) == batch_size:
+                n_points += write_csv_batch(writer, batch, map_points, x_idx, y_idx)
+                batch = []
+        if batch:
+            n_points += write_csv_batch(writer, batch, map_points, x_idx, y_idx)
+
+    return n_points
+
+
+
+def write_csv_batch(writer, rows, map_points, x_idx, y_idx):
+    xy = np.array([(row[x_idx], row[y_idx]) for row in rows], dtype=float)
+    mapped = map_points(xy)
+
+    for row, (x, y) in zip(rows, mapped.tolist()):
+        row[x_idx] = repr(x)
+        row[y_idx] = repr(y)
+    writer.writerows(rows)
+
+    return len(rows)
+
+
+
+def transform_points_parquet(input_path, output_path, map_points, x_col="x", y_col="y", batch_size=100000):
+
+    if pyarrow is None:
+        raise ValueError("Parquet support requires pyarrow. Install it with `pip install stainwarpy[parquet]`.")
+
+    parquet_file = pq.ParquetFile(input_path)
+    schema = parquet_file.schema_arrow
+    if x_col not in schema.names or y_col not in schema.names:
+        raise ValueError(f"Columns '{x_col}' and '{y_col}' not found in {input_path}.")
+
+    # transformed coordinates are always float64
+    x_idx, y_idx = schema.get_field_index(x_col), schema.get_field_index(y_col)
+    schema = schema.set(x_idx, pyarrow.field(x_col, pyarrow.float64())).set(y_idx, pyarrow.field(y_col, pyarrow.float64()))
+
+    n_points = 0
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            xy = np.column_stack([batch.column(x_idx).to_numpy(zero_copy_only=False),
+                                  batch.column(y_idx).to_numpy(zero_copy_only=False)]).astype(float)
+            mapped = map_points(xy)
+
+            columns = list(batch.columns)
+            columns[x_idx] = pyarrow.array(mapped[:, 0])
+            columns[y_idx] = pyarrow.array(mapped[:, 1])
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema=schema))
+            n_points += len(xy)
+
+    return n_points
+
+
+
+def geometry_coordinates(coordinates, out):
+    # flatten the nested coordinate lists of any GeoJSON geometry into out
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        out.append(coordinates[:2])
+    else:
+        for item in coordinates:
+            geometry_coordinates(item, out)
+
+
+
+def replace_coordinates(coordinates, mapped, i=0):
+    # write the transformed points back in the order they were flattened, returns the next index
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        coordinates[:2] = mapped[i]
+        return i + 1
+
+    for item in coordinates:
+        i = replace_coordinates(item, mapped, i)
+    return i
+
+
+
+def feature_geometries(item):
+    # geometries of a FeatureCollection, Feature, GeometryCollection or plain geometry
+    if item is None:
+        return []
+    kind = item.get("type")
+    if kind == "FeatureCollection":
+        return [g for feature in item["features"] for g in feature_geometries(feature)]
+    if kind == "Feature":
+        return feature_geometries(item.get("geometry"))
+    if kind == "GeometryCollection":
+        return [g for geometry in item["geometries"] for g in feature_geometries(geometry)]
+    return [item]
+
+
+
+class JsonStream:
+    # values of a JSON file read one at a time with raw_decode, growing the buffer only while a value is incomplete
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        chunk = self.f.read(size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        # next character that is not whitespace
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError("Invalid GeoJSON: unexpected end of file.")
+            self.fill(self.chunk_size)
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"Invalid GeoJSON: expected one of {chars!r}, found {char!r}.")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            # a value ending with the buffer (e.g. a number) may continue in the next chunk
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ValueError(f"Invalid GeoJSON: {e}")
+            # doubling the read keeps large values linear
+            self.fill(max(self.chunk_size, len(self.buffer) - self.pos))
+
+    def members(self):
+        # keys of the object just opened, the caller reads the value of each before the next
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("Invalid GeoJSON: object keys must be strings.")
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def items(self):
+        # values of the array just opened
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+
+def map_geometries(geometries, points, map_points):
+    # the points flattened from the geometries are transformed together in one vectorised call and written back
+    if not points:
+        return 0
+    mapped = map_points(np.array(points, dtype=float)).tolist()
+    i = 0
+    for geometry in geometries:
+        i = replace_coordinates(geometry["coordinates"], mapped, i)
+
+    return len(points)
+
+
+
+def transform_geometries(geometries, map_points, batch_size=100000):
+
+    n_points = 0
+    start = 0
+    while start < len(geometries):
+        batch, points = [], []
+        while start < len(geometries) and len(points) < batch_size:
+            geometry_coordinates(geometries[start]["coordinates"], points)
+            batch.append(geometries[start])
+            start += 1
+        n_points += map_geometries(batch, points, map_points)
+
+    return n_points
+
+
+
+def write_features(out, features, n_written):
+    # features of a streamed array, separated from the n_written before them
+    for feature in features:
+        out.write((", " if n_written > 0 else "") + json.dumps(feature))
+        n_written += 1
+
+    return n_written
+
+
+
+def transform_geojson(input_path, output_path, map_points, batch_size=100000):
+
+    # the features of a FeatureCollection are streamed in batches of about batch_size points, so memory does not grow
+    # with the number of annotations; other members (e.g. the geometry of a single Feature) are read whole
+    n_points = 0
+    with open(input_path) as f, open(output_path, "w") as out:
+        stream = JsonStream(f)
+        stream.expect("{")
+        out.write("{")
+        first = True
+        for key in stream.members():
+            # bounding boxes are no longer valid after the transformation
+            if key == "bbox":
+                stream.value()
+                continue
+            out.write(("" if first else ", ") + json.dumps(key) + ": ")
+            first = False
+
+            if key == "features" and stream.peek() == "[":
+                stream.expect("[")
+                out.write("[")
+                n_features = 0
+                features, geometries, points = [], [], []
+                for feature in stream.items():
+                    feature.pop("bbox", None)
+                    features.append(feature)
+                    for geometry in feature_geometries(feature):
+                        geometry_coordinates(geometry["coordinates"], points)
+                        geometries.append(geometry)
+
+                    # a batch is written once it holds enough points, and at the end
+                    if len(points) >= batch_size:
+                        n_points += map_geometries(geometries, points, map_points)
+                        n_features = write_features(out, features, n_features)
+                        features, geometries, points = [], [], []
+
+                n_points += map_geometries(geometries, points, map_points)
+                write_features(out, features, n_features)
+                out.write("]")
+                continue
+
+            value = stream.value()
+            if key == "geometry":
+                n_points += transform_geometries(feature_geometries(value), map_points, batch_size)
+            elif key == "geometries":
+                n_points += transform_geometries([g for geometry in value for g in feature_geometries(geometry)], map_points, batch_size)
+            elif key == "coordinates":
+                n_points += transform_geometries([{"coordinates": value}], map_points, batch_size)
+            out.write(json.dumps(value))
+        out.write("}")
+
+    return n_points
+
+
+
+def transform_points_file(input_path, output_path, map_points, x_col="x", y_col="y", batch_size=100000):
+
+    if input_path.endswith((".csv", ".tsv")):
+        return transform_points_csv(input_path, output_path, map_points, x_col, y_col, batch_size)
+    if input_path.endswith((".parquet", ".pq")):
+        return transform_points_parquet(input_path, output_path, map_points, x_col, y_col, batch_size)
+    if input_path.endswith((".geojson", ".json")):
+        return transform_geojson(input_path, output_path, map_points, batch_size)
+
+    raise ValueError("Unsupported point file format. Please provide a .csv, .tsv, .parquet or .geojson file.")
+
+
+
+def transform_points_path(input_path, output_path, tform_map_path, moving_px_sz=None, fixed_px_sz=None, fixed_path=None, units="px", x_col="x", y_col="y", batch_size=100000):
+
+    if fixed_px_sz is None and fixed_path is not None:
+        fixed_px_sz, _ = get_pixel_size_ome_tiff(fixed_path)
+        if fixed_px_sz is None:
+            raise ValueError("Pixel size information not found in metadata for fixed image. Please provide fixed_px_sz.")
+
+    if tform_map_path.endswith(".json"):
+        # the artifact knows both pixel sizes; points of the moving image at another pixel size are rescaled to it
+        transform = load_transform(tform_map_path)
+        moving_px_sz = transform.source_pixel_size if moving_px_sz is None else moving_px_sz
+        transform = transform.at_pixel_size(source_pixel_size=moving_px_sz)
+        # the target of a registration is the fixed image resampled to the moving pixel size: points go to the fixed image itself
+        if fixed_px_sz is None and not transform.metadata.get("inverted", False):
+            fixed_px_sz = transform.metadata.get("fixed_pixel_size")
+        if fixed_px_sz is None:
+            print(f"Fixed pixel size not known, points are saved in the target frame of the transformation (pixel size {transform.target_pixel_size}).")
+            fixed_px_sz = transform.target_pixel_size
+        map_points = point_mapper(transform.tform, moving_px_sz, fixed_px_sz, units, frame_px_sz=transform.target_pixel_size)
+    else:
+        if moving_px_sz is None or fixed_px_sz is None:
+            print("Pixel sizes not provided, points are saved in the fixed image resampled to the moving pixel size.")
+
+        map_points = point_mapper(load_transformation_map(tform_map_path), moving_px_sz, fixed_px_sz, units)
+
+    n_points = transform_points_file(input_path, output_path, map_points, x_col=x_col, y_col=y_col, batch_size=batch_size)
+    print(f"{n_points} transformed points saved to {output_path}")
+
+    return n_points
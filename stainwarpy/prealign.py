@@ -0,0 +1,112 @@
+import collections
+import numpy as np
+from scipy import ndimage
+from scipy.fft import next_fast_len
+from .tissue import block_mean
+from .tiling import warp_tiled
+
+
+PREALIGN_MODES = ("off", "on", "auto")
+
+# best orientation of the moving thumbnail: 3x3 moving -> fixed matrix (xy, registration px), rotation in degrees, mirrored or not, phase correlation peak
+Prealignment = collections.namedtuple('Prealignment', ['matrix', 'angle', 'flip', 'score'])
+
+
+def thumbnail(image, downsample, sigma=1):
+    # smoothed block mean with the background (its median) at zero, so the zero padding of the canvas matches it
+    thumb = ndimage.gaussian_filter(block_mean(image, downsample), sigma)
+
+    return thumb - np.median(thumb)
+
+
+
+def orientation_matrix(angle, flip, moving_center, fixed_center):
+    # xy matrix mirroring (x -> -x) and rotating the moving thumbnail about its centre onto the fixed thumbnail centre
+    theta = np.deg2rad(angle)
+    rotation = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    linear = rotation @ np.diag([-1.0, 1.0]) if flip else rotation
+
+    matrix = np.eye(3)
+    matrix[:2, :2] = linear
+    matrix[:2, 2] = np.asarray(fixed_center) - linear @ np.asarray(moving_center)
+
+    return matrix
+
+
+
+def phase_correlation_peak(fixed_spectrum, moving_canvas):
+    # peak of the phase correlation and the shift s with fixed(u) ~ moving(u - s), in (row, col);
+    # only half whitened (square root of the magnitude): full whitening weighs fine texture as much as the tissue shape,
+    # and texture stops correlating a few degrees off the true rotation, i.e. between the coarse search angles
+    cross_power = fixed_spectrum * np.conj(np.fft.rfft2(moving_canvas))
+    correlation = np.fft.irfft2(cross_power / (np.sqrt(np.abs(cross_power)) + 1e-12), s=moving_canvas.shape)
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = np.array([p - n if p > n // 2 else p for p, n in zip(peak, correlation.shape)], dtype=float)
+
+    return correlation[peak], shift
+
+
+
+def score_orientation(fixed_spectrum, moving_thumb, canvas_shape, angle, flip, moving_center, fixed_center):
+    matrix = orientation_matrix(angle, flip, moving_center, fixed_center)
+
+    # ndimage maps output (row, col) to input (row, col)
+    swap = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]])
+    inverse_rc = swap @ np.linalg.inv(matrix) @ swap
+    moving_canvas = ndimage.affine_transform(moving_thumb, inverse_rc, output_shape=canvas_shape, order=1, cval=0)
+
+    score, shift = phase_correlation_peak(fixed_spectrum, moving_canvas)
+    matrix[0, 2] += shift[1]
+    matrix[1, 2] += shift[0]
+
+    return Prealignment(matrix, angle, flip, float(score))
+
+
+
+def estimate_prealignment(fixed, moving, scale=1, target_size=128, angle_step=10, refine_steps=4):
+
+    # both images share the registration pixel size, so only rotation, mirroring and translation are searched
+    downsample = max(1, int(np.ceil(max(fixed.shape[:2] + moving.shape[:2]) / target_size)))
+    fixed_thumb = thumbnail(fixed, downsample)
+    moving_thumb = thumbnail(moving, downsample)
+
+    # the canvas holds the fixed thumbnail and any rotation of the moving one without wrapping around
+    moving_diagonal = int(np.ceil(np.hypot(*moving_thumb.shape)))
+    canvas_shape = tuple(next_fast_len(n + moving_diagonal) for n in fixed_thumb.shape)
+    fixed_canvas = np.zeros(canvas_shape)
+    fixed_canvas[:fixed_thumb.shape[0], :fixed_thumb.shape[1]] = fixed_thumb
+    fixed_spectrum = np.fft.rfft2(fixed_canvas)
+
+    moving_center = ((moving_thumb.shape[1] - 1) / 2, (moving_thumb.shape[0] - 1) / 2)
+    fixed_center = ((fixed_thumb.shape[1] - 1) / 2, (fixed_thumb.shape[0] - 1) / 2)
+
+    # coarse search over all rotations of both the section and its mirror image, then finer steps around the best one
+    candidates = [score_orientation(fixed_spectrum, moving_thumb, canvas_shape, angle, flip, moving_center, fixed_center)
+                  for flip in (False, True) for angle in np.arange(-180, 180, angle_step)]
+    best = max(candidates, key=lambda c: c.score)
+    for angle in best.angle + np.linspace(-angle_step, angle_step, 2 * refine_steps + 1):
+        candidate = score_orientation(fixed_spectrum, moving_thumb, canvas_shape, angle, best.flip, moving_center, fixed_center)
+        if candidate.score > best.score:
+            best = candidate
+
+    # thumbnail px (block centres) -> px of the given images -> registration px
+    to_image = np.array([[downsample, 0, (downsample - 1) / 2], [0, downsample, (downsample - 1) / 2], [0, 0, 1]])
+    to_registration = np.diag([scale, scale, 1.0])
+    matrix = to_registration @ to_image @ best.matrix @ np.linalg.inv(to_image) @ np.linalg.inv(to_registration)
+    angle = (float(best.angle) + 180) % 360 - 180
+
+    return Prealignment(matrix, angle, best.flip, best.score)
+
+
+
+def needs_prealignment(prealignment, angle_step=10):
+    # sections within about one search step of the fixed orientation are left to the rotation invariant SIFT matching
+    return prealignment.flip or abs(prealignment.angle) > angle_step
+
+
+
+def prealign_moving(moving, matrix, output_shape, scale=1, tile_size=None):
+    # moving image resampled into the fixed frame by the pre-alignment, e.g. at the SIFT scale (scale = SIFT scale factor)
+    scaled = np.diag([1 / scale, 1 / scale, 1.0]) @ matrix @ np.diag([scale, scale, 1.0])
+
+    return warp_tiled(moving, scaled, output_shape[:2], tile_size=tile_size or 1024)
@@ -1,8 +1,10 @@
 import numpy as np
 import xml.etree.ElementTree as ET
+import tifffile
 from tifffile import imread, TiffFile
-from skimage.transform import resize
 import collections
+from concurrent.futures import ThreadPoolExecutor
+from .profiling import profile_stage
 
 """
 This file contains parts of code adapted from HistomicsTK
@@ -38,7 +40,7 @@ def sda_to_rgb(im_sda):
 
 
 
-def colour_deconvolusion(hne_init, W):
+def complement_stain_matrix(W):
     w = np.array(W)
 
     if w.shape[1] < 3:
@@ -57,6 +59,13 @@ def colour_deconvolusion(hne_init, W):
     # normalize stains to unit-norm
     wc = wc / np.sqrt((wc ** 2).sum(0))
 
+    return wc
+
+
+
+def colour_deconvolusion(hne_init, W):
+    wc = complement_stain_matrix(W)
+
     # invert stain matrix
     Q = np.linalg.pinv(wc)
 
@@ -86,11 +95,84 @@ def colour_deconvolusion(hne_init, W):
 
 
 
-def colour_deconvolusion_preprocessing_HnE(hne_init):
+def rgb_to_sda_inplace(channel, buf):
+    # float32 version of rgb_to_sda for one channel, written into buf
+    I_0 = 256
+
+    buf[...] = channel
+    buf += 1
+    np.maximum(buf, 1e-10, out=buf)
+    buf /= I_0
+    np.log(buf, out=buf)
+    buf *= -255 / np.log(I_0)
+    np.maximum(buf, 0, out=buf)
+
+    return buf
+
+
+
+def sda_lookup_table():
+    # optical density of every uint8 intensity, so uint8 channels need a gather instead of a log
+    return rgb_to_sda_inplace(np.arange(256), np.empty(256, dtype=np.float32))
+
+
+
+def colour_deconvolusion_fast(hne_init, W, stains=(0,), chunk_rows=512):
+
+    Q = np.linalg.pinv(complement_stain_matrix(W)).astype(np.float32)
+    I_0 = 256
+
+    h, w = hne_init.shape[:2]
+    chunk_rows = min(chunk_rows, h)
+    lut = sda_lookup_table() if hne_init.dtype == np.uint8 else None
+
+    # buffers reused for every chunk of rows
+    sda = np.empty((3, chunk_rows, w), dtype=np.float32)
+    acc = np.empty((chunk_rows, w), dtype=np.float32)
+    tmp = np.empty((chunk_rows, w), dtype=np.float32)
+    Stains = np.empty((h, w, len(stains)), dtype=np.uint8)
+
+    for r0 in range(0, h, chunk_rows):
+        r1 = min(r0 + chunk_rows, h)
+        n = r1 - r0
+        rows = hne_init[r0:r1]
+
+        # transform input RGB to optical density values
+        for c in range(3):
+            if lut is not None:
+                np.take(lut, rows[:, :, c], out=sda[c, :n])
+            else:
+                rgb_to_sda_inplace(rows[:, :, c], sda[c, :n])
+
+        # deconvolve only the requested stains and transform back to RGB
+        for i, k in enumerate(stains):
+            a, t = acc[:n], tmp[:n]
+            np.multiply(sda[0, :n], Q[k, 0], out=a)
+            for c in (1, 2):
+                np.multiply(sda[c, :n], Q[k, c], out=t)
+                a += t
+
+            # I_0 ** (1 - sda / 255) - 1
+            a *= -np.log(I_0) / 255
+            a += np.log(I_0)
+            np.exp(a, out=a)
+            a -= 1
+            np.clip(a, 0, 255, out=a)
+            Stains[r0:r1, :, i] = a
+
+    return Stains
+
+
+
+def colour_deconvolusion_preprocessing_HnE(hne_init, fast=False):
 
     # create stain matrix (columns correspond to stains hematoxylin, eosin, null)
     W = np.array([[0.65, 0.70, 0.29], [0.07, 0.99, 0.11], [0.0, 0.0, 0.0]]).T
 
+    if fast:
+        # chunked float32 deconvolution of the hematoxylin channel only
+        return 1 - colour_deconvolusion_fast(hne_init, W, stains=(0,))[:, :, 0]
+
     # perform standard color deconvolution
     imDeconvolved = colour_deconvolusion(hne_init, W)
     hne_deconv = 1 - imDeconvolved.Stains[:, :, 0]
@@ -99,38 +181,196 @@ def colour_deconvolusion_preprocessing_HnE(hne_init):
 
 
 
+def is_channels_first(shape):
+    # same convention as load_image_data: (c, h, w) stacks are moved to (h, w, c)
+    return len(shape) == 3 and not shape[2] < shape[0]
+
+
+
+def channels_last_shape(shape):
+    shape = tuple(shape)
+    return shape[1:] + shape[:1] if is_channels_first(shape) else shape
+
+
+
 def get_image_size_ome_tiff(file_path):
 
+    # read the shape from the tiff structure without decoding pixels
     with TiffFile(file_path) as tif:
-        img = tif.series[0].asarray()
-        shape = img.shape[0:2] if img.ndim == 2 or img.shape[0] < img.shape[2] else img.shape[1:3] 
-        return shape
+        return channels_last_shape(tif.series[0].shape)[0:2]
+
+
+
+def read_pixel_size(tif):
+    ome = tif.ome_metadata
+    if ome is None:
+        raise ValueError(f"Not an OME-TIFF: {tif.filename}")
+
+    root = ET.fromstring(ome)
+    pixels = root.find(".//{*}Pixels")   
+
+    px = pixels.get("PhysicalSizeX")
+    py = pixels.get("PhysicalSizeY")
+
+    px = float(px) if px is not None else None
+    py = float(py) if py is not None else None
+
+    return px, py
+
+
+
+def read_channel_names(tif):
+    ome = tif.ome_metadata
+    if ome is None:
+        return None
+
+    root = ET.fromstring(ome)
+    names = [channel.get("Name") for channel in root.findall(".//{*}Pixels/{*}Channel")]
+
+    return names if names and all(name is not None for name in names) else None
 
 
 
 def get_pixel_size_ome_tiff(file_path):
     with TiffFile(file_path) as tif:
-        ome = tif.ome_metadata
-        if ome is None:
-            raise ValueError(f"Not an OME-TIFF: {file_path}")
+        return read_pixel_size(tif)
+
+
+
+def optional_zarr():
+    # zarr is optional and slow to import, so it is only imported when an image is opened
+    try:
+        import zarr
+    except ImportError:
+        return None
 
-        root = ET.fromstring(ome)
-        pixels = root.find(".//{*}Pixels")   
+    return zarr
 
-        px = pixels.get("PhysicalSizeX")
-        py = pixels.get("PhysicalSizeY")
 
-        px = float(px) if px is not None else None
-        py = float(py) if py is not None else None
 
-        return px, py
+class ChannelsLastView:
+    # (c, h, w) array-like presented as (h, w, c) without reading it
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = channels_last_shape(data.shape)
+        self.dtype = data.dtype
+        self.ndim = 3
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        region = np.asarray(self.data[key[2], key[0], key[1]])
+
+        # move the channel axis back to the end if it was not indexed away
+        return np.moveaxis(region, 0, -1) if not isinstance(key[2], (int, np.integer)) else region
+
+
+
+class PagedChannels:
+    # (c, h, w) stack stored as one page per channel, decoding only the pages of the indexed channels
+
+    def __init__(self, pages, shape, dtype):
+        self.pages = pages
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.ndim = 3
+        self._cached = (None, None)
+
+    def plane(self, channel):
+        # the last decoded page is kept, as windows of the same channel are usually read one after another
+        index, plane = self._cached
+        if index != channel:
+            plane = self.pages[channel].asarray()
+            self._cached = (channel, plane)
+        return plane
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        if isinstance(key[0], (int, np.integer)):
+            return self.plane(key[0])[key[1], key[2]]
+
+        return np.stack([self.plane(c)[key[1], key[2]] for c in range(self.shape[0])[key[0]]])
+
+
+
+class LazyImage:
+    # shape, dtype, pixel size and pyramid levels of a tiff without decoding pixels
+
+    def __init__(self, file_path):
+        if not (file_path.endswith(".tif") or file_path.endswith(".tiff")):
+            raise ValueError("Unsupported file format. Please provide a .tif file.")
+
+        self.file_path = file_path
+        self.tif = TiffFile(file_path)
+        self.series = self.tif.series[0]
+        self.dtype = self.series.dtype
+        self.levels = [channels_last_shape(level.shape) for level in self.series.levels]
+        self.shape = self.levels[0]
+        self.ndim = len(self.shape)
+
+        try:
+            self.pixel_size, _ = read_pixel_size(self.tif)
+        except Exception:
+            self.pixel_size = None
+
+        self.channel_names = read_channel_names(self.tif)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.tif.close()
+
+    def downsample(self, level):
+        return self.shape[0] / self.levels[level][0]
+
+    def level_for_shape(self, target_shape):
+        # coarsest level that is still at least as large as target_shape
+        level = 0
+        for i, shape in enumerate(self.levels):
+            if shape[0] >= target_shape[0] and shape[1] >= target_shape[1]:
+                level = i
+        return level
+
+    def data(self, level=0):
+        # array-like supporting window reads, decoding only what is sliced
+        arr = None
+        zarr = optional_zarr()
+        if zarr is not None:
+            try:
+                arr = zarr.open(self.series.aszarr(level=level), mode="r")
+            except Exception:
+                # a zarr release the installed tifffile cannot serve a store to is skipped like a missing one
+                arr = None
+        if arr is None:
+            try:
+                arr = tifffile.memmap(self.file_path, series=0, level=level, mode="r")
+            except ValueError:
+                # compressed or non-contiguous data cannot be memory-mapped, planar stacks are still read page by page
+                level_series = self.series.levels[level]
+                if len(level_series.shape) == 3 and is_channels_first(level_series.shape) and len(level_series.pages) == level_series.shape[0]:
+                    arr = PagedChannels(level_series.pages, level_series.shape, level_series.dtype)
+                else:
+                    arr = level_series.asarray()
+
+        return ChannelsLastView(arr) if is_channels_first(arr.shape) else arr
+
+    def read(self, level=0):
+        img = self.series.levels[level].asarray()
+        return img.transpose(1, 2, 0) if is_channels_first(img.shape) else img
 
 
 
 def load_image_data(file_path):
     if file_path.endswith(".tif") or file_path.endswith(".tiff"):
-        img_raw = imread(file_path)
-        img = np.array(img_raw) 
+        img = np.asarray(imread(file_path))
 
         return img if (len(img.shape) == 2) or (img.shape[2] < img.shape[0]) else img.transpose(1, 2, 0)
     
@@ -139,13 +379,29 @@ def load_image_data(file_path):
 
 
 
+def load_downsampled(file_path, target_shape):
+    from skimage.transform import resize
+
+    # decode a low resolution pyramid level instead of the full image and resize the rest of the way
+    with LazyImage(file_path) as img:
+        level = img.level_for_shape(target_shape)
+        data = img.read(level)
+
+    scaled = resize(data, tuple(target_shape[:2]) + data.shape[2:], anti_aliasing=True, preserve_range=True)
+    if np.issubdtype(data.dtype, np.integer):
+        scaled = np.rint(scaled)
+
+    return scaled.astype(data.dtype)
+
+
+
 def extract_channel(img, channel_index):
     
     return img[:, :, channel_index]
 
 
 
-def load_and_scale_images(fixed_path, moving_path, fixed_px_sz, moving_px_sz):
+def resolve_pixel_sizes(fixed_path, moving_path, fixed_px_sz, moving_px_sz):
 
     if fixed_px_sz is None:
         try:
@@ -165,20 +421,101 @@ def load_and_scale_images(fixed_path, moving_path, fixed_px_sz, moving_px_sz):
         if moving_px_sz is None:
             raise ValueError("Pixel size information not found in metadata for moving image. Please provide moving_px_sz.")
 
+    return fixed_px_sz, moving_px_sz
+
+
+
+def scaled_shape(shape, scale):
+    # (h, w) of an image resampled from its pixel size to one scale times larger, without reading it
+    return (int(shape[0]/scale), int(shape[1]/scale))
+
+
+
+def float_scale(dtype):
+    # same value range as img_as_float
+    return 1 / np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1
+
+
+
+def box_downscale(data, target_shape, channel=None, workers=None, block_rows=256):
+    from scipy import ndimage
+
+    # integer box filter over row blocks in float32, then the remaining (< 2x) anti-aliased resampling on the reduced image
+    h, w = data.shape[:2]
+    fy, fx = h / target_shape[0], w / target_shape[1]
+    ky, kx = max(int(fy), 1), max(int(fx), 1)
+    rh, rw = -(-h // ky), -(-w // kx)
+    channels = data.shape[2:] if channel is None else ()
+    scale = float_scale(data.dtype)
+    reduced = np.empty((rh, rw) + channels, dtype=np.float32)
+
+    def reduce_rows(r0):
+        r1 = min(r0 + block_rows, rh)
+        block = np.asarray(data[r0 * ky:r1 * ky] if channel is None else data[r0 * ky:r1 * ky, :, channel], dtype=np.float32)
+
+        # the last partial box of each axis is completed by replicating the edge
+        pad = [(0, (r1 - r0) * ky - block.shape[0]), (0, rw * kx - w)] + [(0, 0)] * len(channels)
+        if any(p[1] for p in pad):
+            block = np.pad(block, pad, mode="edge")
+        reduced[r0:r1] = block.reshape((r1 - r0, ky, rw, kx) + channels).mean(axis=(1, 3)) * scale
+
+    # numpy releases the GIL in the reductions, so row blocks are reduced by a pool of threads
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(reduce_rows, range(0, rh, block_rows)))
+
+    if (rh, rw) == tuple(target_shape) and ky * rh == h and kx * rw == w:
+        return reduced
+
+    # output pixel centres in the reduced image, with the pixel centre convention of skimage resize
+    ry, rx = fy / ky, fx / kx
+    sigma = [max(0, (ry - 1) / 2), max(0, (rx - 1) / 2)] + [0] * len(channels)
+    if any(sigma):
+        reduced = ndimage.gaussian_filter(reduced, sigma, mode="mirror")
+
+    return ndimage.affine_transform(reduced, [ry, rx] + [1] * len(channels), offset=[ry / 2 - 0.5, rx / 2 - 0.5] + [0] * len(channels),
+                                    output_shape=tuple(target_shape) + channels, order=1, mode="nearest")
+
+
+
+def load_scaled_fast(file_path, scale, workers=None):
+    # fixed image scaled like load_and_scale_images, from the closest pyramid level and only the needed channel
+    with LazyImage(file_path) as img:
+        target_shape = scaled_shape(img.shape, scale)
+        level = img.level_for_shape(target_shape)
+        data = img.data(level)
+
+        channel = 0 if data.ndim == 3 and data.shape[2] > 3 else None
+        scaled = box_downscale(data, target_shape, channel=channel, workers=workers)
+
+    return scaled * 255
+
+
+
+def load_and_scale_images(fixed_path, moving_path, fixed_px_sz, moving_px_sz, fast=False, workers=None, profiler=None):
+    from skimage.transform import resize
+
+    fixed_px_sz, moving_px_sz = resolve_pixel_sizes(fixed_path, moving_path, fixed_px_sz, moving_px_sz)
     scale = moving_px_sz / fixed_px_sz
 
-    # load fixed image
-    fixed_img = load_image_data(fixed_path)
-    if len(fixed_img.shape) == 2:
-        fixed_init = resize(fixed_img, (int(fixed_img.shape[0]/scale), int(fixed_img.shape[1]/scale)), anti_aliasing=True)
-    elif fixed_img.shape[2] == 3:
-        fixed_init = resize(fixed_img, (int(fixed_img.shape[0]/scale), int(fixed_img.shape[1]/scale), fixed_img.shape[2]), anti_aliasing=True)
-    elif fixed_img.shape[2] > 3:
-        fixed_ch_img = extract_channel(fixed_img, 0)
-        fixed_init = resize(fixed_ch_img, (int(fixed_ch_img.shape[0]/scale), int(fixed_ch_img.shape[1]/scale)), anti_aliasing=True)
-    fixed_init = fixed_init*255
-
-    # load moving image
-    moving_init = load_image_data(moving_path)
+    # load both images, the fast path reads the fixed image window by window while scaling it
+    with profile_stage(profiler, "decode") as record:
+        fixed_img = None if fast else load_image_data(fixed_path)
+        moving_init = load_image_data(moving_path)
+        record.arrays(fixed=fixed_img, moving=moving_init)
+
+    # scale the fixed image to the moving pixel size
+    with profile_stage(profiler, "resize") as record:
+        if fast:
+            fixed_init = load_scaled_fast(fixed_path, scale, workers)
+        else:
+            if len(fixed_img.shape) == 2:
+                fixed_init = resize(fixed_img, scaled_shape(fixed_img.shape, scale), anti_aliasing=True)
+            elif fixed_img.shape[2] == 3:
+                fixed_init = resize(fixed_img, scaled_shape(fixed_img.shape, scale) + (fixed_img.shape[2],), anti_aliasing=True)
+            elif fixed_img.shape[2] > 3:
+                fixed_ch_img = extract_channel(fixed_img, 0)
+                fixed_init = resize(fixed_ch_img, scaled_shape(fixed_ch_img.shape, scale), anti_aliasing=True)
+            fixed_init = fixed_init*255
+        record.arrays(fixed=fixed_init)
 
     return fixed_init, moving_init
@@ -0,0 +1,164 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def process_peak_rss_mb():
+    # peak resident set size of the process so far, including everything before the current stage
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+
+class RssSampler:
+    # peak resident set size during a stage, sampled by a background thread since the kernel only keeps the process lifetime peak
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = current_rss_mb()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        rss = current_rss_mb()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sample()
+
+
+
+class StageRecord(dict):
+
+    def arrays(self, **arrays):
+        # shape, dtype and size of the arrays a stage produced
+        for name, arr in arrays.items():
+            if arr is not None and hasattr(arr, "shape"):
+                self.setdefault("arrays", {})[name] = {
+                    "shape": list(arr.shape),
+                    "dtype": str(arr.dtype),
+                    "mb": arr.size * arr.dtype.itemsize / 1024 ** 2,
+                }
+
+
+
+class StageProfiler:
+    # wall time, CPU time, memory and array sizes of every pipeline stage
+
+    def __init__(self, hooks=None, profile_stage=None, profile_dir=None):
+        self.records = []
+        self.hooks = list(hooks) if hooks is not None else []
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @contextmanager
+    def stage(self, name):
+        record = StageRecord(stage=name)
+        rss_before = current_rss_mb()
+
+        # cProfile only the requested stage, the overhead elsewhere would distort the timings
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+
+        sampler = RssSampler()
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            with sampler:
+                yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+            record["wall_s"] = time.perf_counter() - wall
+            record["cpu_s"] = time.process_time() - cpu
+            rss_after = current_rss_mb()
+            record["rss_before_mb"] = rss_before
+            record["rss_after_mb"] = rss_after
+            # memory the stage kept, and the most it held at any point above what was resident when it started
+            record["rss_delta_mb"] = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+            record["peak_rss_mb"] = sampler.peak
+            record["peak_rss_delta_mb"] = sampler.peak - rss_before if rss_before is not None and sampler.peak is not None else None
+            record["process_peak_rss_mb"] = process_peak_rss_mb()
+
+            if profiler is not None:
+                record["cprofile"] = self.dump_cprofile(name, profiler)
+
+            self.records.append(record)
+            for hook in self.hooks:
+                hook(record)
+
+    def dump_cprofile(self, name, profiler):
+        profile_dir = self.profile_dir if self.profile_dir is not None else "."
+        os.makedirs(profile_dir, exist_ok=True)
+
+        # binary stats for snakeviz/pstats and a readable summary
+        prof_path = os.path.join(profile_dir, f"profile_{name}.prof")
+        profiler.dump_stats(prof_path)
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(30)
+        with open(os.path.join(profile_dir, f"profile_{name}.txt"), "w") as f:
+            f.write(summary.getvalue())
+
+        return prof_path
+
+    def summary(self):
+        return {
+            "stages": self.records,
+            "total_wall_s": sum(r["wall_s"] for r in self.records),
+            "peak_rss_mb": process_peak_rss_mb(),
+        }
+
+    def save(self, file_path):
+        with open(file_path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        print(f"Profile saved to {file_path}")
+
+
+
+@contextmanager
+def profile_stage(profiler, name):
+    # no-op when profiling is off
+    if profiler is None:
+        yield StageRecord(stage=name)
+    else:
+        with profiler.stage(name) as record:
+            yield record
@@ -0,0 +1,195 @@
+import collections
+import numpy as np
+from skimage.transform import estimate_transform
+
+# points of a minimal sample of each transformation family
+MIN_SAMPLES = {"euclidean": 2, "similarity": 2, "affine": 3, "projective": 4}
+
+# 'prosac' orders the matches by descriptor distance, 'uniform' samples all matches alike, 'skimage' is the former measure.ransac
+RANSAC_METHODS = ("prosac", "uniform", "skimage")
+
+RansacResult = collections.namedtuple('RansacResult', ['model', 'inliers', 'trials'])
+
+
+def minimal_models(kind, src, dst):
+    # 3x3 matrices mapping src to dst for a batch of minimal samples (B, m, 2), and which samples were not degenerate
+    n = src.shape[0]
+
+    if kind in ("euclidean", "similarity"):
+        # z = a * w + b in complex numbers
+        w = src[..., 0] + 1j * src[..., 1]
+        z = dst[..., 0] + 1j * dst[..., 1]
+        dw = w[:, 1] - w[:, 0]
+        valid = np.abs(dw) > 1e-9
+        a = (z[:, 1] - z[:, 0]) / np.where(valid, dw, 1)
+        if kind == "euclidean":
+            a = a / np.maximum(np.abs(a), 1e-12)
+        b = z[:, 0] - a * w[:, 0]
+
+        models = np.zeros((n, 3, 3))
+        models[:, 0, 0], models[:, 0, 1], models[:, 0, 2] = a.real, -a.imag, b.real
+        models[:, 1, 0], models[:, 1, 1], models[:, 1, 2] = a.imag, a.real, b.imag
+        models[:, 2, 2] = 1
+        return models, valid
+
+    # points of every sample are normalised to zero mean and unit spread (Hartley) for a well conditioned solve
+    src_norm, src_t = normalise_samples(src)
+    dst_norm, dst_t = normalise_samples(dst)
+
+    if kind == "affine":
+        A = np.concatenate([src_norm, np.ones(src.shape[:2] + (1,))], axis=2)
+        B = dst_norm
+    elif kind == "projective":
+        # direct linear transform with h33 = 1
+        x, y, u, v = src_norm[..., 0], src_norm[..., 1], dst_norm[..., 0], dst_norm[..., 1]
+        zeros, ones = np.zeros_like(x), np.ones_like(x)
+        A = np.concatenate([np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], axis=2),
+                            np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], axis=2)], axis=1)
+        B = np.concatenate([u, v], axis=1)[..., None]
+    else:
+        raise ValueError(f"Invalid transformation. Use one of {list(MIN_SAMPLES)}.")
+
+    # degenerate (e.g. collinear) samples are solved with the identity and discarded
+    valid = np.abs(np.linalg.det(A)) > 1e-6
+    A = np.where(valid[:, None, None], A, np.eye(A.shape[1]))
+    solution = np.linalg.solve(A, B)
+
+    models = np.zeros((n, 3, 3))
+    if kind == "affine":
+        models[:, :2, :] = solution.transpose(0, 2, 1)
+    else:
+        models.reshape(n, 9)[:, :8] = solution[..., 0]
+    models[:, 2, 2] = 1
+
+    models = np.linalg.inv(dst_t) @ models @ src_t
+    models /= models[:, 2:, 2:]
+
+    return models, valid
+
+
+
+def normalise_samples(points):
+    # normalised points and the (B, 3, 3) similarity matrices that normalise them
+    centre = points.mean(axis=1, keepdims=True)
+    spread = np.sqrt(((points - centre) ** 2).sum(axis=2)).mean(axis=1)
+    scale = np.sqrt(2) / np.maximum(spread, 1e-12)
+
+    matrices = np.zeros((len(points), 3, 3))
+    matrices[:, 0, 0] = matrices[:, 1, 1] = scale
+    matrices[:, :2, 2] = -centre[:, 0] * scale[:, None]
+    matrices[:, 2, 2] = 1
+
+    return (points - centre) * scale[:, None, None], matrices
+
+
+
+def residuals(models, src, dst):
+    # (B, N) transfer errors of all points under a batch of models
+    mapped = np.einsum("bij,nj->bni", models, np.column_stack([src, np.ones(len(src))]))
+    w = mapped[..., 2]
+    w = np.where(np.abs(w) < 1e-12, 1e-12, w)
+
+    return np.hypot(mapped[..., 0] / w - dst[:, 0], mapped[..., 1] / w - dst[:, 1])
+
+
+
+def prosac_schedule(n_points, min_samples, max_trials):
+    # number of hypotheses after which the PROSAC sampling pool grows to the next best match (Chum & Matas 2005)
+    schedule = np.zeros(n_points + 1)
+    t_n = max_trials * np.prod([(min_samples - i) / (n_points - i) for i in range(min_samples)])
+    t_prime = 1.0
+    schedule[min_samples] = t_prime
+
+    for n in range(min_samples, n_points):
+        t_next = t_n * (n + 1) / (n + 1 - min_samples)
+        t_prime += max(np.ceil(t_next - t_n), 1)
+        schedule[n + 1] = t_prime
+        t_n = t_next
+
+    return schedule
+
+
+
+def required_trials(inlier_ratio, min_samples, confidence):
+    if inlier_ratio >= 1:
+        return 0
+    if inlier_ratio <= 0:
+        return np.inf
+
+    return np.log(1 - confidence) / np.log(1 - inlier_ratio ** min_samples)
+
+
+
+def ransac(src, dst, kind="similarity", residual_threshold=2, max_trials=1000, confidence=0.999,
+           quality=None, batch_size=256, local_optimization=3, seed=None):
+
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    if kind not in MIN_SAMPLES:
+        raise ValueError(f"Invalid transformation. Use one of {list(MIN_SAMPLES)}.")
+    min_samples = MIN_SAMPLES[kind]
+    n_points = len(src)
+    if n_points < min_samples:
+        raise ValueError(f"At least {min_samples} matches are required for a {kind} transformation, only {n_points} found.")
+
+    rng = np.random.default_rng(seed)
+
+    # PROSAC: sample from the best matches first, growing the pool towards all matches
+    if quality is not None:
+        order = np.argsort(quality, kind="stable")
+        src, dst = src[order], dst[order]
+        schedule = prosac_schedule(n_points, min_samples, max_trials)
+    else:
+        order = None
+
+    best_score, best_model, best_inliers = np.inf, None, None
+    trials, needed = 0, max_trials
+    threshold_sq = residual_threshold ** 2
+
+    while trials < min(needed, max_trials):
+        batch = int(min(batch_size, max_trials - trials))
+        if order is not None:
+            pool = np.searchsorted(schedule, np.arange(trials + 1, trials + batch + 1), side="left")
+            pool = np.clip(pool, min_samples, n_points)
+        else:
+            pool = np.full(batch, n_points)
+        trials += batch
+
+        samples = (rng.random((batch, min_samples)) * pool[:, None]).astype(np.intp)
+        distinct = np.all(np.sort(samples, axis=1)[:, 1:] != np.sort(samples, axis=1)[:, :-1], axis=1)
+        models, valid = minimal_models(kind, src[samples], dst[samples])
+        valid &= distinct & np.all(np.isfinite(models), axis=(1, 2))
+        if not valid.any():
+            continue
+
+        # MSAC score: truncated squared residuals, lower is better
+        errors = residuals(models[valid], src, dst) ** 2
+        scores = np.minimum(errors, threshold_sq).sum(axis=1)
+        best = np.argmin(scores)
+        if scores[best] < best_score:
+            best_score, best_model = scores[best], models[valid][best]
+            best_inliers = errors[best] < threshold_sq
+
+            # adaptive termination once the inlier ratio gives the requested confidence
+            needed = required_trials(best_inliers.mean(), min_samples, confidence)
+
+    if best_model is None or best_inliers.sum() < min_samples:
+        raise ValueError("RANSAC could not find a transformation consistent with the matches.")
+
+    # local optimisation: least squares on the inliers, then re-select the inliers
+    model = estimate_transform(kind, src[best_inliers], dst[best_inliers])
+    inliers = best_inliers
+    for _ in range(local_optimization):
+        refit_inliers = residuals(model.params[None], src, dst)[0] < residual_threshold
+        if refit_inliers.sum() < min_samples or np.array_equal(refit_inliers, inliers):
+            break
+        inliers = refit_inliers
+        model = estimate_transform(kind, src[inliers], dst[inliers])
+
+    if order is not None:
+        # inliers in the order of the input matches
+        unordered = np.zeros(n_points, dtype=bool)
+        unordered[order] = inliers
+        inliers = unordered
+
+    return RansacResult(model, inliers, trials)
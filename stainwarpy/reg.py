@@ -1,10 +1,46 @@
 import random
-from skimage.transform import resize, estimate_transform, warp, AffineTransform
+import collections
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from skimage.transform import resize, estimate_transform, warp, AffineTransform, ProjectiveTransform
 from skimage.feature import SIFT, match_descriptors
+from skimage.registration import phase_cross_correlation
 from skimage import measure
+from skimage.util import img_as_float
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .tiling import warp_tiled, tile_grid
+from .profiling import profile_stage
+from .masks import warp_labels_tiled, warp_labels_objects, MASK_MODES
+from .ransac import ransac, RANSAC_METHODS
+from .prealign import prealign_moving
+from .tissue import block_mean
 
 
-def transform_seg_mask(mask, transformation_maps, output_shape):
+SIFT_N_OCTAVES = 3
+SIFT_N_SCALES = 5
+SIFT_TILE_OVERLAP = 64
+
+# keypoints and descriptors detected on an image downscaled by scale_factor
+SIFTFeatures = collections.namedtuple('SIFTFeatures', ['keypoints', 'descriptors', 'scale_factor'])
+
+
+def transform_seg_mask(mask, transformation_maps, output_shape, tile_size=None, mode=None):
+
+    # tiled by default when a tile size is given, for backwards compatibility
+    if mode is None:
+        mode = "tiled" if tile_size is not None else "dense"
+
+    if mode == "objects":
+        # nearest neighbour over the bounding box of every object, keeping the integer label dtype
+        return warp_labels_objects(mask, transformation_maps, output_shape)
+
+    if mode == "tiled":
+        # nearest neighbour, tile by tile, skipping tiles without objects and keeping the integer label dtype
+        return warp_labels_tiled(mask, transformation_maps, output_shape, tile_size=tile_size or 1024)
+
+    if mode != "dense":
+        raise ValueError(f"Invalid mask transformation mode. Use one of {list(MASK_MODES)}.")
 
     moved_mask = warp(mask, transformation_maps.inverse, output_shape=output_shape, order=0, preserve_range=True)
 
@@ -12,29 +48,269 @@ def transform_seg_mask(mask, transformation_maps, output_shape):
 
 
 
-def features_with_SIFT(fixed, moving, max_ratio=0.6, n_octaves=3, n_scales=5):
-    fixedX, fixedY = fixed.shape
-    movingX, movingY = moving.shape
+def sift_scale_factor(fixed_shape):
+    fixedX, fixedY = fixed_shape[:2]
     scale_factor = 4
 
     if fixedX > 2000 or fixedY > 2000:
         scale_factor = max(fixedX // 2000, fixedY // 2000) * 4
 
+    return scale_factor
+
+
+
+def scale_for_SIFT(image, scale_factor, prescaled=False):
+
+    # images read from a pyramid level are already downscaled by scale_factor
+    if prescaled:
+        return img_as_float(image)
+
+    imageX, imageY = image.shape
+
     # Resize the images to reduce memory usage
-    fixed_scaled = resize(fixed, (fixedX // scale_factor, fixedY // scale_factor), anti_aliasing=True)
-    moving_scaled = resize(moving, (movingX // scale_factor, movingY // scale_factor), anti_aliasing=True)
+    return resize(image, (imageX // scale_factor, imageY // scale_factor), anti_aliasing=True)
+
 
+
+def detect_SIFT(image_scaled, scale_factor, n_octaves=SIFT_N_OCTAVES, n_scales=SIFT_N_SCALES):
+
+    descriptor_extractor = SIFT(n_octaves=n_octaves, n_scales=n_scales)
+    descriptor_extractor.detect_and_extract(image_scaled)
+
+    return SIFTFeatures(descriptor_extractor.keypoints, descriptor_extractor.descriptors, scale_factor)
+
+
+
+def detect_SIFT_window(image, n_octaves=SIFT_N_OCTAVES, n_scales=SIFT_N_SCALES):
+    # keypoints and descriptors of one image or tile, empty if it has no features (e.g. background tiles)
     descriptor_extractor = SIFT(n_octaves=n_octaves, n_scales=n_scales)
+    try:
+        descriptor_extractor.detect_and_extract(image)
+    except RuntimeError:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros((0, 128), dtype=np.uint8)
+
+    return descriptor_extractor.keypoints, descriptor_extractor.descriptors
+
+
+
+def sift_pool(sift_workers=None, sift_backend="thread"):
+    if sift_backend == "thread":
+        return ThreadPoolExecutor(max_workers=sift_workers or 1)
+    if sift_backend == "process":
+        return ProcessPoolExecutor(max_workers=sift_workers or 1)
+
+    raise ValueError("Invalid SIFT backend. Use 'thread' or 'process'.")
+
+
+
+def submit_SIFT(executor, image_scaled, n_octaves=SIFT_N_OCTAVES, n_scales=SIFT_N_SCALES, tile_size=None, overlap=SIFT_TILE_OVERLAP, tissue=None, scale_factor=1):
+
+    untiled = tile_size is None or max(image_scaled.shape) <= tile_size
+    if untiled and tissue is None:
+        return [((0, image_scaled.shape[0], 0, image_scaled.shape[1]), (0, 0), executor.submit(detect_SIFT_window, image_scaled, n_octaves, n_scales))]
+
+    h, w = image_scaled.shape
+    if untiled:
+        # without tiles the detection is cropped to the bounding boxes of the tissue regions
+        cores = [(y0 // scale_factor, min(-(-y1 // scale_factor), h), x0 // scale_factor, min(-(-x1 // scale_factor), w)) for y0, y1, x0, x1 in tissue.bounding_boxes()]
+    else:
+        # background tiles (in the full resolution tissue mask) are not detected at all
+        cores = [(y0, y1, x0, x1) for y0, y1, x0, x1 in tile_grid((h, w), tile_size)
+                 if tissue is None or tissue.any_in(y0 * scale_factor, y1 * scale_factor, x0 * scale_factor, x1 * scale_factor)]
+
+    # overlapping windows, each owning the keypoints in its non-overlapping core
+    jobs = []
+    for y0, y1, x0, x1 in cores:
+        wy0, wx0 = max(y0 - overlap, 0), max(x0 - overlap, 0)
+        window = image_scaled[wy0:min(y1 + overlap, h), wx0:min(x1 + overlap, w)]
+        jobs.append(((y0, y1, x0, x1), (wy0, wx0), executor.submit(detect_SIFT_window, window, n_octaves, n_scales)))
+
+    return jobs
+
+
+
+def collect_SIFT(jobs, scale_factor, dedup_radius=1.5):
+
+    keypoints, descriptors, tile_ids = [], [], []
+    for i, ((y0, y1, x0, x1), (wy0, wx0), future) in enumerate(jobs):
+        kp, desc = future.result()
+        kp = kp + [wy0, wx0]
+        core = (kp[:, 0] >= y0) & (kp[:, 0] < y1) & (kp[:, 1] >= x0) & (kp[:, 1] < x1)
+        keypoints.append(kp[core])
+        descriptors.append(desc[core])
+        tile_ids.append(np.full(core.sum(), i))
+
+    if not jobs:
+        return SIFTFeatures(np.zeros((0, 2), dtype=np.int64), np.zeros((0, 128), dtype=np.uint8), scale_factor)
+
+    keypoints = np.concatenate(keypoints)
+    descriptors = np.concatenate(descriptors)
+    tile_ids = np.concatenate(tile_ids)
+
+    # a feature on a core border can be found by both neighbouring tiles at slightly different positions
+    if len(jobs) > 1 and len(keypoints) > 1:
+        pairs = cKDTree(keypoints).query_pairs(dedup_radius, output_type="ndarray")
+        pairs = pairs[tile_ids[pairs[:, 0]] != tile_ids[pairs[:, 1]]]
+        keep = np.ones(len(keypoints), dtype=bool)
+        keep[pairs[:, 1]] = False
+        keypoints, descriptors = keypoints[keep], descriptors[keep]
+
+    return SIFTFeatures(keypoints, descriptors, scale_factor)
+
+
+
+def ratio_and_mutual_check(best_idx, best_dist, second_dist, mutual_idx, max_ratio):
+
+    # Lowe's ratio test and mutual nearest neighbour check, as in match_descriptors
+    idx1 = np.arange(best_idx.shape[0])
+    second_dist = np.where(second_dist == 0, np.finfo(float).eps, second_dist)
+    keep = (best_dist / second_dist < max_ratio) & (mutual_idx[best_idx] == idx1)
+
+    return np.column_stack([idx1[keep], best_idx[keep]])
+
+
+
+def nearest_two(query, reference, tree, basis, n_candidates):
+
+    # candidates from a KD-tree on PCA-reduced descriptors, re-ranked with exact distances
+    _, candidates = tree.query(query @ basis, k=n_candidates, workers=-1)
+    candidates = candidates.reshape(query.shape[0], -1)
+    dist = np.linalg.norm(reference[candidates] - query[:, None, :], axis=2)
+
+    order = np.argsort(dist, axis=1)[:, :2]
+    rows = np.arange(query.shape[0])[:, None]
+
+    return candidates[rows, order], dist[rows, order]
+
+
 
-    descriptor_extractor.detect_and_extract(moving_scaled)
-    keypoints1, descriptors1 = descriptor_extractor.keypoints, descriptor_extractor.descriptors
+def match_kdtree(descriptors1, descriptors2, max_ratio=0.6, n_components=8, n_candidates=16):
 
-    descriptor_extractor.detect_and_extract(fixed_scaled)
-    keypoints2, descriptors2 = descriptor_extractor.keypoints, descriptor_extractor.descriptors
+    # approximate nearest neighbours: KD-trees work well in few dimensions, so search a PCA projection
+    d1 = descriptors1.astype(np.float32)
+    d2 = descriptors2.astype(np.float32)
 
-    matches12 = match_descriptors(
-        descriptors1, descriptors2, max_ratio=max_ratio, cross_check=True
-    )
+    mean = np.concatenate([d1, d2]).mean(axis=0)
+    d1 -= mean
+    d2 -= mean
+    _, _, vt = np.linalg.svd(np.concatenate([d1, d2]), full_matrices=False)
+    basis = vt[:n_components].T
+
+    n_candidates = min(n_candidates, d1.shape[0], d2.shape[0])
+    if n_candidates < 2:
+        return np.empty((0, 2), dtype=np.intp)
+
+    idx12, dist12 = nearest_two(d1, d2, cKDTree(d2 @ basis), basis, n_candidates)
+    idx21, _ = nearest_two(d2, d1, cKDTree(d1 @ basis), basis, n_candidates)
+
+    return ratio_and_mutual_check(idx12[:, 0], dist12[:, 0], dist12[:, 1], idx21[:, 0], max_ratio)
+
+
+
+def match_blockwise(descriptors1, descriptors2, max_ratio=0.6, block_size=4096):
+
+    # exact matching with memory bounded by block_size x len(descriptors2) distances
+    d1 = descriptors1.astype(np.float32)
+    d2 = descriptors2.astype(np.float32)
+    sq2 = (d2 ** 2).sum(axis=1)
+
+    n1 = d1.shape[0]
+    best_idx = np.empty(n1, dtype=np.intp)
+    best_dist = np.empty(n1, dtype=np.float32)
+    second_dist = np.empty(n1, dtype=np.float32)
+    col_best_dist = np.full(d2.shape[0], np.inf, dtype=np.float32)
+    col_best_idx = np.zeros(d2.shape[0], dtype=np.intp)
+
+    for r0 in range(0, n1, block_size):
+        block = d1[r0:r0 + block_size]
+        dist = (block ** 2).sum(axis=1)[:, None] + sq2[None, :] - 2 * block @ d2.T
+        np.maximum(dist, 0, out=dist)
+        np.sqrt(dist, out=dist)
+
+        rows = np.arange(block.shape[0])
+        best = np.argmin(dist, axis=1)
+        best_idx[r0:r0 + block_size] = best
+        best_dist[r0:r0 + block_size] = dist[rows, best]
+        dist[rows, best] = np.inf
+        second_dist[r0:r0 + block_size] = dist.min(axis=1)
+        dist[rows, best] = best_dist[r0:r0 + block_size]
+
+        # running nearest neighbour of every descriptor in descriptors2 for the mutual check
+        block_best = np.argmin(dist, axis=0)
+        block_best_dist = dist[block_best, np.arange(dist.shape[1])]
+        better = block_best_dist < col_best_dist
+        col_best_dist[better] = block_best_dist[better]
+        col_best_idx[better] = block_best[better] + r0
+
+    return ratio_and_mutual_check(best_idx, best_dist, second_dist, col_best_idx, max_ratio)
+
+
+
+def match_features(descriptors1, descriptors2, max_ratio=0.6, matcher="brute"):
+
+    if matcher == "brute":
+        return match_descriptors(descriptors1, descriptors2, max_ratio=max_ratio, cross_check=True)
+    elif matcher == "kdtree":
+        return match_kdtree(descriptors1, descriptors2, max_ratio=max_ratio)
+    elif matcher == "blockwise":
+        return match_blockwise(descriptors1, descriptors2, max_ratio=max_ratio)
+    else:
+        raise ValueError("matcher must be one of 'brute', 'kdtree' or 'blockwise'")
+
+
+
+def features_with_SIFT(fixed, moving, max_ratio=0.6, n_octaves=SIFT_N_OCTAVES, n_scales=SIFT_N_SCALES, scale_factor=None, prescaled=False, fixed_features=None, matcher="brute", profiler=None, sift_workers=None, sift_backend="thread", sift_tile_size=None, feature_tform="affine", ransac_method="skimage", seed=None, fixed_tissue=None, moving_tissue=None, return_model=False):
+
+    if ransac_method not in RANSAC_METHODS:
+        raise ValueError(f"Invalid RANSAC method. Use one of {list(RANSAC_METHODS)}.")
+
+    if fixed_features is not None:
+        # precomputed (e.g. cached) fixed image features fix the scale factor
+        scale_factor = fixed_features.scale_factor
+    elif prescaled and scale_factor is None:
+        raise ValueError("scale_factor must be provided for prescaled images.")
+    elif scale_factor is None:
+        scale_factor = sift_scale_factor(fixed.shape)
+
+    # the tissue masks crop the detection, which the windowed detection below does
+    if sift_workers is None and sift_tile_size is None and fixed_tissue is None and moving_tissue is None:
+        with profile_stage(profiler, "sift_moving") as record:
+            moving_scaled = scale_for_SIFT(moving, scale_factor, prescaled)
+            keypoints1, descriptors1, _ = detect_SIFT(moving_scaled, scale_factor, n_octaves, n_scales)
+            record.arrays(moving_scaled=moving_scaled, descriptors=descriptors1)
+
+        if fixed_features is None:
+            with profile_stage(profiler, "sift_fixed") as record:
+                fixed_scaled = scale_for_SIFT(fixed, scale_factor, prescaled)
+                fixed_features = detect_SIFT(fixed_scaled, scale_factor, n_octaves, n_scales)
+                record.arrays(fixed_scaled=fixed_scaled, descriptors=fixed_features.descriptors)
+    else:
+        # both images (and their tiles or tissue regions) are detected concurrently
+        with profile_stage(profiler, "sift") as record, sift_pool(sift_workers, sift_backend) as executor:
+            moving_scaled = scale_for_SIFT(moving, scale_factor, prescaled)
+            moving_jobs = submit_SIFT(executor, moving_scaled, n_octaves, n_scales, sift_tile_size, tissue=moving_tissue, scale_factor=scale_factor)
+            if fixed_features is None:
+                fixed_scaled = scale_for_SIFT(fixed, scale_factor, prescaled)
+                fixed_jobs = submit_SIFT(executor, fixed_scaled, n_octaves, n_scales, sift_tile_size, tissue=fixed_tissue, scale_factor=scale_factor)
+
+            keypoints1, descriptors1, _ = collect_SIFT(moving_jobs, scale_factor)
+            if fixed_features is None:
+                fixed_features = collect_SIFT(fixed_jobs, scale_factor)
+            record.arrays(moving_descriptors=descriptors1, fixed_descriptors=fixed_features.descriptors)
+
+    keypoints2, descriptors2, _ = fixed_features
+
+    # keypoints on background glass are dropped before matching
+    if moving_tissue is not None:
+        on_tissue = moving_tissue.contains(keypoints1[:, 0] * scale_factor, keypoints1[:, 1] * scale_factor)
+        keypoints1, descriptors1 = keypoints1[on_tissue], descriptors1[on_tissue]
+    if fixed_tissue is not None:
+        on_tissue = fixed_tissue.contains(keypoints2[:, 0] * scale_factor, keypoints2[:, 1] * scale_factor)
+        keypoints2, descriptors2 = keypoints2[on_tissue], descriptors2[on_tissue]
+
+    with profile_stage(profiler, "matching") as record:
+        matches12 = match_features(descriptors1, descriptors2, max_ratio=max_ratio, matcher=matcher)
+        record.arrays(matches=matches12)
 
     if matches12.shape[0] < 3:
         raise ValueError("Not enough matching points found between images for reliable registration.")
@@ -45,46 +321,174 @@ def features_with_SIFT(fixed, moving, max_ratio=0.6, n_octaves=3, n_scales=5):
     dst, src = dst * scale_factor, src * scale_factor
 
     # Compute inliers using RANSAC 
-    _, inliers = measure.ransac((dst, src),
-                               AffineTransform, min_samples=4,
-                               residual_threshold=2, max_trials=1000)
-    
+    with profile_stage(profiler, "ransac") as record:
+        if ransac_method == "skimage":
+            model, inliers = measure.ransac((dst, src),
+                                       AffineTransform, min_samples=4,
+                                       residual_threshold=2, max_trials=1000, rng=seed)
+            # fixed -> moving in (row, col) to moving -> fixed in xy
+            swap = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]])
+            model = AffineTransform(matrix=np.linalg.inv(swap @ model.params @ swap))
+        else:
+            # the requested transformation is fitted directly (moving -> fixed, xy), PROSAC samples the closest descriptors first
+            quality = None
+            if ransac_method == "prosac":
+                quality = np.linalg.norm(descriptors1[matches12[:, 0]].astype(np.float32) - descriptors2[matches12[:, 1]].astype(np.float32), axis=1)
+            result = ransac(src[:, ::-1], dst[:, ::-1], kind=feature_tform, residual_threshold=2, max_trials=1000, quality=quality, seed=seed)
+            model, inliers = result.model, result.inliers
+            record["trials"] = result.trials
+        record["inliers"] = int(np.count_nonzero(inliers))
+
     movingtemp_matches = src[inliers] 
     fixedtemp_matches = dst[inliers] 
     
     moving_matches = movingtemp_matches[:, [1, 0]].copy()
     fixed_matches = fixedtemp_matches[:, [1, 0]].copy()
 
+    # the moving -> fixed (xy) model of the RANSAC, fitted on all inliers (affine for 'skimage')
+    if return_model:
+        return [moving_matches, fixed_matches, model]
+
     return [moving_matches, fixed_matches]
 
 
 
-def register_feature_based(fixed, moving, feature_tform):
+def refine_match(fixed_level, moving_level, tform, point, level, window, upsample_factor):
+
+    # window around the point in the fixed image at the current level (level x level block means)
+    cx, cy = (point[0] + 0.5) / level - 0.5, (point[1] + 0.5) / level - 0.5
+    x0 = int(round(cx)) - window // 2
+    y0 = int(round(cy)) - window // 2
 
+    if x0 < 0 or y0 < 0 or x0 + window > fixed_level.shape[1] or y0 + window > fixed_level.shape[0]:
+        return None
 
-    [moving_matches, fixed_matches] = features_with_SIFT(fixed, moving)
+    fixed_patch = fixed_level[y0:y0 + window, x0:x0 + window].astype(float)
+
+    # same window of the moving image at this level, resampled into the fixed frame with the current estimate
+    ys, xs = np.mgrid[y0:y0 + window, x0:x0 + window]
+    fixed_xy = (np.column_stack([xs.ravel(), ys.ravel()]) + 0.5) * level - 0.5
+    moving_xy = (tform.inverse(fixed_xy) + 0.5) / level - 0.5
+    moving_patch = ndimage.map_coordinates(moving_level, [moving_xy[:, 1], moving_xy[:, 0]], order=1, mode="constant", cval=0)
+    moving_patch = moving_patch.reshape(window, window)
+
+    if fixed_patch.std() == 0 or moving_patch.std() == 0:
+        return None
+
+    shift, _, _ = phase_cross_correlation(fixed_patch, moving_patch, upsample_factor=upsample_factor)
+
+    # large shifts mean the window content did not correlate
+    if np.abs(shift).max() > window / 4:
+        return None
+
+    # fixed(u) = moving_warped(u - shift)
+    return tform.inverse(np.array([[point[0] - shift[1] * level, point[1] - shift[0] * level]]))[0]
+
+
+
+def refine_matches_multiscale(fixed, moving, moving_matches, fixed_matches, feature_tform, scale_factor, held_out=None, window=64, upsample_factor=10):
+
+    moving_matches = moving_matches.copy()
+    held_out = np.zeros(len(moving_matches), dtype=bool) if held_out is None else held_out.copy()
+    level = scale_factor // 2
+
+    # from one level finer than SIFT down to full resolution, matching only in small windows around the predicted positions
+    while level >= 1:
+        # both images are block averaged once per level, so every window costs the same at every level
+        fixed_level = block_mean(fixed, level) if level > 1 else fixed
+        moving_level = block_mean(moving, level) if level > 1 else moving
+
+        # held out (TRE) matches are refined with the model of the others, but never fitted to it
+        tform = estimate_transform(feature_tform, src=moving_matches[~held_out], dst=fixed_matches[~held_out])
+
+        refined = [refine_match(fixed_level, moving_level, tform, point, level, window, upsample_factor) for point in fixed_matches]
+        keep = np.array([r is not None for r in refined])
+
+        # keep the previous estimates if too few windows could be refined at this level;
+        # held out matches whose window could not be refined keep their previous position instead of being dropped
+        if (keep & ~held_out).sum() >= 3:
+            refined = [moving_matches[i] if r is None else r for i, r in enumerate(refined)]
+            keep |= held_out
+            moving_matches = np.array(refined)[keep]
+            fixed_matches = fixed_matches[keep]
+            held_out = held_out[keep]
+
+        level //= 2
+
+    return [moving_matches, fixed_matches, held_out]
+
+
+
+def register_feature_based(fixed, moving, feature_tform, tile_size=None, sift_inputs=None, fixed_features=None, refine=False, matcher="brute", profiler=None, sift_workers=None, sift_backend="thread", sift_tile_size=None, ransac_method="skimage", fixed_tissue=None, moving_tissue=None, initial_transform=None, seed=None):
+
+    # a pre-alignment resamples the moving image into the fixed frame, SIFT then only has to find the residual transformation
+    moving_original = moving
+    if initial_transform is not None:
+        with profile_stage(profiler, "prealign_warp") as record:
+            if sift_inputs is not None:
+                fixed_scaled, moving_scaled, scale_factor = sift_inputs
+                sift_inputs = (fixed_scaled, prealign_moving(moving_scaled, initial_transform, fixed_scaled.shape, scale=scale_factor), scale_factor)
+            if sift_inputs is None or refine:
+                moving = prealign_moving(moving, initial_transform, fixed.shape, tile_size=tile_size)
+            record.arrays(moving=moving)
+        # the moving tissue mask no longer lies in the frame of the resampled image
+        moving_tissue = None
+
+    if sift_inputs is not None:
+        fixed_scaled, moving_scaled, scale_factor = sift_inputs
+        [moving_matches, fixed_matches, ransac_model] = features_with_SIFT(fixed_scaled, moving_scaled, scale_factor=scale_factor, prescaled=True, fixed_features=fixed_features, matcher=matcher, profiler=profiler, sift_workers=sift_workers, sift_backend=sift_backend, sift_tile_size=sift_tile_size, feature_tform=feature_tform, ransac_method=ransac_method, seed=seed, fixed_tissue=fixed_tissue, moving_tissue=moving_tissue, return_model=True)
+    else:
+        scale_factor = fixed_features.scale_factor if fixed_features is not None else sift_scale_factor(fixed.shape)
+        [moving_matches, fixed_matches, ransac_model] = features_with_SIFT(fixed, moving, scale_factor=scale_factor, fixed_features=fixed_features, matcher=matcher, profiler=profiler, sift_workers=sift_workers, sift_backend=sift_backend, sift_tile_size=sift_tile_size, feature_tform=feature_tform, ransac_method=ransac_method, seed=seed, fixed_tissue=fixed_tissue, moving_tissue=moving_tissue, return_model=True)
 
     num_matches = moving_matches.shape[0]
 
     if num_matches < 3:
         raise ValueError(f"At least three matching points are required for initial feature based registration, only {num_matches} found.")
-    
+
+    # the TRE points are held out before any fitting, including the refinement
     num_tre_points = min(6, num_matches - 3, num_matches // 2)
-    all_idx = set(range(num_matches))
-    tre_idx = random.sample(range(num_matches), num_tre_points)
-    other_idx = list(all_idx - set(tre_idx))
-    moving_pts_for_reg, fixed_pts_for_reg = moving_matches[other_idx], fixed_matches[other_idx]
+    held_out = np.zeros(num_matches, dtype=bool)
+    held_out[random.Random(seed).sample(range(num_matches), num_tre_points)] = True
+
+    # refine the coarse SIFT matches at progressively finer levels
+    if refine:
+        with profile_stage(profiler, "refine"):
+            [moving_matches, fixed_matches, held_out] = refine_matches_multiscale(fixed, moving, moving_matches, fixed_matches, feature_tform, scale_factor, held_out=held_out)
+
+    moving_pts_for_reg, fixed_pts_for_reg = moving_matches[~held_out], fixed_matches[~held_out]
+
+    # the RANSAC model is used as it is unless its points changed: it also fits the held out TRE points, so with any held out
+    # (or refined) it is fitted again on the remaining points only; the 'skimage' model is always affine
+    if num_tre_points == 0 and not refine and ransac_method != "skimage":
+        tform = ransac_model
+    else:
+        tform = estimate_transform(feature_tform, moving_pts_for_reg, fixed_pts_for_reg)
+
+    # back to the moving image: matches through the inverse pre-alignment, the transformation composed with it
+    if initial_transform is not None:
+        moving_matches = ProjectiveTransform(matrix=np.linalg.inv(initial_transform))(moving_matches)
+        moving_pts_for_reg = moving_matches[~held_out]
+        transform_class = ProjectiveTransform if feature_tform == "projective" else AffineTransform
+        tform = transform_class(matrix=tform.params @ initial_transform)
 
-    tform = estimate_transform(feature_tform, src=moving_pts_for_reg, dst=fixed_pts_for_reg)
-    aligned_moving = warp(moving, tform.inverse, output_shape=fixed.shape)
+    # without the full resolution images (SIFT on pyramid levels only) there is nothing to warp here
+    aligned_moving = None
+    if fixed is not None:
+        with profile_stage(profiler, "warp_preprocessed") as record:
+            if tile_size is not None:
+                aligned_moving = warp_tiled(moving_original, tform, fixed.shape, tile_size=tile_size, tissue=fixed_tissue)
+            else:
+                aligned_moving = warp(moving_original, tform.inverse, output_shape=fixed.shape)
+            record.arrays(aligned_moving=aligned_moving)
 
-    return tform, aligned_moving, [moving_matches[tre_idx], fixed_matches[tre_idx]], [moving_pts_for_reg, fixed_pts_for_reg]
+    return tform, aligned_moving, [moving_matches[held_out], fixed_matches[held_out]], [moving_pts_for_reg, fixed_pts_for_reg]
 
 
 
-def register_DAPI_HnE(fixed, moving, feature_tform='similarity'):
+def register_DAPI_HnE(fixed, moving, feature_tform='similarity', tile_size=None, sift_inputs=None, fixed_features=None, refine=False, matcher="brute", profiler=None, sift_workers=None, sift_backend="thread", sift_tile_size=None, ransac_method="skimage", fixed_tissue=None, moving_tissue=None, initial_transform=None, seed=None):
 
-    tform_map, moving_img_aligned, [moving_tre_pts, fixed_tre_pts], [moving_reg_pts, fixed_reg_pts] = register_feature_based(fixed, moving, feature_tform)
+    tform_map, moving_img_aligned, [moving_tre_pts, fixed_tre_pts], [moving_reg_pts, fixed_reg_pts] = register_feature_based(fixed, moving, feature_tform, tile_size=tile_size, sift_inputs=sift_inputs, fixed_features=fixed_features, refine=refine, matcher=matcher, profiler=profiler, sift_workers=sift_workers, sift_backend=sift_backend, sift_tile_size=sift_tile_size, ransac_method=ransac_method, fixed_tissue=fixed_tissue, moving_tissue=moving_tissue, initial_transform=initial_transform, seed=seed)
 
     print('Feature based registration completed.')
 
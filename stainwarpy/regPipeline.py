@@ -1,42 +1,200 @@
-from skimage.transform import warp
-from .preprocess import load_and_scale_images, colour_deconvolusion_preprocessing_HnE, extract_channel
-from .reg import register_DAPI_HnE
+import os
+import json
+import random
+import numpy as np
+from tifffile import imwrite
+from skimage.transform import warp, AffineTransform
+from skimage.util import img_as_float
+from .preprocess import load_and_scale_images, load_image_data, colour_deconvolusion_preprocessing_HnE, extract_channel, resolve_pixel_sizes, load_downsampled, LazyImage, scaled_shape
+from .reg import register_DAPI_HnE, transform_seg_mask, sift_scale_factor, scale_for_SIFT, detect_SIFT, SIFT_N_OCTAVES, SIFT_N_SCALES
 from .metrics import compute_TRE, compute_mutual_information
+from .tiling import warp_tiled, warp_to_tiff
+from .writer import write_pyramidal_ome_tiff, warp_tile_reader
+from .profiling import profile_stage
+from .tissue import detect_tissue
+from .prealign import estimate_prealignment, needs_prealignment, PREALIGN_MODES
+from .artifact import TransformArtifact, load_transform
+from .masks import transform_centroids, transform_contours, save_centroids_csv, save_contours_geojson
+
+
+PROFILE_NAME = "registration_profile.json"
+TRANSFORM_NAME = "transform.json"
 
-def registration_pipeline(fixed_path, moving_path, fixed_px_sz, moving_px_sz, fixed_img, feature_tform='similarity'):
-    
-    # load and scale images 
-    fixed_init, moving_init = load_and_scale_images(fixed_path, moving_path, fixed_px_sz, moving_px_sz)
-    print("Images loaded.")
+
+def preprocess_images(fixed_init, moving_init, fixed_img, fast_deconvolution=False):
 
     # preprocess HnE image
     if fixed_img == 'multiplexed':
-        moving_prepr = colour_deconvolusion_preprocessing_HnE(moving_init)
+        moving_prepr = colour_deconvolusion_preprocessing_HnE(moving_init, fast=fast_deconvolution)
         fixed_prepr = fixed_init
     elif fixed_img == 'hne':
-        fixed_prepr = colour_deconvolusion_preprocessing_HnE(fixed_init)
+        fixed_prepr = colour_deconvolusion_preprocessing_HnE(fixed_init, fast=fast_deconvolution)
         if len(moving_init.shape) == 2:
             moving_prepr = moving_init
         else:
             moving_prepr = extract_channel(moving_init, 0)
     else:
         raise ValueError("fixed_img must be either 'multiplexed' or 'hne'")
-    print("Preprocessing completed.")
+
+    return fixed_prepr, moving_prepr
+
+
+
+def load_sift_inputs(fixed_path, moving_path, fixed_px_sz, moving_px_sz, fixed_img, fast_deconvolution=False):
+
+    # read both images at the SIFT resolution from their pyramid levels
+    fixed_px_sz, moving_px_sz = resolve_pixel_sizes(fixed_path, moving_path, fixed_px_sz, moving_px_sz)
+    scale = moving_px_sz / fixed_px_sz
+
+    with LazyImage(fixed_path) as fixed_lazy, LazyImage(moving_path) as moving_lazy:
+        fixed_shape, moving_shape = fixed_lazy.shape, moving_lazy.shape
+
+    fixedX, fixedY = scaled_shape(fixed_shape, scale)
+    scale_factor = sift_scale_factor((fixedX, fixedY))
+
+    # same value range as load_and_scale_images produces for the full image
+    fixed_low = img_as_float(load_downsampled(fixed_path, (fixedX // scale_factor, fixedY // scale_factor)))
+    if fixed_low.ndim == 3 and fixed_low.shape[2] > 3:
+        fixed_low = extract_channel(fixed_low, 0)
+    fixed_low = fixed_low*255
+
+    moving_low = load_downsampled(moving_path, (moving_shape[0] // scale_factor, moving_shape[1] // scale_factor))
+
+    fixed_prepr_low, moving_prepr_low = preprocess_images(fixed_low, moving_low, fixed_img, fast_deconvolution)
+
+    return fixed_prepr_low, moving_prepr_low, scale_factor
+
+
+
+def cached_fixed_features(feature_cache, fixed_path, fixed_prepr, sift_inputs, fixed_img, fast_deconvolution, shape=None):
+
+    if sift_inputs is not None:
+        fixed_image, _, scale_factor = sift_inputs
+        prescaled = True
+    else:
+        fixed_image, scale_factor, prescaled = fixed_prepr, sift_scale_factor(fixed_prepr.shape), False
+
+    # everything that changes the detected features is part of the key
+    key = feature_cache.key(fixed_path, shape=fixed_prepr.shape if shape is None else shape, scale_factor=scale_factor, pyramid=prescaled,
+                            fixed_img=fixed_img, fast_deconvolution=fast_deconvolution,
+                            n_octaves=SIFT_N_OCTAVES, n_scales=SIFT_N_SCALES)
+
+    features = feature_cache.get(key)
+    if features is None:
+        features = detect_SIFT(scale_for_SIFT(fixed_image, scale_factor, prescaled), scale_factor)
+        feature_cache.put(key, features)
+        print("Fixed image features computed and cached.")
+    else:
+        print("Fixed image features loaded from cache.")
+
+    return features
+
+
+
+def registration_pipeline(fixed_path, moving_path, fixed_px_sz, moving_px_sz, fixed_img, feature_tform='similarity', tile_size=None, output_path=None, use_pyramid=False, fast_deconvolution=False, feature_cache=None, refine=False, matcher="brute", mi_sample_size=None, ome_tiff=False, compression="zlib", profiler=None, channel_workers=None, fast_load=False, sift_workers=None, sift_backend="thread", sift_tile_size=None, ransac_method="skimage", tissue_mask=False, prealign="off", seed=None):
+
+    if prealign not in PREALIGN_MODES:
+        raise ValueError(f"Invalid pre-alignment mode. Use one of {list(PREALIGN_MODES)}.")
+
+    # the seed of the TRE point split and the RANSAC sampling is saved with the transformation, so a registration can be repeated exactly
+    if seed is None:
+        seed = random.randrange(2**32)
+    
+    # with SIFT on pyramid levels the full resolution images are only decoded where they are needed:
+    # by the refinement, and by the warp, which reads the moving image window by window when tiled
+    full_resolution = not use_pyramid or refine
+
+    # load and scale images (profiled as the decode and resize stages)
+    fixed_px_sz, moving_px_sz = resolve_pixel_sizes(fixed_path, moving_path, fixed_px_sz, moving_px_sz)
+    if full_resolution:
+        fixed_init, moving_init = load_and_scale_images(fixed_path, moving_path, fixed_px_sz, moving_px_sz, fast=fast_load, profiler=profiler)
+        fixed_shape, moving_shape = fixed_init.shape, moving_init.shape
+    else:
+        fixed_init = moving_init = fixed_prepr = moving_prepr = None
+        with LazyImage(fixed_path) as fixed_lazy, LazyImage(moving_path) as moving_lazy:
+            fixed_shape, moving_shape = scaled_shape(fixed_lazy.shape, moving_px_sz / fixed_px_sz), moving_lazy.shape
+    print("Images loaded." if full_resolution else "Image shapes read.")
+
+    if full_resolution:
+        with profile_stage(profiler, "preprocess") as record:
+            fixed_prepr, moving_prepr = preprocess_images(fixed_init, moving_init, fixed_img, fast_deconvolution)
+            record.arrays(fixed=fixed_prepr, moving=moving_prepr)
+        print("Preprocessing completed.")
+
+    h, w = fixed_shape[:2]
+
+    # SIFT on existing low resolution pyramid levels instead of resizing the full images
+    sift_inputs = None
+    if use_pyramid:
+        with profile_stage(profiler, "pyramid_sift_inputs") as record:
+            sift_inputs = load_sift_inputs(fixed_path, moving_path, fixed_px_sz, moving_px_sz, fixed_img, fast_deconvolution)
+            record.arrays(fixed=sift_inputs[0], moving=sift_inputs[1])
+
+    # low resolution tissue masks of both images, used to skip background in feature detection, warping and metrics
+    fixed_tissue = moving_tissue = None
+    if tissue_mask:
+        with profile_stage(profiler, "tissue") as record:
+            # DAPI and the preprocessed hematoxylin channel are both bright on tissue
+            if full_resolution:
+                fixed_tissue = detect_tissue(fixed_prepr)
+                moving_tissue = detect_tissue(moving_prepr)
+            else:
+                fixed_tissue = detect_tissue(sift_inputs[0], scale=sift_inputs[2])
+                moving_tissue = detect_tissue(sift_inputs[1], scale=sift_inputs[2])
+            record["fixed_coverage"], record["moving_coverage"] = fixed_tissue.coverage, moving_tissue.coverage
+        print(f"Tissue detected: {fixed_tissue.coverage:.1%} of the fixed image, {moving_tissue.coverage:.1%} of the moving image.")
+
+    # rotation, mirroring and translation searched on thumbnails, seeding the feature registration of rotated or mirrored sections
+    initial_transform = None
+    if prealign != "off":
+        with profile_stage(profiler, "prealign") as record:
+            if sift_inputs is not None:
+                prealignment = estimate_prealignment(sift_inputs[0], sift_inputs[1], scale=sift_inputs[2])
+            else:
+                prealignment = estimate_prealignment(fixed_prepr, moving_prepr)
+            record["angle"], record["flip"], record["score"] = prealignment.angle, prealignment.flip, prealignment.score
+        if prealign == "on" or needs_prealignment(prealignment):
+            initial_transform = prealignment.matrix
+        print(f"Pre-alignment: rotation {prealignment.angle:.1f} deg{', mirrored' if prealignment.flip else ''}, {'applied' if initial_transform is not None else 'not needed'}.")
+
+    # fixed image features are detected once per slide and reused from the cache
+    fixed_features = None
+    if feature_cache is not None:
+        with profile_stage(profiler, "fixed_features"):
+            fixed_features = cached_fixed_features(feature_cache, fixed_path, fixed_prepr, sift_inputs, fixed_img, fast_deconvolution,
+                                                   shape=fixed_prepr.shape if fixed_prepr is not None else (h, w))
     
     
     # registration
-    if len(fixed_init.shape) == 2:
-        h, w = fixed_init.shape
-    else:
-        h, w, c = fixed_init.shape
+    transformation_maps, registered_imgs, tre_pts = register_DAPI_HnE(fixed_prepr, moving_prepr, feature_tform, tile_size=tile_size, sift_inputs=sift_inputs, fixed_features=fixed_features, refine=refine, matcher=matcher, profiler=profiler,
+                                                                       sift_workers=sift_workers, sift_backend=sift_backend, sift_tile_size=sift_tile_size, ransac_method=ransac_method,
+                                                                       fixed_tissue=fixed_tissue, moving_tissue=moving_tissue, initial_transform=initial_transform,
+                                                                       seed=seed)
 
-    transformation_maps, registered_imgs, tre_pts = register_DAPI_HnE(fixed_prepr, moving_prepr, feature_tform)
-    moved_img = warp(moving_init, transformation_maps.inverse, output_shape=(h, w, moving_init.shape[2]) if len(moving_init.shape) == 3 else (h, w))
+    # moving px -> px of the fixed image resampled to the moving pixel size (the frame of the registered image)
+    transform = TransformArtifact(transformation_maps.params, feature_tform, moving_shape[:2], (h, w), moving_px_sz, moving_px_sz, seed=seed,
+                                  metadata={"fixed_path": fixed_path, "moving_path": moving_path, "fixed_img": fixed_img, "fixed_pixel_size": fixed_px_sz,
+                                            "ransac_method": ransac_method, "refine": refine, "prealign": initial_transform is not None})
+
+    with profile_stage(profiler, "warp") as record:
+        if moving_init is None and (tile_size is not None or ome_tiff):
+            with LazyImage(moving_path) as moving_lazy:
+                moved_img = warp_moving_image(fixed_path, moving_path, fixed_px_sz, moving_px_sz, moving_lazy.data(), transformation_maps, (h, w),
+                                              tile_size=tile_size, output_path=output_path, ome_tiff=ome_tiff, compression=compression,
+                                              channel_workers=channel_workers, tissue=fixed_tissue)
+        else:
+            if moving_init is None:
+                moving_init = load_image_data(moving_path)
+            moved_img = warp_moving_image(fixed_path, moving_path, fixed_px_sz, moving_px_sz, moving_init, transformation_maps, (h, w),
+                                          tile_size=tile_size, output_path=output_path, ome_tiff=ome_tiff, compression=compression,
+                                          channel_workers=channel_workers, tissue=fixed_tissue)
+        record.arrays(moved_img=moved_img)
 
 
     # evaluate registration with metrics
     try:
-        tre = compute_TRE(transformation_maps, tre_pts, fixed_prepr)
+        with profile_stage(profiler, "tre"):
+            tre = compute_TRE(transformation_maps, tre_pts, (h, w))
     except ValueError as e:
         print("TRE computation skipped:", e)
         tre = None  
@@ -45,11 +203,136 @@ def registration_pipeline(fixed_path, moving_path, fixed_px_sz, moving_px_sz, fi
         tre = None
 
     try:
-        mi = compute_mutual_information(fixed_prepr, moving_prepr, registered_imgs)
+        with profile_stage(profiler, "mutual_information"):
+            if full_resolution:
+                mi_mask = fixed_tissue.full(fixed_prepr.shape) if fixed_tissue is not None else None
+                mi = compute_mutual_information(fixed_prepr, moving_prepr, registered_imgs, mask=mi_mask, sample_size=mi_sample_size, seed=seed)
+            else:
+                # without the full resolution images the mutual information is computed at the SIFT resolution
+                fixed_low, moving_low, scale_factor = sift_inputs
+                low_transform = transform.at_pixel_size(moving_px_sz * scale_factor, moving_px_sz * scale_factor)
+                registered_low = warp(moving_low, low_transform.tform.inverse, output_shape=fixed_low.shape)
+                mi_mask = fixed_tissue.scaled(scale_factor, fixed_low.shape).full() if fixed_tissue is not None else None
+                mi = compute_mutual_information(fixed_low, moving_low, registered_low, mask=mi_mask, sample_size=mi_sample_size, seed=seed)
     except Exception as e:
         print("An unexpected error occurred during mutual information computation:", e)
         mi = None
 
-    return transformation_maps, moved_img, tre, mi
+    return transform, moved_img, tre, mi
+
+
+
+def warp_moving_image(fixed_path, moving_path, fixed_px_sz, moving_px_sz, moving_init, transformation_maps, output_shape, tile_size=None, output_path=None, ome_tiff=False, compression="zlib", channel_workers=None, tissue=None):
+
+    h, w = output_shape
+
+    if ome_tiff:
+        if output_path is None:
+            raise ValueError("output_path must be provided for OME-TIFF output.")
+
+        # tiled, compressed, multi-resolution OME-TIFF in the pixel size of the moving image
+        _, moving_px = resolve_pixel_sizes(fixed_path, moving_path, fixed_px_sz, moving_px_sz)
+        with LazyImage(moving_path) as moving_lazy:
+            channel_names = moving_lazy.channel_names
+        output_shape = (h, w) + moving_init.shape[2:]
+        if channel_names is not None and len(channel_names) != (output_shape[2] if len(output_shape) == 3 else 1):
+            channel_names = None
+
+        write_pyramidal_ome_tiff(output_path, warp_tile_reader(moving_init, transformation_maps, tissue=tissue), output_shape, moving_init.dtype,
+                                 channel_names=channel_names, pixel_size=moving_px, tile_size=tile_size or 512, compression=compression)
+        moved_img = None
+    elif tile_size is None:
+        moved_img = warp(moving_init, transformation_maps.inverse, output_shape=(h, w, moving_init.shape[2]) if len(moving_init.shape) == 3 else (h, w))
+    elif output_path is not None:
+        # stream the registered image tile by tile to disk
+        warp_to_tiff(output_path, moving_init, transformation_maps, (h, w), tile_size=tile_size, channel_workers=channel_workers, tissue=tissue)
+        moved_img = None
+    else:
+        moved_img = warp_tiled(moving_init, transformation_maps, (h, w), tile_size=tile_size, channel_workers=channel_workers, tissue=tissue)
+
+    return moved_img
+
+
+
+def registered_image_path(output_folder, ome_tiff=False):
+    return os.path.join(output_folder, "0_final_channel_image.ome.tif" if ome_tiff else "0_final_channel_image.tif")
+
+
+
+def save_registration_outputs(output_folder, transformation_map, final_img, tre, mi, final_img_path=None):
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    # save registration metrics
+    metrics_output_path = os.path.join(output_folder, "registration_metrics.json")
+
+    with open(metrics_output_path, "w") as f:
+        json.dump({"TRE": tre, "Mutual Information": mi}, f)
+    print(f"Registration metrics saved to {metrics_output_path}")
+
+    # save registered image (already streamed to disk in tiled mode)
+    final_img_path = registered_image_path(output_folder) if final_img_path is None else final_img_path
+    if final_img is not None:
+        imwrite(final_img_path, final_img)
+
+    print(f"Registered image saved to {final_img_path}")
+
+    # save transformation map, as the raw matrix and as a transform artifact that also describes the frames it maps between
+    np.save(os.path.join(output_folder, "feature_based_transformation_map.npy"), transformation_map.params)
+    transformation_map.save(os.path.join(output_folder, TRANSFORM_NAME))
+
+    print(f"Transformation maps saved to {output_folder}/feature_based_transformation_map.npy and {output_folder}/{TRANSFORM_NAME}")
+
+
+
+def transform_seg_mask_files(mask_path, fixed_path, output_folder_path, tform_map_path, moving_px_sz, fixed_px_sz=None, tile_size=None, mode=None, centroids=False, contours=False):
+
+    # load mask
+    mask = np.load(mask_path) # will need to change according to mask format
+    print(f"Loaded segmentation mask.")
+
+    if tform_map_path.endswith(".json"):
+        # the artifact describes the registered frame, so the fixed image is not opened; masks at another pixel size than the registered moving image are rescaled
+        transform = load_transform(tform_map_path).at_pixel_size(source_pixel_size=moving_px_sz)
+        transformation_maps, fixed_img_shape = transform.tform, transform.target_shape
+        print("Loaded transform artifact.")
+    else:
+        if fixed_path is None:
+            raise ValueError("fixed_path must be provided with a .npy transformation map, only a transform artifact (.json) describes the fixed frame.")
+
+        # load and create transformation parameter objects
+        transformation_maps= AffineTransform(matrix=np.load(os.path.join(tform_map_path)))
+
+        print("Loaded transformation map.")
+
+        # only the shape of the fixed image is needed, no pixels are decoded
+        with LazyImage(fixed_path) as fixed_lazy:
+            fixed_shape = fixed_lazy.shape
+            if fixed_px_sz is None:
+                fixed_px_sz = fixed_lazy.pixel_size
+
+        if fixed_px_sz is None:
+            raise ValueError("Pixel size information not found in metadata for fixed image. Please provide fixed_px_sz.")
+
+        fixed_img_shape = scaled_shape(fixed_shape, moving_px_sz / fixed_px_sz)
+
+    moved_mask = transform_seg_mask(mask, transformation_maps, output_shape=fixed_img_shape, tile_size=tile_size, mode=mode)
+
+    os.makedirs(output_folder_path, exist_ok=True)
+    outputs = {"mask": os.path.join(output_folder_path, "transformed_segmentation_mask.npy")}
+    np.save(outputs["mask"], moved_mask)
+    print(f"Transformed segmentation mask saved to {output_folder_path}/transformed_segmentation_mask.npy")
+
+    # objects as point sets, in the same coordinates as the transformed mask
+    if centroids:
+        labels, points = transform_centroids(mask, transformation_maps)
+        outputs["centroids"] = os.path.join(output_folder_path, "transformed_centroids.csv")
+        save_centroids_csv(outputs["centroids"], labels, points)
+        print(f"Transformed centroids saved to {output_folder_path}/transformed_centroids.csv")
 
+    if contours:
+        outputs["contours"] = os.path.join(output_folder_path, "transformed_contours.geojson")
+        save_contours_geojson(outputs["contours"], transform_contours(mask, transformation_maps))
+        print(f"Transformed contours saved to {output_folder_path}/transformed_contours.geojson")
 
+    return outputs
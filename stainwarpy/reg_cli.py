@@ -1,12 +1,8 @@
 import typer
 import os
-import numpy as np
-import json
-from tifffile import imwrite
-from skimage.transform import AffineTransform, resize
-from .regPipeline import registration_pipeline
-from .preprocess import extract_channel, load_image_data
-from .reg import transform_seg_mask
+from typing import List
+
+# the modules of each command are imported inside it, so --help and light commands do not load skimage and scipy
 
 
 app = typer.Typer(help="Register H&E stained images to multiplexed images using a feature based registration pipeline.")
@@ -20,8 +16,37 @@ def register(
     fixed_img: str = typer.Argument(..., help="Type of fixed image: ['multiplexed', 'hne']"),
     fixed_px_sz: float = typer.Option(None, help="Pixel size of the fixed image (if image is not .ome.tif)"),
     moving_px_sz: float = typer.Option(None, help="Pixel size of the moving image (if image is not .ome.tif)"),
-    feature_tform: str = typer.Option('similarity', help="Feature transformation method ['similarity', 'affine', 'projective']. 'similarity' by default and recommended.", show_default=True)
+    feature_tform: str = typer.Option('similarity', help="Feature transformation method ['similarity', 'affine', 'projective']. 'similarity' by default and recommended.", show_default=True),
+    tile_size: int = typer.Option(None, help="Warp the registered image tile by tile with this tile size (multiple of 16) and stream it to a tiled TIFF, keeping the input dtype"),
+    use_pyramid: bool = typer.Option(False, "--use-pyramid", help="Detect features on existing low resolution pyramid levels of the images instead of resizing the full resolution images"),
+    fast_deconv: bool = typer.Option(False, "--fast-deconv", help="Chunked float32 colour deconvolution of the hematoxylin channel only (lower memory, equal within rounding)"),
+    feature_cache: str = typer.Option(None, help="Folder of a persistent cache of fixed image SIFT features, reused when the same fixed image is registered again"),
+    feature_cache_size_mb: int = typer.Option(1024, help="Maximum size of the feature cache in MB, least recently used entries are evicted", show_default=True),
+    refine: bool = typer.Option(False, "--refine", help="Refine the SIFT matches coarse-to-fine up to full resolution by matching small windows around the predicted positions"),
+    matcher: str = typer.Option('brute', help="Descriptor matcher ['brute', 'blockwise', 'kdtree']. 'blockwise' is exact with bounded memory, 'kdtree' is approximate and fastest for very large keypoint sets", show_default=True),
+    mi_sample_size: int = typer.Option(None, help="Estimate mutual information from this many randomly sampled pixels and report a 95% confidence interval instead of using every pixel"),
+    ome_tiff: bool = typer.Option(False, "--ome-tiff", help="Write the registered image as a tiled, zlib compressed, multi-resolution OME-TIFF with channel names and pixel size, generated tile by tile"),
+    compression: str = typer.Option('zlib', help="Compression of the OME-TIFF output ['zlib', 'zstd', 'none']", show_default=True),
+    channel_workers: int = typer.Option(None, help="Warp the channels of each tile with this many threads (with --tile-size)"),
+    fast_load: bool = typer.Option(False, "--fast-load", help="Scale the fixed image with a threaded box filter from its closest pyramid level, reading only the registration channel"),
+    sift_workers: int = typer.Option(None, help="Detect SIFT features on the fixed and moving images (and their tiles) concurrently with this many workers"),
+    sift_backend: str = typer.Option('thread', help="Pool of the concurrent SIFT detection ['thread', 'process']", show_default=True),
+    sift_tile_size: int = typer.Option(None, help="Detect SIFT features in overlapping tiles of this size (in px of the downscaled SIFT images)"),
+    ransac: str = typer.Option('skimage', help="Outlier rejection of the matches ['skimage', 'prosac', 'uniform']. 'skimage' is the fixed 1000 trial affine RANSAC of scikit-image, 'prosac' and 'uniform' fit the requested transformation with batched, early stopping RANSAC", show_default=True),
+    tissue_mask: bool = typer.Option(False, "--tissue-mask", help="Detect the tissue at low resolution and skip background glass in feature detection, warping and the mutual information"),
+    prealign: str = typer.Option('off', help="Search the rotation and mirroring of the moving image on thumbnails and seed the feature registration with it ['off', 'on', 'auto']. 'auto' only applies it to mirrored sections or rotations beyond 10 degrees", show_default=True),
+    seed: int = typer.Option(None, help="Seed of the TRE point split, RANSAC and mutual information sampling; a random seed is drawn and saved to transform.json if not given"),
+    profile: bool = typer.Option(False, "--profile", help="Record wall time, CPU time, memory and array sizes of every pipeline stage to registration_profile.json"),
+    profile_stage: str = typer.Option(None, help="Run cProfile on this stage (e.g. 'sift_fixed', 'matching', 'warp') and save the stats to the output folder")
 ):
+    from .regPipeline import registration_pipeline, save_registration_outputs, registered_image_path, PROFILE_NAME
+    from .cache import FeatureCache
+    from .profiling import StageProfiler
+
+    os.makedirs(output_folder, exist_ok=True)
+    final_img_path = registered_image_path(output_folder, ome_tiff)
+    profiler = StageProfiler(profile_stage=profile_stage, profile_dir=output_folder) if profile or profile_stage is not None else None
+
     # run the pipeline
     transformation_map, final_img, tre, mi = registration_pipeline(
         fixed_path,
@@ -29,29 +54,95 @@ def register(
         fixed_px_sz,
         moving_px_sz,
         fixed_img,
-        feature_tform=feature_tform
+        feature_tform=feature_tform,
+        tile_size=tile_size,
+        output_path=final_img_path if tile_size is not None or ome_tiff else None,
+        use_pyramid=use_pyramid,
+        fast_deconvolution=fast_deconv,
+        feature_cache=FeatureCache(feature_cache, feature_cache_size_mb) if feature_cache is not None else None,
+        refine=refine,
+        matcher=matcher,
+        mi_sample_size=mi_sample_size,
+        ome_tiff=ome_tiff,
+        compression=None if compression == 'none' else compression,
+        profiler=profiler,
+        channel_workers=channel_workers,
+        fast_load=fast_load,
+        sift_workers=sift_workers,
+        sift_backend=sift_backend,
+        sift_tile_size=sift_tile_size,
+        ransac_method=ransac,
+        tissue_mask=tissue_mask,
+        prealign=prealign,
+        seed=seed
     )
 
-    os.makedirs(output_folder, exist_ok=True)
-
-    # save registration metrics
-    metrics_output_path = os.path.join(output_folder, "registration_metrics.json")
-
-    with open(metrics_output_path, "w") as f:
-        json.dump({"TRE": tre, "Mutual Information": mi}, f)
-    print(f"Registration metrics saved to {metrics_output_path}")
-
-    # save registered image
-    final_img_path = os.path.join(output_folder, "0_final_channel_image.tif")
-    imwrite(final_img_path, final_img)
-
-    print(f"Registered image saved to {final_img_path}")
-
-    # save transformation map
-
-    np.save(os.path.join(output_folder, f"feature_based_transformation_map.npy"), transformation_map.params)
+    save_registration_outputs(output_folder, transformation_map, final_img, tre, mi, final_img_path)
+
+    if profiler is not None:
+        profiler.save(os.path.join(output_folder, PROFILE_NAME))
+
+
+
+@app.command(name="register-batch")
+def register_batch_cmd(
+    manifest_path: str = typer.Argument(..., help="Path to a .csv/.json manifest with fixed_path, moving_path and optionally pair_id, fixed_px_sz, moving_px_sz, fixed_img"),
+    output_folder: str = typer.Argument(..., help="Folder to save the per-pair outputs, the completed-pairs ledger and the aggregated metrics table"),
+    fixed_img: str = typer.Argument(..., help="Type of fixed image for pairs that do not set it: ['multiplexed', 'hne']"),
+    workers: int = typer.Option(1, help="Number of worker processes", show_default=True),
+    max_memory_mb: int = typer.Option(None, help="Memory budget per worker process in MB"),
+    feature_tform: str = typer.Option('similarity', help="Feature transformation method ['similarity', 'affine', 'projective']. 'similarity' by default and recommended.", show_default=True),
+    tile_size: int = typer.Option(None, help="Warp the registered images tile by tile with this tile size (multiple of 16)"),
+    use_pyramid: bool = typer.Option(False, "--use-pyramid", help="Detect features on existing low resolution pyramid levels of the images"),
+    fast_deconv: bool = typer.Option(False, "--fast-deconv", help="Chunked float32 colour deconvolution of the hematoxylin channel only"),
+    feature_cache: str = typer.Option(None, help="Folder of a persistent cache of fixed image SIFT features shared by all workers"),
+    feature_cache_size_mb: int = typer.Option(1024, help="Maximum size of the feature cache in MB", show_default=True),
+    refine: bool = typer.Option(False, "--refine", help="Refine the SIFT matches coarse-to-fine up to full resolution"),
+    matcher: str = typer.Option('brute', help="Descriptor matcher ['brute', 'blockwise', 'kdtree']", show_default=True),
+    mi_sample_size: int = typer.Option(None, help="Estimate mutual information from this many randomly sampled pixels"),
+    ome_tiff: bool = typer.Option(False, "--ome-tiff", help="Write the registered images as tiled, compressed, multi-resolution OME-TIFFs"),
+    compression: str = typer.Option('zlib', help="Compression of the OME-TIFF outputs ['zlib', 'zstd', 'none']", show_default=True),
+    channel_workers: int = typer.Option(None, help="Warp the channels of each tile with this many threads per worker (with --tile-size)"),
+    fast_load: bool = typer.Option(False, "--fast-load", help="Scale the fixed images with a box filter from their closest pyramid level"),
+    sift_workers: int = typer.Option(None, help="Detect SIFT features concurrently with this many workers per pair"),
+    sift_backend: str = typer.Option('thread', help="Pool of the concurrent SIFT detection ['thread', 'process']", show_default=True),
+    sift_tile_size: int = typer.Option(None, help="Detect SIFT features in overlapping tiles of this size"),
+    ransac: str = typer.Option('skimage', help="Outlier rejection of the matches ['skimage', 'prosac', 'uniform']", show_default=True),
+    tissue_mask: bool = typer.Option(False, "--tissue-mask", help="Skip background glass in feature detection, warping and the mutual information"),
+    prealign: str = typer.Option('off', help="Seed the feature registration with a thumbnail rotation and mirroring search ['off', 'on', 'auto']", show_default=True),
+    seed: int = typer.Option(None, help="Seed of the TRE point split, RANSAC and mutual information sampling of every pair"),
+    profile: bool = typer.Option(False, "--profile", help="Save a per-stage profile of every pair to its output folder")
+):
+    from .batch import register_batch
+    from .cache import FeatureCache
 
-    print(f"Transformation maps saved to {output_folder}/feature_based_transformation_map.npy")
+    register_batch(
+        manifest_path,
+        output_folder,
+        fixed_img,
+        workers=workers,
+        max_memory_mb=max_memory_mb,
+        feature_tform=feature_tform,
+        tile_size=tile_size,
+        use_pyramid=use_pyramid,
+        fast_deconvolution=fast_deconv,
+        feature_cache=FeatureCache(feature_cache, feature_cache_size_mb) if feature_cache is not None else None,
+        refine=refine,
+        matcher=matcher,
+        mi_sample_size=mi_sample_size,
+        ome_tiff=ome_tiff,
+        compression=None if compression == 'none' else compression,
+        channel_workers=channel_workers,
+        fast_load=fast_load,
+        sift_workers=sift_workers,
+        sift_backend=sift_backend,
+        sift_tile_size=sift_tile_size,
+        ransac_method=ransac,
+        tissue_mask=tissue_mask,
+        prealign=prealign,
+        seed=seed,
+        profile=profile
+    )
 
 
 
@@ -59,59 +150,100 @@ def register(
 def extract_channel_cmd(
     file_path: str = typer.Argument(..., help="Path to the input image (.tif/.tiff/.ome.tif/.ome.tiff)"),
     output_folder_path: str = typer.Argument(..., help="Folder to save the image with extracted channel"),
-    channel_idx: int = typer.Option(0, help="Channel index to extract (Default = 0 for DAPI)", show_default=True),
+    channel_idx: List[int] = typer.Option([0], help="Channel index to extract (Default = 0 for DAPI), repeat to extract several channels in one pass", show_default=True),
+    tile_size: int = typer.Option(512, help="Tile size of the output TIFFs (multiple of 16)", show_default=True),
+    compression: str = typer.Option('zlib', help="Compression of the output TIFFs ['zlib', 'zstd', 'none']", show_default=True),
 ):
-    img = load_image_data(file_path)
-    img_ch = extract_channel(img, channel_idx)
+    from .writer import extract_channels
 
-    os.makedirs(output_folder_path, exist_ok=True)
-    img_path = os.path.join(output_folder_path, f"multiplexed_channel_{channel_idx}.tif")
-    imwrite(img_path, img_ch)
-    print(f"Image with extracted channel saved to {img_path}")
+    for img_path in extract_channels(file_path, output_folder_path, channel_idx, tile_size=tile_size, compression=None if compression == 'none' else compression):
+        print(f"Image with extracted channel saved to {img_path}")
 
 
 
 @app.command(name="transform-seg-mask")
 def transform_seg_mask_cmd(
     mask_path: str = typer.Argument(..., help="Path to the segmentation mask of the moving image (.npy)"),
-    fixed_path: str = typer.Argument(..., help="Path to the fixed image (.tif/.tiff/.ome.tif/.ome.tiff)"),
-    output_folder_path: str = typer.Argument(..., help="Folder to save the transformed segmentation mask"),
-    tform_map_path: str = typer.Argument(..., help="Path to the transformation map"),
-    moving_px_sz: float = typer.Argument(..., help="Pixel size of the moving image"),
-    fixed_px_sz: float = typer.Option(None, help="Pixel size of the fixed image (if image is not .ome.tif)", show_default=True)
+    paths: List[str] = typer.Argument(..., metavar="[FIXED_PATH] OUTPUT_FOLDER_PATH TFORM_MAP_PATH MOVING_PX_SZ",
+                                      help="Path to the fixed image (.tif/.tiff/.ome.tif/.ome.tiff, left out with a transform artifact), folder to save the transformed segmentation mask, "
+                                           "path to the transformation map (.npy) or transform artifact (transform.json, the fixed image is then not read) and pixel size of the moving image (of the mask)"),
+    fixed_px_sz: float = typer.Option(None, help="Pixel size of the fixed image (if image is not .ome.tif)", show_default=True),
+    tile_size: int = typer.Option(None, help="Transform the mask tile by tile with this tile size, keeping the label dtype"),
+    mode: str = typer.Option(None, help="Mask transformation ['dense', 'tiled', 'objects']. 'tiled' skips tiles without objects, 'objects' maps only the bounding box of every object; both keep the label dtype. 'tiled' if --tile-size is given, 'dense' otherwise"),
+    centroids: bool = typer.Option(False, "--centroids", help="Also save the transformed object centroids to transformed_centroids.csv"),
+    contours: bool = typer.Option(False, "--contours", help="Also save the transformed object contours to transformed_contours.geojson")
 ):
-    # load mask
-    mask = np.load(mask_path) # will need to change according to mask format
-    print(f"Loaded segmentation mask.")
-
-    # load and create transformation parameter objects
-    transformation_maps= AffineTransform(matrix=np.load(os.path.join(tform_map_path)))
-
-    print("Loaded transformation map.")
-
-    fixed_init = load_image_data(fixed_path)
-
-    if fixed_px_sz is None:
-        try:
-            fixed_px_sz, _ = get_pixel_size_ome_tiff(fixed_path)
-        except Exception:
-            fixed_px_sz = None
-        
-        if fixed_px_sz is None:
-            raise ValueError("Pixel size information not found in metadata for fixed image. Please provide fixed_px_sz.")
-    
-    scale = moving_px_sz / fixed_px_sz
-    if len(fixed_init.shape) == 2:
-        fixed_init_sc = resize(fixed_init, (int(fixed_init.shape[0]/scale), int(fixed_init.shape[1]/scale)), anti_aliasing=True)
+    from .regPipeline import transform_seg_mask_files
+
+    # the fixed image is only needed with a .npy transformation map
+    if len(paths) == 4:
+        fixed_path, output_folder_path, tform_map_path, moving_px_sz = paths
+    elif len(paths) == 3 and paths[1].endswith(".json"):
+        fixed_path, (output_folder_path, tform_map_path, moving_px_sz) = None, paths
     else:
-        fixed_init_sc = resize(fixed_init, (int(fixed_init[:, :, 0].shape[0]/scale), int(fixed_init[:, :, 0].shape[1]/scale)), anti_aliasing=True)
-    fixed_img_shape = (int(fixed_init_sc.shape[0]), int(fixed_init_sc.shape[1]))
+        raise ValueError("Expected FIXED_PATH OUTPUT_FOLDER_PATH TFORM_MAP_PATH MOVING_PX_SZ, or OUTPUT_FOLDER_PATH TFORM_MAP_PATH MOVING_PX_SZ with a transform artifact (.json).")
 
-    moved_mask = transform_seg_mask(mask, transformation_maps, output_shape=fixed_img_shape)
+    transform_seg_mask_files(mask_path, fixed_path, output_folder_path, tform_map_path, float(moving_px_sz), fixed_px_sz,
+                             tile_size=tile_size, mode=mode, centroids=centroids, contours=contours)
+
+
+
+@app.command(name="transform-points")
+def transform_points_cmd(
+    input_path: str = typer.Argument(..., help="Points in moving image coordinates (.csv/.tsv/.parquet with x and y columns, or .geojson)"),
+    output_path: str = typer.Argument(..., help="Path to save the transformed points, in the same format"),
+    tform_map_path: str = typer.Argument(..., help="Path to the transformation map (.npy) or transform artifact (transform.json)"),
+    moving_px_sz: float = typer.Option(None, help="Pixel size of the moving image (read from a transform artifact if not given)"),
+    fixed_px_sz: float = typer.Option(None, help="Pixel size of the fixed image (read from a transform artifact of a registration if not given)"),
+    fixed_path: str = typer.Option(None, help="Fixed .ome.tif to read the fixed pixel size from"),
+    units: str = typer.Option('px', help="Units of the input and output coordinates ['px', 'um']", show_default=True),
+    x_col: str = typer.Option('x', help="Name of the x column of tables", show_default=True),
+    y_col: str = typer.Option('y', help="Name of the y column of tables", show_default=True),
+    batch_size: int = typer.Option(100000, help="Number of points transformed at once", show_default=True)
+):
+    from .points import transform_points_path
+
+    transform_points_path(input_path, output_path, tform_map_path, moving_px_sz, fixed_px_sz, fixed_path=fixed_path,
+                          units=units, x_col=x_col, y_col=y_col, batch_size=batch_size)
+
+
+
+@app.command(name="compose-transforms")
+def compose_transforms_cmd(
+    output_path: str = typer.Argument(..., help="Path to save the resulting transform artifact (.json)"),
+    transform_paths: List[str] = typer.Argument(..., help="Transform artifacts, applied in the given order (the target frame of each must be the source frame of the next)"),
+    invert: bool = typer.Option(False, "--invert", help="Save the inverse (fixed -> moving) of the composition"),
+    level: int = typer.Option(0, help="Express the transformation between this pyramid level of both images (every level halves the resolution)", show_default=True)
+):
+    from .artifact import load_transform, compose_transforms
+
+    transform = compose_transforms([load_transform(path) for path in transform_paths])
+    if invert:
+        transform = transform.inverse
+    if level > 0:
+        transform = transform.at_level(level)
+
+    transform.save(output_path)
+    print(f"Transform artifact saved to {output_path}")
+
+
+
+@app.command(name="serve")
+def serve_cmd(
+    host: str = typer.Option('127.0.0.1', help="Address to listen on", show_default=True),
+    port: int = typer.Option(8765, help="Port to listen on", show_default=True),
+    socket: str = typer.Option(None, help="Listen on this Unix socket instead of host and port"),
+    workers: int = typer.Option(1, help="Number of jobs run at the same time", show_default=True),
+    queue_size: int = typer.Option(16, help="Maximum number of waiting jobs, further submissions are rejected with 503", show_default=True),
+    feature_cache: str = typer.Option(None, help="Folder of a persistent cache of fixed image SIFT features shared by all registration jobs"),
+    feature_cache_size_mb: int = typer.Option(1024, help="Maximum size of the feature cache in MB", show_default=True),
+    allow_remote: bool = typer.Option(False, "--allow-remote", help="Allow a non-loopback --host. Jobs are unauthenticated and read and write files on this machine")
+):
+    from .server import serve
+    from .cache import FeatureCache
 
-    os.makedirs(output_folder_path, exist_ok=True)
-    np.save(os.path.join(output_folder_path, "transformed_segmentation_mask.npy"), moved_mask)
-    print(f"Transformed segmentation mask saved to {output_folder_path}/transformed_segmentation_mask.npy")
+    serve(host=host, port=port, socket_path=socket, workers=workers, queue_size=queue_size,
+          feature_cache=FeatureCache(feature_cache, feature_cache_size_mb) if feature_cache is not None else None, allow_remote=allow_remote)
 
 
 
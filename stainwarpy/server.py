@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import uuid
+import queue
+import socket
+import inspect
+import ipaddress
+import threading
+import traceback
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .regPipeline import registration_pipeline, save_registration_outputs, registered_image_path, transform_seg_mask_files, PROFILE_NAME, TRANSFORM_NAME
+from .points import transform_points_path
+from .profiling import StageProfiler
+
+
+JOB_STATES = ("queued", "running", "completed", "failed")
+
+# pipeline arguments given by the job itself or set by the server, which a job cannot override
+JOB_OPTIONS = ("fixed_path", "moving_path", "fixed_px_sz", "moving_px_sz", "fixed_img")
+SERVER_OPTIONS = ("output_path", "profiler", "feature_cache")
+MANAGED_OPTIONS = JOB_OPTIONS + SERVER_OPTIONS
+PIPELINE_OPTIONS = tuple(name for name in inspect.signature(registration_pipeline).parameters if name not in MANAGED_OPTIONS)
+
+
+def register_job(fixed_path, moving_path, output_folder, fixed_img, fixed_px_sz=None, moving_px_sz=None, profile=False, feature_cache=None, **pipeline_options):
+
+    os.makedirs(output_folder, exist_ok=True)
+    ome_tiff = pipeline_options.get("ome_tiff", False)
+    final_img_path = registered_image_path(output_folder, ome_tiff)
+    profiler = StageProfiler() if profile else None
+
+    transformation_map, final_img, tre, mi = registration_pipeline(
+        fixed_path,
+        moving_path,
+        fixed_px_sz,
+        moving_px_sz,
+        fixed_img,
+        output_path=final_img_path if pipeline_options.get("tile_size") is not None or ome_tiff else None,
+        feature_cache=feature_cache,
+        profiler=profiler,
+        **pipeline_options
+    )
+    save_registration_outputs(output_folder, transformation_map, final_img, tre, mi, final_img_path)
+    if profiler is not None:
+        profiler.save(os.path.join(output_folder, PROFILE_NAME))
+
+    return {
+        "output_folder": output_folder,
+        "transformation_map": os.path.join(output_folder, "feature_based_transformation_map.npy"),
+        "transform": os.path.join(output_folder, TRANSFORM_NAME),
+        "seed": transformation_map.seed,
+        "TRE": tre,
+        "Mutual Information": mi,
+    }
+
+
+
+def transform_seg_mask_job(mask_path, output_folder, tform_map_path, moving_px_sz, fixed_path=None, fixed_px_sz=None, tile_size=None, mode=None, centroids=False, contours=False):
+    return transform_seg_mask_files(mask_path, fixed_path, output_folder, tform_map_path, moving_px_sz, fixed_px_sz,
+                                    tile_size=tile_size, mode=mode, centroids=centroids, contours=contours)
+
+
+
+def transform_points_job(input_path, output_path, tform_map_path, moving_px_sz=None, fixed_px_sz=None, fixed_path=None, units="px", x_col="x", y_col="y", batch_size=100000):
+    n_points = transform_points_path(input_path, output_path, tform_map_path, moving_px_sz, fixed_px_sz, fixed_path=fixed_path,
+                                     units=units, x_col=x_col, y_col=y_col, batch_size=batch_size)
+
+    return {"output_path": output_path, "points": n_points}
+
+
+
+JOB_KINDS = {
+    "register": register_job,
+    "transform-seg-mask": transform_seg_mask_job,
+    "transform-points": transform_points_job,
+}
+
+
+def validate_job(kind, params):
+
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job type '{kind}'. Use one of {list(JOB_KINDS)}.")
+    if not isinstance(params, dict):
+        raise ValueError("The job parameters must be a JSON object.")
+
+    job = JOB_KINDS[kind]
+    if kind == "register":
+        # the output path, profiler and feature cache belong to the server
+        managed = [name for name in params if name in SERVER_OPTIONS]
+        if managed:
+            raise ValueError(f"Parameters {managed} are set by the server and cannot be given by a '{kind}' job.")
+
+        # registration options are checked against the pipeline itself
+        unknown = [name for name in params if name not in inspect.signature(job).parameters and name not in PIPELINE_OPTIONS]
+        if unknown:
+            raise ValueError(f"Unknown parameters for '{kind}': {unknown}.")
+    try:
+        inspect.signature(job).bind(**params)
+    except TypeError as e:
+        raise ValueError(f"Invalid parameters for '{kind}': {e}.")
+
+
+
+def to_json(value):
+    # numpy scalars in the metrics
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+
+class JobQueue:
+    # bounded queue of jobs run by a fixed pool of worker threads in this (already warmed up) process
+
+    def __init__(self, workers=1, queue_size=16, feature_cache=None, keep_jobs=1000):
+        self.feature_cache = feature_cache
+        self.keep_jobs = keep_jobs
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, kind, params):
+        validate_job(kind, params)
+        job = {"job_id": uuid.uuid4().hex, "type": kind, "status": "queued", "params": params,
+               "submitted": time.time(), "started": None, "finished": None, "result": None, "error": None}
+
+        with self.lock:
+            # raises queue.Full when the queue is at capacity
+            self.pending.put_nowait(job["job_id"])
+            self.jobs[job["job_id"]] = job
+            self.forget_finished()
+
+        return self.status(job["job_id"])
+
+    def forget_finished(self):
+        # oldest finished jobs are dropped beyond keep_jobs
+        finished = [job for job in self.jobs.values() if job["status"] in ("completed", "failed")]
+        for job in sorted(finished, key=lambda job: job["finished"])[:max(len(self.jobs) - self.keep_jobs, 0)]:
+            del self.jobs[job["job_id"]]
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def summary(self):
+        with self.lock:
+            counts = {state: sum(job["status"] == state for job in self.jobs.values()) for state in JOB_STATES}
+
+        return {"workers": len(self.workers), "queue_size": self.pending.maxsize, "jobs": counts}
+
+    def work(self):
+        while True:
+            job_id = self.pending.get()
+            with self.lock:
+                job = self.jobs[job_id]
+                job.update(status="running", started=time.time())
+
+            params = dict(job["params"])
+            if job["type"] == "register":
+                params["feature_cache"] = self.feature_cache
+
+            try:
+                result = JOB_KINDS[job["type"]](**params)
+                update = dict(status="completed", result=result)
+            except Exception as e:
+                traceback.print_exc()
+                update = dict(status="failed", error=f"{type(e).__name__}: {e}")
+
+            with self.lock:
+                job.update(finished=time.time(), **update)
+            self.pending.task_done()
+
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    # POST /jobs/<type> submits a job, GET /jobs/<job_id> returns its status, GET /status the queue summary
+
+    def send_json(self, code, body):
+        data = json.dumps(body, default=to_json).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["status"]:
+            return self.send_json(200, self.server.jobs.summary())
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self.server.jobs.status(parts[1])
+            if job is None:
+                return self.send_json(404, {"error": f"Job {parts[1]} not found."})
+            return self.send_json(200, job)
+
+        self.send_json(404, {"error": f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self.send_json(404, {"error": f"Unknown path {self.path}."})
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length) or b"{}")
+            job = self.server.jobs.submit(parts[1], params)
+        except (ValueError, json.JSONDecodeError) as e:
+            return self.send_json(400, {"error": str(e)})
+        except queue.Full:
+            return self.send_json(503, {"error": "The job queue is full, retry later."})
+
+        self.send_json(202, job)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+
+class JobHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs):
+        self.jobs = jobs
+        super().__init__(address, JobRequestHandler)
+
+
+
+class JobUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, jobs):
+        self.jobs = jobs
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, JobRequestHandler)
+
+
+
+def is_loopback(host):
+    # every address the host name resolves to must be a loopback address
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except (socket.gaierror, UnicodeError):
+        return False
+
+    return bool(addresses) and all(ipaddress.ip_address(address.split("%")[0]).is_loopback for address in addresses)
+
+
+
+def serve(host="127.0.0.1", port=8765, socket_path=None, workers=1, queue_size=16, feature_cache=None, allow_remote=False):
+
+    # jobs read and write any path the server can access and there is no authentication, so only local clients are served by default
+    if socket_path is None and not is_loopback(host):
+        if not allow_remote:
+            raise ValueError(f"Refusing to listen on the non-loopback address '{host}': jobs are unauthenticated and read and write "
+                             "files on this machine. Use a loopback address or a Unix socket, or pass allow_remote=True (--allow-remote).")
+        print(f"Warning: listening on the non-loopback address '{host}'. Any client that can reach it can read and write files as this user.")
+
+    jobs = JobQueue(workers=workers, queue_size=queue_size, feature_cache=feature_cache)
+    server = JobUnixServer(socket_path, jobs) if socket_path is not None else JobHTTPServer((host, port), jobs)
+    print(f"Serving on {socket_path if socket_path is not None else f'http://{host}:{port}'} with {workers} worker(s), queue size {queue_size}.")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Server stopped.")
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,210 @@
+import numpy as np
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from skimage.transform import warp
+from tifffile import imwrite
+
+
+# spline prefilters (order 2, 4 and 5) reach further than their support: windows for orders above 1 are padded
+# until the effect of the window border has decayed, so the tiles match the warp of the whole image
+SPLINE_MARGIN = 24
+
+
+def transform_matrix(tform):
+    # accept skimage transforms as well as raw 3x3 matrices
+    matrix = tform.params if hasattr(tform, "params") else tform
+    matrix = np.asarray(matrix, dtype=float)
+
+    if matrix.shape != (3, 3):
+        raise ValueError(f"Expected a 3x3 transformation matrix, got shape {matrix.shape}.")
+
+    return matrix
+
+
+
+def tile_grid(output_shape, tile_size):
+    h, w = output_shape[:2]
+
+    for y0 in range(0, h, tile_size):
+        for x0 in range(0, w, tile_size):
+            yield y0, min(y0 + tile_size, h), x0, min(x0 + tile_size, w)
+
+
+
+def inverse_coords(inv_matrix, y0, y1, x0, x1):
+    # map output pixel centres of a tile back into the source image (rows, cols)
+    xs = np.arange(x0, x1, dtype=float)
+    ys = np.arange(y0, y1, dtype=float)
+
+    src_x = np.add.outer(inv_matrix[0, 1] * ys, inv_matrix[0, 0] * xs) + inv_matrix[0, 2]
+    src_y = np.add.outer(inv_matrix[1, 1] * ys, inv_matrix[1, 0] * xs) + inv_matrix[1, 2]
+
+    if not np.allclose(inv_matrix[2], [0, 0, 1]):
+        src_w = np.add.outer(inv_matrix[2, 1] * ys, inv_matrix[2, 0] * xs) + inv_matrix[2, 2]
+        src_x /= src_w
+        src_y /= src_w
+
+    return src_y, src_x
+
+
+
+def source_window(src_y, src_x, image_shape, margin):
+    # smallest window of the source image needed to interpolate the given coordinates
+    h, w = image_shape[:2]
+
+    ymin = max(int(np.floor(src_y.min())) - margin, 0)
+    ymax = min(int(np.ceil(src_y.max())) + margin + 1, h)
+    xmin = max(int(np.floor(src_x.min())) - margin, 0)
+    xmax = min(int(np.ceil(src_x.max())) + margin + 1, w)
+
+    if ymin >= ymax or xmin >= xmax:
+        return None
+
+    return ymin, ymax, xmin, xmax
+
+
+
+def cast_to_dtype(values, dtype):
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+
+    return values.astype(dtype, copy=False)
+
+
+
+def sampling_plan(src_y, src_x, window_shape, order, dtype=np.float32):
+    # flat indices into the source window padded by one pixel of cval, and their bilinear weights;
+    # coordinates outside the window are clipped onto the padding, which reproduces mode="grid-constant"
+    hp, wp = window_shape[0] + 2, window_shape[1] + 2
+
+    if order == 0:
+        iy = np.clip(np.floor(src_y + 1.5), 0, hp - 1).astype(np.intp)
+        ix = np.clip(np.floor(src_x + 1.5), 0, wp - 1).astype(np.intp)
+        return [iy * wp + ix], None
+
+    # float32 weights are exact enough for 8/16 bit images and halve the memory traffic
+    weight_dtype = np.result_type(np.float32, dtype)
+    fy, fx = np.floor(src_y), np.floor(src_x)
+    wy, wx = (src_y - fy).astype(weight_dtype), (src_x - fx).astype(weight_dtype)
+    iy0 = np.clip(fy + 1, 0, hp - 1).astype(np.intp) * wp
+    iy1 = np.clip(fy + 2, 0, hp - 1).astype(np.intp) * wp
+    ix0 = np.clip(fx + 1, 0, wp - 1).astype(np.intp)
+    ix1 = np.clip(fx + 2, 0, wp - 1).astype(np.intp)
+
+    indices = [iy0 + ix0, iy0 + ix1, iy1 + ix0, iy1 + ix1]
+    weights = [(1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx]
+
+    return indices, weights
+
+
+
+def apply_sampling_plan(plane, indices, weights, dtype):
+    # gather one padded channel plane in its native dtype
+    flat = plane.ravel()
+    if weights is None:
+        return np.take(flat, indices[0])
+
+    values = np.take(flat, indices[0]) * weights[0]
+    for idx, weight in zip(indices[1:], weights[1:]):
+        values += np.take(flat, idx) * weight
+
+    return cast_to_dtype(values, dtype)
+
+
+
+def warp_tile(image, inv_matrix, y0, y1, x0, x1, order=1, cval=0, channel=None, executor=None):
+    channels = image.shape[2:] if channel is None else ()
+    tile = np.full((y1 - y0, x1 - x0) + channels, cval, dtype=image.dtype)
+
+    src_y, src_x = inverse_coords(inv_matrix, y0, y1, x0, x1)
+    window = source_window(src_y, src_x, image.shape, margin=order + 1 if order <= 1 else SPLINE_MARGIN)
+    if window is None:
+        return tile
+
+    # read only the part of the source needed for this tile
+    wy0, wy1, wx0, wx1 = window
+    src = np.asarray(image[wy0:wy1, wx0:wx1] if channel is None else image[wy0:wy1, wx0:wx1, channel])
+
+    if order > 1:
+        # the same interpolation as skimage's warp of the whole image (cubic convolution for order 3, splines otherwise),
+        # with the inverse matrix moved to the tile and the window
+        window_matrix = inv_matrix.copy()
+        window_matrix[:2] -= np.outer([wx0, wy0], inv_matrix[2])
+        window_matrix[:, 2] += window_matrix[:, 0] * x0 + window_matrix[:, 1] * y0
+        values = warp(src.astype(np.result_type(np.float32, src.dtype)), window_matrix, output_shape=tile.shape[:2], order=order, cval=cval, clip=False)
+        tile[:] = cast_to_dtype(values, image.dtype)
+        return tile
+
+    src_y -= wy0
+    src_x -= wx0
+
+    # nearest/bilinear indices and weights are computed once and shared by all channels
+    indices, weights = sampling_plan(src_y, src_x, src.shape, order, src.dtype)
+    planes = np.full((src.shape[2] if src.ndim == 3 else 1, src.shape[0] + 2, src.shape[1] + 2), cval, dtype=src.dtype)
+    planes[:, 1:-1, 1:-1] = np.moveaxis(src, -1, 0) if src.ndim == 3 else src
+
+    if src.ndim == 2:
+        tile[:] = apply_sampling_plan(planes[0], indices, weights, image.dtype)
+        return tile
+
+    def warp_channel(c):
+        tile[:, :, c] = apply_sampling_plan(planes[c], indices, weights, image.dtype)
+
+    if executor is None:
+        for c in range(len(planes)):
+            warp_channel(c)
+    else:
+        # numpy releases the GIL in the gathers, so channels can be warped by a pool of threads
+        list(executor.map(warp_channel, range(len(planes))))
+
+    return tile
+
+
+
+def channel_executor(channel_workers):
+    return ThreadPoolExecutor(max_workers=channel_workers) if channel_workers is not None and channel_workers > 1 else nullcontext()
+
+
+
+def iter_warp_tiles(image, tform, output_shape, tile_size=1024, order=1, cval=0, channel_workers=None, tissue=None):
+    inv_matrix = np.linalg.inv(transform_matrix(tform))
+
+    with channel_executor(channel_workers) as executor:
+        for y0, y1, x0, x1 in tile_grid(output_shape, tile_size):
+            # output tiles without tissue are left at cval
+            if tissue is not None and not tissue.any_in(y0, y1, x0, x1):
+                yield (y0, y1, x0, x1), np.full((y1 - y0, x1 - x0) + tuple(image.shape[2:]), cval, dtype=image.dtype)
+                continue
+            yield (y0, y1, x0, x1), warp_tile(image, inv_matrix, y0, y1, x0, x1, order=order, cval=cval, executor=executor)
+
+
+
+def warp_tiled(image, tform, output_shape, tile_size=1024, order=1, cval=0, out=None, channel_workers=None, tissue=None):
+
+    h, w = output_shape[:2]
+    if out is None:
+        out = np.empty((h, w) + tuple(image.shape[2:]), dtype=image.dtype)
+
+    for (y0, y1, x0, x1), tile in iter_warp_tiles(image, tform, (h, w), tile_size, order, cval, channel_workers, tissue):
+        out[y0:y1, x0:x1] = tile
+
+    return out
+
+
+
+def warp_to_tiff(file_path, image, tform, output_shape, tile_size=1024, order=1, cval=0, compression=None, channel_workers=None, tissue=None):
+
+    if tile_size % 16 != 0:
+        raise ValueError("tile_size must be a multiple of 16 for tiled TIFF output.")
+
+    h, w = output_shape[:2]
+    shape = (h, w) + tuple(image.shape[2:])
+    tiles = (tile for _, tile in iter_warp_tiles(image, tform, (h, w), tile_size, order, cval, channel_workers, tissue))
+
+    # tiles are streamed to the writer as they are computed
+    imwrite(file_path, tiles, shape=shape, dtype=image.dtype, tile=(tile_size, tile_size),
+            photometric="minisblack", planarconfig="contig" if len(shape) == 3 else None,
+            compression=compression, bigtiff=True)
+
+    return file_path
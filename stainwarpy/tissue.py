@@ -0,0 +1,120 @@
+import itertools
+import numpy as np
+from scipy import ndimage
+from skimage.filters import threshold_otsu
+
+
+class TissueMask:
+    # low resolution tissue mask of an image, queried in the full resolution pixel coordinates of that image
+
+    def __init__(self, mask, downsample, shape):
+        self.mask = mask
+        self.downsample = downsample
+        self.shape = tuple(shape[:2])
+
+    @property
+    def coverage(self):
+        return float(self.mask.mean())
+
+    def contains(self, rows, cols):
+        # whether the (row, col) points lie on tissue
+        r = np.clip((np.asarray(rows) / self.downsample).astype(np.intp), 0, self.mask.shape[0] - 1)
+        c = np.clip((np.asarray(cols) / self.downsample).astype(np.intp), 0, self.mask.shape[1] - 1)
+        return self.mask[r, c]
+
+    def any_in(self, y0, y1, x0, x1):
+        # whether the window [y0, y1) x [x0, x1) contains any tissue
+        f = self.downsample
+        my0, mx0 = max(int(y0 // f), 0), max(int(x0 // f), 0)
+        my1, mx1 = int(np.ceil(y1 / f)), int(np.ceil(x1 / f))
+        return bool(self.mask[my0:my1, mx0:mx1].any())
+
+    def full(self, shape=None, chunk_rows=1024):
+        # full resolution boolean mask, e.g. for the mutual information
+        h, w = self.shape if shape is None else shape[:2]
+        cols = np.minimum((np.arange(w) / self.downsample).astype(np.intp), self.mask.shape[1] - 1)
+        out = np.empty((h, w), dtype=bool)
+        for r0 in range(0, h, chunk_rows):
+            rows = np.minimum((np.arange(r0, min(r0 + chunk_rows, h)) / self.downsample).astype(np.intp), self.mask.shape[0] - 1)
+            out[r0:r0 + chunk_rows] = self.mask[rows[:, None], cols]
+
+        return out
+
+    def bounding_boxes(self):
+        # (y0, y1, x0, x1) in full resolution px around every tissue region, overlapping boxes merged into one
+        f = self.downsample
+        labels, _ = ndimage.label(self.mask)
+        boxes = [[s[0].start, s[0].stop, s[1].start, s[1].stop] for s in ndimage.find_objects(labels)]
+
+        while True:
+            for i, j in itertools.combinations(range(len(boxes)), 2):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    break
+            else:
+                break
+
+        h, w = self.shape
+        return [(int(y0 * f), min(int(np.ceil(y1 * f)), h), int(x0 * f), min(int(np.ceil(x1 * f)), w)) for y0, y1, x0, x1 in boxes]
+
+    def scaled(self, factor, shape):
+        # the same mask queried in the px of the image resampled to factor times larger pixels, e.g. the SIFT inputs
+        return TissueMask(self.mask, self.downsample / factor, shape)
+
+
+
+def block_mean(image, factor):
+    # mean over factor x factor blocks, the last partial blocks included
+    h, w = image.shape[:2]
+    hb, wb = -(-h // factor), -(-w // factor)
+    sums = np.zeros((hb, wb))
+    counts = np.zeros((hb, wb))
+
+    # row blocks keep the float copies small for large images
+    for b0 in range(0, hb, max(1, 1024 // factor)):
+        rows = np.asarray(image[b0 * factor:(b0 + max(1, 1024 // factor)) * factor], dtype=np.float32)
+        rb = -(-rows.shape[0] // factor)
+        pad = ((0, rb * factor - rows.shape[0]), (0, wb * factor - w))
+        valid = np.pad(np.ones(rows.shape, dtype=np.float32), pad)
+        rows = np.pad(rows, pad)
+        sums[b0:b0 + rb] = rows.reshape(rb, factor, wb, factor).sum(axis=(1, 3))
+        counts[b0:b0 + rb] = valid.reshape(rb, factor, wb, factor).sum(axis=(1, 3))
+
+    return sums / np.maximum(counts, 1)
+
+
+
+def detect_tissue(image, bright_tissue=True, target_size=512, sigma=16, closing=32, margin=32, min_size_fraction=0.001, scale=1):
+
+    # Otsu threshold of a smoothed, low resolution copy of the hematoxylin / DAPI signal;
+    # sigma, closing and margin are in full resolution px, so the gaps between nuclei close at any downsampling;
+    # the image may itself be downsampled scale times (e.g. read from a pyramid level), the mask is queried in full resolution px
+    downsample = max(1, int(np.ceil(max(image.shape[:2]) / target_size)))
+    full_px = downsample * scale
+    shape = (image.shape[0] * scale, image.shape[1] * scale)
+    low = ndimage.gaussian_filter(block_mean(image, downsample), sigma / full_px)
+    if low.max() <= low.min():
+        return TissueMask(np.ones(low.shape, dtype=bool), full_px, shape)
+
+    threshold = threshold_otsu(low)
+    mask = low > threshold if bright_tissue else low < threshold
+
+    # close gaps, fill holes, drop specks and keep a margin around the tissue edge
+    structure = ndimage.generate_binary_structure(2, 1)
+    mask = ndimage.binary_closing(mask, structure, iterations=max(1, round(closing / full_px)), border_value=0)
+    mask = ndimage.binary_fill_holes(mask)
+    labels, n = ndimage.label(mask)
+    if n > 0:
+        sizes = np.bincount(labels.ravel())
+        keep = sizes >= max(min_size_fraction * mask.size, 1)
+        keep[0] = False
+        mask = keep[labels]
+    mask = ndimage.binary_dilation(mask, structure, iterations=max(1, round(margin / full_px)))
+
+    # nothing detected keeps everything
+    if not mask.any():
+        mask[:] = True
+
+    return TissueMask(mask, full_px, shape)
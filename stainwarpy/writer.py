@@ -0,0 +1,206 @@
+import os
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tifffile import TiffWriter
+from .tiling import tile_grid, warp_tile, transform_matrix, cast_to_dtype
+from .preprocess import LazyImage, ChannelsLastView, PagedChannels
+
+
+def pyramid_levels(shape, tile_size):
+    # halve the image until it fits in a single tile
+    h, w = shape[:2]
+    levels = 1
+    while max(h, w) > tile_size:
+        h, w = (h + 1) // 2, (w + 1) // 2
+        levels += 1
+
+    return levels
+
+
+
+def downsample_tile(tile):
+    # 2x2 mean, replicating the last row/column of odd sized tiles
+    h, w = tile.shape
+    tile = np.pad(tile, ((0, h % 2), (0, w % 2)), mode="edge")
+
+    return tile.reshape((h + 1) // 2, 2, (w + 1) // 2, 2).mean(axis=(1, 3))
+
+
+
+def array_tile_reader(image):
+    # tiles of an in-memory, memory-mapped or lazily loaded (h, w) / (h, w, c) image
+    def read_tile(channel, y0, y1, x0, x1):
+        return np.asarray(image[y0:y1, x0:x1] if image.ndim == 2 else image[y0:y1, x0:x1, channel])
+
+    return read_tile
+
+
+
+def warp_tile_reader(image, tform, order=1, cval=0, tissue=None):
+    # tiles of the moving image warped into the fixed frame, computed on demand
+    inv_matrix = np.linalg.inv(transform_matrix(tform))
+
+    def read_tile(channel, y0, y1, x0, x1):
+        if tissue is not None and not tissue.any_in(y0, y1, x0, x1):
+            return np.full((y1 - y0, x1 - x0), cval, dtype=image.dtype)
+        return warp_tile(image, inv_matrix, y0, y1, x0, x1, order=order, cval=cval, channel=channel if image.ndim == 3 else None)
+
+    return read_tile
+
+
+
+def iter_level_tiles(read_tile, n_channels, shape, tile_size, dtype, next_level=None):
+
+    for c in range(n_channels):
+        for y0, y1, x0, x1 in tile_grid(shape, tile_size):
+            tile = read_tile(c, y0, y1, x0, x1)
+
+            # the next pyramid level is built from the tiles as they pass through
+            if next_level is not None:
+                next_level[c, y0 // 2:(y1 + 1) // 2, x0 // 2:(x1 + 1) // 2] = cast_to_dtype(downsample_tile(tile), dtype)
+
+            yield tile
+
+
+
+def write_pyramidal_ome_tiff(file_path, read_tile, shape, dtype, channel_names=None, pixel_size=None, tile_size=512, levels=None, compression="zlib"):
+
+    if tile_size % 16 != 0:
+        raise ValueError("tile_size must be a multiple of 16 for tiled TIFF output.")
+
+    h, w = shape[:2]
+    n_channels = shape[2] if len(shape) == 3 else 1
+    levels = pyramid_levels(shape, tile_size) if levels is None else levels
+
+    if channel_names is not None and len(channel_names) != n_channels:
+        raise ValueError(f"Expected {n_channels} channel names, got {len(channel_names)}.")
+
+    metadata = {"axes": "CYX" if len(shape) == 3 else "YX"}
+    if channel_names is not None:
+        metadata["Channel"] = {"Name": list(channel_names)}
+    if pixel_size is not None:
+        metadata.update(PhysicalSizeX=pixel_size, PhysicalSizeXUnit="µm", PhysicalSizeY=pixel_size, PhysicalSizeYUnit="µm")
+
+    options = dict(dtype=dtype, tile=(tile_size, tile_size), compression=compression, photometric="minisblack")
+
+    # lower levels are staged in temporary memory-mapped files next to the output, never in memory
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(file_path))) as tmp_dir, \
+            TiffWriter(file_path, bigtiff=True, ome=True) as tif:
+
+        level_shape = (h, w)
+        current = read_tile
+        for level in range(levels):
+            next_shape = ((level_shape[0] + 1) // 2, (level_shape[1] + 1) // 2)
+            next_level = None
+            if level + 1 < levels:
+                next_level = np.lib.format.open_memmap(os.path.join(tmp_dir, f"level_{level + 1}.npy"), mode="w+",
+                                                       dtype=dtype, shape=(n_channels,) + next_shape)
+
+            tiles = iter_level_tiles(current, n_channels, level_shape, tile_size, dtype, next_level)
+            series_shape = (n_channels,) + level_shape if len(shape) == 3 else level_shape
+
+            if level == 0:
+                tif.write(tiles, shape=series_shape, subifds=levels - 1, metadata=metadata, **options)
+            else:
+                tif.write(tiles, shape=series_shape, subfiletype=1, metadata=None, **options)
+
+            if next_level is not None:
+                next_level.flush()
+                current = array_tile_reader(np.moveaxis(next_level, 0, -1) if len(shape) == 3 else next_level[0])
+            level_shape = next_shape
+
+    return file_path
+
+
+
+class SharedTileReader:
+    # windows of several channels read once and handed to one writer per channel; a writer running ahead
+    # waits while max_pending windows are still held for the slower ones
+
+    def __init__(self, read_window, n_readers, max_pending=4):
+        self.read_window = read_window
+        self.n_readers = n_readers
+        self.max_pending = max_pending
+        self.pending = {}
+        self.error = None
+        self.condition = threading.Condition()
+
+    def reader(self, index):
+        def read_tile(_, y0, y1, x0, x1):
+            key = (y0, y1, x0, x1)
+            with self.condition:
+                while key not in self.pending and len(self.pending) >= self.max_pending and self.error is None:
+                    self.condition.wait()
+                if self.error is not None:
+                    raise RuntimeError("Channel extraction stopped after an error in another channel.")
+                if key not in self.pending:
+                    self.pending[key] = [self.read_window(y0, y1, x0, x1), self.n_readers]
+
+                window = self.pending[key]
+                window[1] -= 1
+                if window[1] == 0:
+                    del self.pending[key]
+                    self.condition.notify_all()
+                return window[0][..., index]
+
+        return read_tile
+
+    def fail(self, error):
+        # the first error is kept, the other writers stop at their next tile
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+
+
+def extract_channels(file_path, output_folder_path, channels, tile_size=512, compression="zlib"):
+
+    # only the tiles (or pages) of the requested channels are read, and each channel is streamed to its own tiled TIFF
+    channels = list(dict.fromkeys(channels))
+    with LazyImage(file_path) as img:
+        data = img.data()
+        n_channels = img.shape[2] if img.ndim == 3 else 1
+        for channel in channels:
+            if not 0 <= channel < n_channels:
+                raise ValueError(f"Channel index {channel} out of range, the image has {n_channels} channel(s).")
+
+        os.makedirs(output_folder_path, exist_ok=True)
+        paths = [os.path.join(output_folder_path, f"multiplexed_channel_{channel}.tif") for channel in channels]
+
+        def write_channel(path, channel, read_tile):
+            channel_names = [img.channel_names[channel]] if img.channel_names is not None and len(img.channel_names) == n_channels else None
+            write_pyramidal_ome_tiff(path, read_tile, img.shape[:2], img.dtype, channel_names=channel_names, pixel_size=img.pixel_size,
+                                     tile_size=tile_size, levels=1, compression=compression)
+
+        # pages that can only be decoded whole are read one channel after another, which decodes every page once
+        if len(channels) == 1 or (isinstance(data, ChannelsLastView) and isinstance(data.data, PagedChannels)):
+            read_tile = array_tile_reader(data)
+            for path, channel in zip(paths, channels):
+                write_channel(path, channel, lambda _, y0, y1, x0, x1, channel=channel: read_tile(channel, y0, y1, x0, x1))
+            return paths
+
+        # otherwise all channels are extracted in one pass over the image: every window is read once (a pixel interleaved
+        # window once for all of its channels) and the outputs are written concurrently
+        def read_window(y0, y1, x0, x1):
+            if isinstance(data, ChannelsLastView):
+                return np.stack([np.asarray(data[y0:y1, x0:x1, channel]) for channel in channels], axis=-1)
+            window = np.asarray(data[y0:y1, x0:x1])
+            return window[..., None] if window.ndim == 2 else window[..., channels]
+
+        shared = SharedTileReader(read_window, len(channels))
+
+        def write_shared(i):
+            try:
+                write_channel(paths[i], channels[i], shared.reader(i))
+            except Exception as e:
+                shared.fail(e)
+
+        with ThreadPoolExecutor(max_workers=len(channels)) as executor:
+            list(executor.map(write_shared, range(len(channels))))
+        if shared.error is not None:
+            raise shared.error
+
+    return paths
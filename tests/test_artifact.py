@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from skimage.transform import SimilarityTransform, AffineTransform
+from stainwarpy.artifact import TransformArtifact, compose_transforms, load_transform, level_shape
+from stainwarpy.preprocess import scaled_shape
+
+
+def similarity_artifact(pixel_size=0.5):
+    tform = SimilarityTransform(scale=1.05, rotation=np.deg2rad(12), translation=(30, -8))
+    return TransformArtifact(tform.params, "similarity", (1001, 1203), (1100, 1250), pixel_size, pixel_size, seed=3)
+
+
+def grid(shape, n=7):
+    return np.stack(np.meshgrid(np.linspace(0, shape[1] - 1, n), np.linspace(0, shape[0] - 1, n)), axis=-1).reshape(-1, 2)
+
+
+def test_compose_with_inverse_is_identity():
+    t = similarity_artifact()
+
+    identity = compose_transforms([t, t.inverse])
+
+    np.testing.assert_allclose(identity.matrix, np.eye(3), atol=1e-12)
+    assert identity.source_shape == identity.target_shape == t.source_shape
+    np.testing.assert_allclose(t.inverse(t(grid(t.source_shape))), grid(t.source_shape), atol=1e-9)
+
+
+def test_inverse_swaps_frames():
+    t = similarity_artifact()
+    inverse = t.inverse
+
+    assert (inverse.source_shape, inverse.target_shape) == (t.target_shape, t.source_shape)
+    assert inverse.metadata["inverted"] and not inverse.inverse.metadata["inverted"]
+    np.testing.assert_allclose(inverse.inverse.matrix, t.matrix)
+
+
+def test_compose_rejects_mismatched_frames():
+    t = similarity_artifact()
+
+    with pytest.raises(ValueError):
+        t.then(t)
+
+
+def test_at_level_matches_pixel_centres_of_the_levels():
+    t = similarity_artifact()
+    level = t.at_level(2)
+
+    assert level.source_shape == level_shape(t.source_shape, 2) == (251, 301)
+    assert level.target_pixel_size == t.target_pixel_size * 4
+    # a level px centre p is the full resolution point (p + 0.5) * 4 - 0.5
+    points = grid(level.source_shape)
+    full = t((points + 0.5) * 4 - 0.5)
+    np.testing.assert_allclose(level(points), (full + 0.5) / 4 - 0.5)
+
+
+def test_at_pixel_size_shapes_match_the_image_resize():
+    t = similarity_artifact()
+
+    # a mask of the moving image at 3x the pixel size
+    rescaled = t.at_pixel_size(source_pixel_size=1.5)
+
+    assert rescaled.source_shape == scaled_shape(t.source_shape, 3)
+    assert rescaled.target_shape == t.target_shape
+    points = grid(rescaled.source_shape)
+    np.testing.assert_allclose(rescaled(points), t((points + 0.5) * 3 - 0.5))
+
+
+def test_save_and_load_round_trip(tmp_path):
+    t = compose_transforms([similarity_artifact(), TransformArtifact(AffineTransform(shear=0.1).params, "affine", (1100, 1250), (1100, 1250), 0.5, 0.5)])
+    path = tmp_path / "transform.json"
+    t.save(path)
+
+    loaded = load_transform(str(path))
+
+    assert loaded.kind == "affine"
+    np.testing.assert_allclose(loaded.matrix, t.matrix)
+    assert (loaded.source_shape, loaded.target_shape) == (t.source_shape, t.target_shape)
@@ -0,0 +1,65 @@
+import numpy as np
+from scipy import ndimage
+from scipy.stats import entropy
+from stainwarpy.metrics import bin_image, joint_histogram, overlap, mutual_information_metric, compute_mutual_information
+
+
+def histogram2d_mutual_information(fixed, moving, bins):
+    # the original implementation: crop to the overlap, then np.histogram2d
+    fixed, moving = overlap(fixed, moving)
+    hist_2d, _, _ = np.histogram2d(fixed.ravel(), moving.ravel(), bins=bins)
+    pxy = hist_2d / np.sum(hist_2d)
+    px, py = np.sum(pxy, axis=1), np.sum(pxy, axis=0)
+    Hx, Hy, Hxy = entropy(px), entropy(py), entropy(pxy.ravel())
+
+    return (Hx + Hy - Hxy) / np.mean([Hx, Hy])
+
+
+def different_shape_images(dtype=float):
+    rng = np.random.default_rng(0)
+    fixed = rng.random((120, 90))
+    moving = rng.random((100, 130))
+    # the largest values lie outside the overlap, so ranges of the uncropped images differ
+    fixed[110:, :] = 5
+    moving[:, 95:] = -3
+    if dtype != float:
+        fixed, moving = (fixed * 40).astype(dtype), ((moving + 3) * 30).astype(dtype)
+
+    return fixed, moving
+
+
+def test_joint_histogram_matches_histogram2d_on_different_shapes():
+    for dtype in (float, np.uint8):
+        fixed, moving = overlap(*different_shape_images(dtype))
+        expected, _, _ = np.histogram2d(fixed.ravel(), moving.ravel(), bins=50)
+
+        hist_2d = joint_histogram(bin_image(fixed, 50), bin_image(moving, 50), 50)
+        np.testing.assert_array_equal(hist_2d, expected)
+
+
+def test_mutual_information_matches_histogram2d_on_different_shapes():
+    fixed, moving = different_shape_images()
+    registered = np.roll(fixed, 3, axis=1)
+
+    assert np.isclose(mutual_information_metric(fixed, moving, 50), histogram2d_mutual_information(fixed, moving, 50))
+
+    scores = compute_mutual_information(fixed, moving, registered, bins=50)
+    assert np.isclose(scores['before registration'], histogram2d_mutual_information(fixed, moving, 50))
+    assert np.isclose(scores['after feature based'], histogram2d_mutual_information(fixed, registered, 50))
+
+
+def test_bin_image_of_a_constant_image():
+    assert (bin_image(np.full((4, 4), 7.0), 10) == 5).all()
+
+
+def test_sampled_mutual_information_lies_in_its_confidence_interval():
+    rng = np.random.default_rng(0)
+    fixed = ndimage.gaussian_filter(rng.normal(size=(400, 400)), 3)
+    moving = fixed + 0.5 * fixed.std() * rng.normal(size=fixed.shape)
+
+    scores = compute_mutual_information(fixed, moving, moving, bins=50, sample_size=20000, seed=1)
+    ci_low, ci_high = scores['after feature based 95% CI']
+
+    assert ci_low <= scores['after feature based'] <= ci_high
+    # the bias corrected interval of the sample covers the mutual information of every pixel
+    assert ci_low <= mutual_information_metric(fixed, moving, 50) <= ci_high
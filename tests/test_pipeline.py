@@ -0,0 +1,35 @@
+import numpy as np
+from scipy import ndimage
+from skimage.transform import warp, SimilarityTransform
+from tifffile import imwrite
+from stainwarpy.regPipeline import registration_pipeline
+
+
+def synthetic_pair(folder, size=384, seed=0):
+    # DAPI like nuclei and the same nuclei as a hematoxylin stained H&E image, rotated and shifted
+    rng = np.random.default_rng(seed)
+    nuclei = np.zeros((size, size))
+    nuclei[tuple(rng.integers(16, size - 16, (2, 600)))] = 1
+    nuclei = ndimage.gaussian_filter(nuclei, 2.5)
+    nuclei /= nuclei.max()
+
+    truth = SimilarityTransform(rotation=np.deg2rad(6), translation=(20, -12))
+    moving = warp(nuclei, truth, order=1)
+    hematoxylin = np.array([0.65, 0.70, 0.29])
+    hne = 255 * 10 ** -(1.2 * moving[..., None] * hematoxylin + rng.normal(0, 0.01, (size, size, 3)))
+
+    fixed_path, moving_path = str(folder / "fixed.tif"), str(folder / "moving.tif")
+    imwrite(fixed_path, (np.clip(0.03 + 0.9 * nuclei, 0, 1) * 65535).astype(np.uint16))
+    imwrite(moving_path, np.clip(hne, 0, 255).astype(np.uint8))
+
+    return fixed_path, moving_path
+
+
+def test_registration_is_repeatable_with_a_seed(tmp_path):
+    fixed_path, moving_path = synthetic_pair(tmp_path)
+
+    first, *_ = registration_pipeline(fixed_path, moving_path, 0.5, 0.5, "multiplexed", seed=7)
+    second, *_ = registration_pipeline(fixed_path, moving_path, 0.5, 0.5, "multiplexed", seed=7)
+
+    np.testing.assert_array_equal(first.matrix, second.matrix)
+    assert first.seed == second.seed == 7
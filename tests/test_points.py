@@ -0,0 +1,99 @@
+import csv
+import io
+import json
+import numpy as np
+from skimage.transform import SimilarityTransform
+from stainwarpy.artifact import TransformArtifact
+from stainwarpy.points import transform_points_path, transform_geojson, JsonStream
+
+
+def registration_artifact(path, metadata):
+    # moving px (0.5 um) -> fixed image resampled to 0.5 um, the fixed image itself has 0.25 um px
+    tform = SimilarityTransform(rotation=0.1, translation=(12, -4))
+    artifact = TransformArtifact(tform.params, "similarity", (400, 400), (420, 410), 0.5, 0.5, seed=0, metadata=metadata)
+    artifact.save(path)
+
+    return artifact
+
+
+def transform_csv(tmp_path, artifact_path, points, **kwargs):
+    with open(tmp_path / "points.csv", "w", newline="") as f:
+        csv.writer(f).writerows([["x", "y"]] + points.tolist())
+    transform_points_path(str(tmp_path / "points.csv"), str(tmp_path / "out.csv"), str(artifact_path), **kwargs)
+    with open(tmp_path / "out.csv") as f:
+        return np.array([[float(row["x"]), float(row["y"])] for row in csv.DictReader(f)])
+
+
+def test_artifact_points_default_to_the_fixed_image(tmp_path):
+    artifact = registration_artifact(tmp_path / "transform.json", {"fixed_pixel_size": 0.25})
+    points = np.array([[0.0, 0.0], [100.5, 30.25], [399.0, 250.0]])
+
+    mapped = transform_csv(tmp_path, tmp_path / "transform.json", points)
+
+    # pixel centres of the registration frame in px of the fixed image, the same as passing --fixed-px-sz
+    np.testing.assert_allclose(mapped, (artifact(points) + 0.5) * 2 - 0.5)
+    np.testing.assert_allclose(mapped, transform_csv(tmp_path, tmp_path / "transform.json", points, fixed_px_sz=0.25))
+
+
+def test_artifact_points_without_fixed_pixel_size_stay_in_the_target_frame(tmp_path, capsys):
+    artifact = registration_artifact(tmp_path / "transform.json", {})
+    points = np.array([[10.0, 20.0], [300.0, 5.0]])
+
+    mapped = transform_csv(tmp_path, tmp_path / "transform.json", points)
+
+    np.testing.assert_allclose(mapped, artifact(points))
+    assert "target frame" in capsys.readouterr().out
+
+
+def annotations():
+    polygon = [[[0.0, 0.0], [10.0, 0.0], [10.0, 12.5], [0.0, 0.0]]]
+    return {
+        "type": "FeatureCollection",
+        "name": "cells",
+        "bbox": [0, 0, 100, 100],
+        "features": [
+            {"type": "Feature", "bbox": [0, 0, 10, 12.5], "properties": {"label": 1}, "geometry": {"type": "Polygon", "coordinates": polygon}},
+            {"type": "Feature", "properties": {"label": 2}, "geometry": {"type": "Point", "coordinates": [3.5, 7.25]}},
+            {"type": "Feature", "properties": {}, "geometry": None},
+            {"type": "Feature", "properties": {"label": "3"}, "geometry": {"type": "GeometryCollection", "geometries": [
+                {"type": "MultiPoint", "coordinates": [[1.0, 2.0], [30.0, 40.0]]}, {"type": "LineString", "coordinates": [[5.0, 5.0], [6.0, 9.0]]}]}},
+        ] * 3,
+        "crs": {"type": "name", "properties": {"name": "px"}},
+    }
+
+
+def test_geojson_is_streamed_feature_by_feature(tmp_path):
+    data = annotations()
+    with open(tmp_path / "in.geojson", "w") as f:
+        json.dump(data, f, indent=1)
+    shift = lambda xy: xy + [100.0, -50.0]
+
+    # batches of a few points, so the features are written in several batches
+    n_points = transform_geojson(str(tmp_path / "in.geojson"), str(tmp_path / "out.geojson"), shift, batch_size=3)
+
+    with open(tmp_path / "out.geojson") as f:
+        result = json.load(f)
+    assert n_points == 3 * 9
+    assert "bbox" not in result and all("bbox" not in feature for feature in result["features"])
+    assert (result["name"], result["crs"]) == (data["name"], data["crs"])
+    assert [feature["properties"] for feature in result["features"]] == [feature["properties"] for feature in data["features"]]
+    assert result["features"][0]["geometry"]["coordinates"][0][2] == [110.0, -37.5]
+    assert result["features"][3]["geometry"]["geometries"][0]["coordinates"][1] == [130.0, -10.0]
+
+
+def test_geojson_of_a_single_feature(tmp_path):
+    with open(tmp_path / "in.geojson", "w") as f:
+        json.dump({"type": "Feature", "geometry": {"type": "Point", "coordinates": [1.0, 2.0]}, "properties": None}, f)
+
+    assert transform_geojson(str(tmp_path / "in.geojson"), str(tmp_path / "out.geojson"), lambda xy: xy * 2) == 1
+    with open(tmp_path / "out.geojson") as f:
+        assert json.load(f)["geometry"]["coordinates"] == [2.0, 4.0]
+
+
+def test_json_stream_reads_values_across_chunks():
+    stream = JsonStream(io.StringIO(' {"a": [1, {"b": "x y"}], "n": 12345 , "c": []} '), chunk_size=4)
+
+    stream.expect("{")
+    values = {key: stream.value() for key in stream.members()}
+
+    assert values == {"a": [1, {"b": "x y"}], "n": 12345, "c": []}
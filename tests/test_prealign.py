@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from skimage.transform import warp, AffineTransform
+from stainwarpy.prealign import estimate_prealignment, orientation_matrix, needs_prealignment
+
+
+def synthetic_section(size=256, seed=0):
+    # irregular tissue outline (thresholded smooth noise) with finer texture, inside a disc so every rotation stays on the canvas
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    inside = np.hypot(yy - size / 2, xx - size / 2) < size * 0.4
+    shape = ndimage.gaussian_filter(rng.normal(size=(size, size)), size / 12)
+    tissue = (shape > np.quantile(shape[inside], 0.5)) & inside
+    texture = ndimage.gaussian_filter(rng.uniform(size=(size, size)), 2)
+
+    return ndimage.gaussian_filter(tissue * (0.5 + texture), 1.5)
+
+
+
+def moving_section(fixed, angle, flip):
+    # moving image such that the orientation_matrix(angle, flip) maps it back onto the fixed one
+    center = ((fixed.shape[1] - 1) / 2, (fixed.shape[0] - 1) / 2)
+    matrix = orientation_matrix(angle, flip, center, center)
+
+    return warp(fixed, AffineTransform(matrix=matrix), order=1), matrix
+
+
+def max_error(matrix, truth, shape):
+    grid = np.stack(np.meshgrid(np.linspace(0, shape[1] - 1, 9), np.linspace(0, shape[0] - 1, 9)), axis=-1).reshape(-1, 2)
+    grid = np.column_stack([grid, np.ones(len(grid))])
+
+    return np.linalg.norm((grid @ matrix.T)[:, :2] - (grid @ truth.T)[:, :2], axis=1).max()
+
+
+@pytest.mark.parametrize("angle, flip", [(0, True), (73, False), (-117, True), (176, False)])
+def test_prealignment_finds_rotation_and_mirroring(angle, flip):
+    fixed = synthetic_section()
+    moving, truth = moving_section(fixed, angle, flip)
+
+    result = estimate_prealignment(fixed, moving)
+
+    assert result.flip == flip
+    # the finest search step is 2.5 degrees, on a thumbnail of half the image size
+    assert abs((result.angle - angle + 180) % 360 - 180) <= 2
+    assert max_error(result.matrix, truth, fixed.shape) < 6
+    assert needs_prealignment(result) == (flip or abs((angle + 180) % 360 - 180) > 10)
+
+
+def test_prealignment_matrix_is_in_registration_px():
+    # the search runs on the given images, the matrix maps between images scale times larger (e.g. at the SIFT scale factor)
+    fixed = synthetic_section()
+    moving, _ = moving_section(fixed, 40, True)
+
+    unscaled = estimate_prealignment(fixed, moving)
+    scaled = estimate_prealignment(fixed, moving, scale=4)
+
+    np.testing.assert_allclose(scaled.matrix[:2, :2], unscaled.matrix[:2, :2])
+    np.testing.assert_allclose(scaled.matrix[:2, 2], unscaled.matrix[:2, 2] * 4)
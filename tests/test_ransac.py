@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from skimage.transform import SimilarityTransform, AffineTransform
+from stainwarpy.ransac import ransac
+
+
+def matches_with_outliers(tform, n_inliers=200, n_outliers=100, noise=0.3, seed=0):
+    rng = np.random.default_rng(seed)
+    src = rng.uniform(0, 1000, (n_inliers + n_outliers, 2))
+    dst = tform(src) + rng.normal(0, noise, src.shape)
+    # outliers are moved far from their true position
+    dst[n_inliers:] = rng.uniform(0, 1000, (n_outliers, 2))
+
+    return src, dst, np.arange(len(src)) < n_inliers
+
+
+def max_error(model, truth):
+    # largest distance between the estimated and true positions over the image
+    grid = np.stack(np.meshgrid(np.linspace(0, 1000, 11), np.linspace(0, 1000, 11)), axis=-1).reshape(-1, 2)
+    return np.linalg.norm(model(grid) - truth(grid), axis=1).max()
+
+
+@pytest.mark.parametrize("quality", [False, True])
+def test_ransac_recovers_known_similarity(quality):
+    truth = SimilarityTransform(scale=1.3, rotation=np.deg2rad(25), translation=(40, -15))
+    src, dst, is_inlier = matches_with_outliers(truth)
+    # PROSAC ordering by a match quality that favours the inliers (lower is better)
+    order = np.where(is_inlier, 0.0, 1.0) + np.random.default_rng(1).uniform(0, 0.5, len(src)) if quality else None
+
+    result = ransac(src, dst, kind="similarity", residual_threshold=2, quality=order, seed=0)
+
+    assert max_error(result.model, truth) < 0.5
+    assert result.inliers[is_inlier].mean() > 0.95
+    assert not result.inliers[~is_inlier].any()
+
+
+def test_ransac_recovers_known_affine():
+    truth = AffineTransform(scale=(1.1, 0.9), rotation=np.deg2rad(-10), shear=0.1, translation=(5, 20))
+    src, dst, is_inlier = matches_with_outliers(truth)
+
+    result = ransac(src, dst, kind="affine", residual_threshold=2, seed=0)
+
+    assert max_error(result.model, truth) < 0.5
+    assert not result.inliers[~is_inlier].any()
+
+
+def test_ransac_is_repeatable_with_a_seed():
+    truth = SimilarityTransform(scale=0.8, rotation=0.3)
+    src, dst, _ = matches_with_outliers(truth, seed=2)
+
+    first = ransac(src, dst, kind="similarity", seed=7)
+    second = ransac(src, dst, kind="similarity", seed=7)
+
+    np.testing.assert_array_equal(first.model.params, second.model.params)
+    np.testing.assert_array_equal(first.inliers, second.inliers)
+
+
+def test_ransac_needs_enough_matches():
+    with pytest.raises(ValueError):
+        ransac(np.zeros((2, 2)), np.zeros((2, 2)), kind="affine")
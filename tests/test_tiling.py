@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from skimage.transform import warp, SimilarityTransform, ProjectiveTransform
+from stainwarpy.tiling import warp_tiled
+
+
+@pytest.mark.parametrize("order", [0, 1, 3, 5])
+def test_tiled_warp_matches_the_warp_of_the_whole_image(order):
+    rng = np.random.default_rng(0)
+    image = rng.random((300, 280))
+    tform = SimilarityTransform(scale=1.1, rotation=0.2, translation=(10, -20))
+
+    expected = warp(image, tform.inverse, output_shape=(320, 300), order=order, clip=False)
+    tiled = warp_tiled(image, tform, (320, 300), tile_size=64, order=order)
+
+    np.testing.assert_allclose(tiled, expected, atol=1e-6)
+
+
+def test_tiled_cubic_warp_of_a_multichannel_image():
+    rng = np.random.default_rng(1)
+    image = rng.random((200, 220, 3))
+    tform = ProjectiveTransform(matrix=np.array([[0.95, 0.1, 12], [-0.08, 1.02, 5], [1e-4, -5e-5, 1]]))
+
+    expected = warp(image, tform.inverse, output_shape=(210, 230), order=3, clip=False)
+    tiled = warp_tiled(image, tform, (210, 230), tile_size=48, order=3)
+
+    np.testing.assert_allclose(tiled, expected, atol=1e-6)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from tifffile import imread, imwrite
+from stainwarpy import writer
+from stainwarpy.writer import extract_channels, write_pyramidal_ome_tiff, array_tile_reader
+
+
+def multichannel_image(shape=(150, 170, 5), seed=0):
+    return np.random.default_rng(seed).integers(0, 65535, shape, dtype=np.uint16)
+
+
+@pytest.mark.parametrize("layout", ["planar", "interleaved"])
+def test_extract_channels_in_one_pass(tmp_path, layout):
+    image = multichannel_image()
+    path = str(tmp_path / "image.ome.tif")
+    if layout == "planar":
+        write_pyramidal_ome_tiff(path, array_tile_reader(image), image.shape, image.dtype, tile_size=64, levels=1)
+    else:
+        imwrite(path, image, tile=(64, 64), compression="zlib")
+
+    paths = extract_channels(path, str(tmp_path / "out"), [3, 0, 3, 4], tile_size=64)
+
+    assert [p.rsplit("_", 1)[1] for p in paths] == ["3.tif", "0.tif", "4.tif"]
+    for p, channel in zip(paths, [3, 0, 4]):
+        np.testing.assert_array_equal(imread(p), image[..., channel])
+
+
+class CountingImage:
+    # interleaved image counting the windows read from it
+    def __init__(self, image):
+        self.image, self.shape, self.dtype, self.ndim = image, image.shape, image.dtype, image.ndim
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return self.image[key]
+
+
+def test_extract_channels_reads_every_window_once(tmp_path, monkeypatch):
+    image = multichannel_image()
+    path = str(tmp_path / "image.tif")
+    imwrite(path, image)
+    counting = CountingImage(image)
+    monkeypatch.setattr(writer.LazyImage, "data", lambda self, level=0: counting)
+
+    extract_channels(path, str(tmp_path / "out"), [1, 2, 4], tile_size=64)
+
+    # 3 x 3 tiles, for all three channels together
+    assert counting.reads == 9